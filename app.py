@@ -1,14 +1,31 @@
 # app.py
 import os
+import re
+import json
 import time
 import uuid
-from openai import OpenAI, RateLimitError, AuthenticationError, APIConnectionError, OpenAIError, BadRequestError
-import google.generativeai as genai
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+import gzip
+import zlib
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, Response, stream_with_context
 from dotenv import load_dotenv
-import google.api_core.exceptions
+from chat_store import create_chat_store
+from search_index import create_search_index
+from providers import (
+    get_provider, list_providers, default_model_choice, fallback_model_choice, describe_catalog, ProviderResponseError, openai_errors, google_errors
+)
+from llm_clients import preload_sdks
+from context_window import fit_history
+from response_cache import create_response_cache
+from semantic_cache import create_semantic_cache, first_turn_message
+from rate_limiter import RateLimitQueueTimeout
+from circuit_breaker import CircuitOpenError, get_circuit_breaker, CLOSED
+from metrics import registry as metrics_registry, time_stage, COALESCED_REQUESTS
+from request_coalescing import SingleFlight, coalescing_key
+from fan_out import FAN_OUT_MODES, hedge, compare
 import logging
 import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 # --- Load Environment Variables ---
 load_dotenv()
@@ -18,6 +35,8 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logging.getLogger('werkzeug').setLevel(logging.WARNING) # Quieter Flask logs
 # Suppress excessive retry logs from OpenAI client during rate limiting for title generation
 logging.getLogger("openai").setLevel(logging.WARNING)
+# Provider SDKs load on first use (llm_clients.py) unless PRELOAD_LLM_SDKS names them
+preload_sdks()
 
 
 app = Flask(__name__)
@@ -29,6 +48,22 @@ if not app.secret_key:
     app.secret_key = secrets.token_hex(24) # Generate temp key, but sessions won't persist reliably across restarts
     logging.warning("Using temporary FLASK_SECRET_KEY. Sessions may be lost on restart.")
 
+# --- Configure Chat Storage (see chat_store.py; only a small user id lives in the cookie) ---
+chat_store = create_chat_store()
+# Full-text index the store keeps current on every write (SEARCH_INDEX_URL; empty disables /search)
+chat_store.search_index = create_search_index()
+# Opt-in completion cache (RESPONSE_CACHE_URL='memory' or 'sqlite:///...'); None when disabled
+response_cache = create_response_cache()
+if response_cache is not None:
+    metrics_registry.add_collector(lambda: [
+        "# TYPE chat_response_cache_hits_total counter", f"chat_response_cache_hits_total {response_cache.hits}",
+        "# TYPE chat_response_cache_misses_total counter", f"chat_response_cache_misses_total {response_cache.misses}",
+    ])
+# Opt-in similarity lookup for first messages that miss the exact cache (SEMANTIC_CACHE_ENABLED); None when disabled
+semantic_cache = create_semantic_cache()
+if semantic_cache is not None:
+    metrics_registry.add_collector(semantic_cache.collect_metrics)
+
 
 # --- Constants ---
 DEFAULT_SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful and modern assistant."}
@@ -38,49 +73,78 @@ Generate a very concise title (max 5 words) for a chat conversation that starts
 Respond ONLY with the title itself, nothing else. Example: "Python List Comprehension"
 """
 MAX_TITLE_GENERATION_TOKENS = 20
-# Define models for title generation per provider
-TITLE_GENERATION_MODEL_GPT = "gpt-3.5-turbo"
-# Use a fast model for Gemini title generation
-TITLE_GENERATION_MODEL_GEMINI = "gemini-1.5-flash-latest"
+# Titles generate_chat_title() falls back to, e.g. "Chat 14:05" or "Chat 14:05 (Rate Limit)"; see regenerate_titles.py
+FALLBACK_TITLE_PATTERN = re.compile(r"^Chat \d{2}:\d{2}( \([^)]*\))?$")
+TITLE_GENERATION_TEMPERATURE = 0.3
+# Models, temperatures, reply limits and timeouts come from the model catalog (see model_catalog.py)
+# Prompt token budget per chat model; the full history is stored, but only what fits is sent upstream.
+# Defaults come from the model catalog; override with CONTEXT_TOKEN_BUDGETS='{"gpt-3.5-turbo": 2000}' (JSON, model name -> tokens).
+CONTEXT_TOKEN_BUDGETS = json.loads(os.getenv("CONTEXT_TOKEN_BUDGETS", "{}"))
+# When enabled, turns that no longer fit the budget are replaced by a rolling summary (one extra, background LLM call)
+CONTEXT_SUMMARY_ENABLED = os.getenv("CONTEXT_SUMMARY_ENABLED", "false").lower() in ("1", "true", "yes")
+SUMMARY_GENERATION_PROMPT_TEMPLATE = """
+Update the summary of an ongoing conversation between a user and an assistant.
+Current summary (may be empty):
+{previous_summary}
+
+New messages to fold into the summary:
+{transcript}
+
+Respond ONLY with the updated summary, at most 120 words.
+"""
+MAX_SUMMARY_GENERATION_TOKENS = 200
+# Titles are generated in the background; new chats show this until the real title is saved
+PROVISIONAL_CHAT_TITLE = "New Chat"
+TITLE_GENERATION_WORKERS = int(os.getenv("TITLE_GENERATION_WORKERS", "4"))
+TITLE_WAIT_SECONDS = 5 # How long a finished stream stays open for a still-running title job
+# Threads for fan-out calls (one per provider per fan-out request; see fan_out.py)
+FAN_OUT_WORKERS = int(os.getenv("FAN_OUT_WORKERS", "16"))
+COALESCED_WAIT_SECONDS = 120 # How long a duplicate submission waits for the original turn (see request_coalescing.py)
+# Page sizes for the sidebar (GET /chats) and for history (GET /chat_history); the page itself renders only the first page
+CHAT_LIST_PAGE_SIZE = 30
+HISTORY_PAGE_SIZE = 50
+SEARCH_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 200
+# Bulk export/import of a user's chats as JSONL (GET /export, POST /import)
+EXPORT_PAGE_SIZE = 100 # Chats listed per store query; histories are still read one chat at a time
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "200")) # Chats per ChatStore.import_chats() call
+IMPORT_READ_SIZE = 64 * 1024
+IMPORT_MAX_LINE_BYTES = int(os.getenv("IMPORT_MAX_LINE_BYTES", str(16 * 1024 * 1024))) # One chat per line
+MAX_IMPORT_ERRORS_REPORTED = 20
+
+# --- Providers ---
+
+def get_api_key(session_data, provider):
+    """ Returns the user's API key for provider from the session (None if missing or the provider needs none). """
+    return session_data.get(provider.api_key_field) if provider and provider.api_key_field else None
+
 
 # --- MODIFIED Helper Function for Title Generation ---
-def generate_chat_title(user_message, model_choice, openai_api_key, google_api_key):
+def generate_chat_title(user_message, model_choice, api_key):
     """Generates a title for a chat using the API key for the selected model."""
     fallback_title = "Chat " + time.strftime("%H:%M") # Default fallback
 
     prompt_content = TITLE_GENERATION_PROMPT_TEMPLATE.format(user_message=user_message[:200]) # Limit prompt length
 
     try:
-        if model_choice == 'gemini':
-            if not google_api_key:
-                logging.warning("Cannot generate title with Gemini: Google API Key not found in session.")
-                return fallback_title + " (Key Missing)"
-            logging.info(f"Generating title with Gemini ({TITLE_GENERATION_MODEL_GEMINI})...")
-            genai.configure(api_key=google_api_key)
-            model = genai.GenerativeModel(TITLE_GENERATION_MODEL_GEMINI)
-            # Simple prompt, no history needed for title
-            response = model.generate_content(prompt_content)
-            title = response.text.strip().replace('"', '')
-
-        elif model_choice == 'gpt':
-            if not openai_api_key:
-                logging.warning("Cannot generate title with GPT: OpenAI API Key not found in session.")
-                return fallback_title + " (Key Missing)"
-            logging.info(f"Generating title with OpenAI ({TITLE_GENERATION_MODEL_GPT})...")
-            client = OpenAI(api_key=openai_api_key, max_retries=1) # Reduce retries for title to fail faster on rate limit
-            response = client.chat.completions.create(
-                model=TITLE_GENERATION_MODEL_GPT,
-                messages=[{"role": "user", "content": prompt_content}],
-                temperature=0.3,
-                max_tokens=MAX_TITLE_GENERATION_TOKENS,
-                n=1,
-                stop=None,
-            )
-            title = response.choices[0].message.content.strip().replace('"', '')
-
-        else:
+        provider = get_provider(model_choice)
+        if provider is None:
             logging.warning(f"Cannot generate title: Invalid model_choice '{model_choice}'.")
             return fallback_title + " (Model Invalid)"
+        if provider.requires_api_key and not api_key:
+            logging.warning(f"Cannot generate title with {model_choice}: {provider.display_name} API Key not found in session.")
+            return fallback_title + " (Key Missing)"
+
+        # Simple prompt, no history needed for title
+        title_messages = [{"role": "user", "content": prompt_content}]
+        title_request = dict(model=provider.title_model, temperature=TITLE_GENERATION_TEMPERATURE, max_tokens=MAX_TITLE_GENERATION_TOKENS)
+        cache_key = provider.cache_key(title_messages, **title_request) if response_cache else None
+        title = response_cache.get(cache_key) if cache_key else None
+        if title is None:
+            logging.info(f"Generating title with {provider.display_name} ({provider.title_model})...")
+            title = provider.complete(api_key, title_messages, **title_request).replace('"', '')
+            if cache_key:
+                response_cache.set(cache_key, title)
 
         logging.info(f"Generated title: '{title}' using {model_choice}")
         # Basic validation: If title is empty or very short/generic, use fallback
@@ -92,26 +156,32 @@ def generate_chat_title(user_message, model_choice, openai_api_key, google_api_k
 
     # --- Specific Error Handling ---
     # OpenAI
-    except AuthenticationError as e:
+    except openai_errors('AuthenticationError') as e:
         logging.error(f"OpenAI Authentication failed during title generation: {e}")
         return fallback_title + " (Auth Error)"
-    except RateLimitError as e:
+    except openai_errors('RateLimitError') as e:
          logging.warning(f"OpenAI Rate limit hit during title generation: {e}")
          return fallback_title + " (Rate Limit)"
-    except BadRequestError as e:
+    except RateLimitQueueTimeout as e:
+         logging.warning(f"Rate limiter rejected title generation: {e}")
+         return fallback_title + " (Rate Limit)"
+    except CircuitOpenError as e:
+         logging.warning(f"Skipped title generation: {e}")
+         return fallback_title + " (Unavailable)"
+    except openai_errors('BadRequestError') as e:
          logging.error(f"OpenAI BadRequestError during title generation: {e}")
          return fallback_title + " (Request Error)"
-    except OpenAIError as e:
+    except openai_errors('OpenAIError') as e:
         logging.error(f"OpenAI API Error during title generation: {e}")
         return fallback_title + " (API Error)"
     # Google / Gemini
-    except (google.api_core.exceptions.PermissionDenied, google.api_core.exceptions.InvalidArgument) as e:
+    except google_errors('PermissionDenied', 'InvalidArgument') as e:
         logging.error(f"Google API Auth/Argument Error during title generation: {e}", exc_info=False)
         return fallback_title + " (Auth Error)"
-    except google.api_core.exceptions.ResourceExhausted as e:
+    except google_errors('ResourceExhausted') as e:
         logging.error(f"Google API Quota Exceeded during title generation: {e}", exc_info=False)
         return fallback_title + " (Rate Limit)"
-    except google.api_core.exceptions.GoogleAPIError as e:
+    except google_errors('GoogleAPIError') as e:
         logging.error(f"Google API Error during title generation: {e}", exc_info=True)
         return fallback_title + " (API Error)"
     # General
@@ -120,49 +190,150 @@ def generate_chat_title(user_message, model_choice, openai_api_key, google_api_k
         return fallback_title + " (Error)"
 
 
-# --- Routes (Index, New Chat, Load Chat, Update Title, Delete Chat, Save API Keys remain unchanged) ---
+# --- Chat Store Helpers ---
+
+def get_user_id():
+    """ Returns the small per-browser id (kept in the session cookie) that keys this user's chats in the store. """
+    if 'sid' not in session:
+        session['sid'] = secrets.token_urlsafe(16)
+    return session['sid']
+
+
+def ensure_system_message(history):
+    """ Returns (history, corrected) where history is a list starting with the system message. """
+    if not isinstance(history, list): # Ensure history is a list
+        history = []
+    if not history or history[0].get('role') != 'system':
+        # A new list: the store then rewrites the history instead of appending to it (see chat_store.StoredHistory)
+        return [DEFAULT_SYSTEM_MESSAGE] + history, True
+    return history, False
+
+
+def migrate_legacy_chats(session_data, user_id):
+    """ Moves chats left in the cookie by older versions of the app into the chat store (one-time per browser). """
+    legacy_chats = session_data.get('chats')
+    if legacy_chats is None:
+        return
+    for chat_id, chat_data in legacy_chats.items():
+        if chat_store.get_chat(user_id, chat_id) is None:
+            history, _ = ensure_system_message(chat_data.get('history', []))
+            chat_store.create_chat(user_id, chat_id, chat_data.get('title', 'Chat'), history)
+    session_data.pop('chats')
+    logging.info(f"Migrated {len(legacy_chats)} cookie-stored chats to the chat store.")
+
+
+@app.before_request
+def migrate_cookie_chats():
+    """ Runs migrate_legacy_chats() before every Flask request; asgi.py does the same for the chat paths it serves. """
+    if 'chats' in session:
+        migrate_legacy_chats(session, get_user_id())
+
+
+# --- Pagination Helpers ---
+
+def encode_chat_cursor(chat):
+    """ Opaque cursor pointing just past chat in the newest-first chat list. """
+    return f"{chat['created_at']!r}:{chat['id']}"
+
+
+def decode_chat_cursor(cursor):
+    """ Returns the (created_at, chat_id) pair for ChatStore.list_chats(before=...); raises ValueError if malformed. """
+    created_at, _, chat_id = cursor.partition(':')
+    if not chat_id:
+        raise ValueError(f"Invalid chat cursor: '{cursor}'")
+    return float(created_at), chat_id
+
+
+def list_chats_page(user_id, before=None, limit=CHAT_LIST_PAGE_SIZE):
+    """ Returns (chats, next_cursor); next_cursor is None on the last page. """
+    chats = chat_store.list_chats(user_id, limit=limit + 1, before=before) # One extra to detect a further page
+    if len(chats) <= limit:
+        return chats, None
+    return chats[:limit], encode_chat_cursor(chats[limit - 1])
+
+
+def history_page(history, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Returns (messages, start): the up-to-limit messages preceding index before (default: the end)
+    and the index of the first one. start > 0 means older messages remain.
+    """
+    end = len(history) if before is None else max(0, min(before, len(history)))
+    start = max(0, end - limit)
+    return history[start:end], start
+
+
+def page_size_arg(default):
+    """ The ?limit= query argument, clamped to 1..MAX_PAGE_SIZE. """
+    return max(1, min(request.args.get('limit', default, type=int), MAX_PAGE_SIZE))
+
+
+# --- Background Title Generation ---
+title_executor = ThreadPoolExecutor(max_workers=TITLE_GENERATION_WORKERS, thread_name_prefix="title-gen")
+
+def generate_and_store_title(user_id, chat_id, user_message, model_choice, api_key):
+    """ Background job: generates the title and saves it unless the chat was renamed or deleted meanwhile. """
+    provider = get_provider(model_choice)
+    with time_stage('title_generation', provider.name, provider.title_model):
+        title = generate_chat_title(user_message, model_choice, api_key)
+    if not chat_store.update_title(user_id, chat_id, title, expected_title=PROVISIONAL_CHAT_TITLE):
+        logging.info(f"Discarding generated title for chat {chat_id}: chat was renamed or deleted.")
+        return None
+    logging.info(f"Saved generated title for chat {chat_id}: '{title}'")
+    return title
+
+
+def wait_for_title(title_future, new_chat_info, timeout=TITLE_WAIT_SECONDS):
+    """ Fills new_chat_info with the generated title if the job finishes within timeout. Returns True if it did. """
+    try:
+        title = title_future.result(timeout=timeout)
+    except FutureTimeoutError:
+        logging.info(f"Title for chat {new_chat_info['id']} still pending after {timeout}s.")
+        return False
+    except Exception as e:
+        logging.error(f"Background title generation failed for chat {new_chat_info['id']}: {e}", exc_info=True)
+        new_chat_info['title_pending'] = False
+        return False
+    new_chat_info['title_pending'] = False
+    if title:
+        new_chat_info['title'] = title
+    return True
+
+
+# --- Routes (Index, New Chat, Chat List, Load Chat, History, Update Title, Delete Chat, Save API Keys, Metrics) ---
 
 @app.route('/')
 def index():
     """ Renders the main chat page, loading existing chat history for the sidebar. """
+    user_id = get_user_id()
     # Initialize session structure if first visit
-    if 'chats' not in session:
-        session['chats'] = {}
     if 'current_chat_id' not in session:
         session['current_chat_id'] = None
 
-    openai_key_present = session.get('openai_api_key') is not None
-    google_key_present = session.get('google_api_key') is not None
-    logging.info(f"Loading index. Current chat ID: {session.get('current_chat_id')}. Total chats: {len(session.get('chats', {}))}")
-    logging.info(f"API Keys on page load: OpenAI Present = {openai_key_present}, Google Present = {google_key_present}")
-
-    chats_list = sorted(
-        [chat for chat in session['chats'].values() if 'id' in chat],
-        key=lambda x: x.get('id', '0'),
-        reverse=True
-    )
+    # Only the newest chats are rendered; script.js pages in the rest from /chats as the sidebar scrolls
+    chats_list, next_chat_cursor = list_chats_page(user_id)
+    logging.debug(f"Loading index. Current chat ID: {session.get('current_chat_id')}. Chats rendered: {len(chats_list)}")
 
     current_chat_history = []
+    history_start = 0
     current_title = "New Chat"
     current_chat_id = session.get('current_chat_id')
+    current_chat = chat_store.get_chat(user_id, current_chat_id) if current_chat_id else None
 
-    if current_chat_id and current_chat_id in session['chats']:
-        current_chat = session['chats'][current_chat_id]
-        current_chat_history = current_chat.get('history', [])
-        if not isinstance(current_chat_history, list):
-            current_chat_history = []
-        if not current_chat_history or current_chat_history[0].get('role') != 'system':
-             current_chat_history.insert(0, DEFAULT_SYSTEM_MESSAGE)
-             session['chats'][current_chat_id]['history'] = current_chat_history # Fix if missing
-             session.modified = True
+    if current_chat:
+        current_chat_history, corrected = ensure_system_message(current_chat.get('history', []))
+        if corrected:
+             chat_store.save_history(user_id, current_chat_id, current_chat_history) # Fix if missing
              logging.warning(f"Corrected missing/invalid system message for chat {current_chat_id} on index load")
+        current_chat_history, history_start = history_page(current_chat_history)
         current_title = current_chat.get('title', 'Chat')
+        if not any(chat['id'] == current_chat_id for chat in chats_list):
+            # An older chat is active: show it at the top so the sidebar has it selected
+            chats_list.insert(0, {'id': current_chat_id, 'title': current_title})
     else:
          current_chat_id = None
          if session.get('current_chat_id') is not None:
              logging.info(f"Invalid current_chat_id '{session.get('current_chat_id')}' found, resetting to None.")
              session['current_chat_id'] = None # Explicitly set to None if invalid ID was found
-             session.modified = True
          current_chat_history = [DEFAULT_SYSTEM_MESSAGE] # Default history for new chat view
          current_title = "New Chat"
 
@@ -170,62 +341,93 @@ def index():
     return render_template(
         'index.html',
         chats=chats_list,
+        next_chat_cursor=next_chat_cursor,
         current_chat_id=current_chat_id,
         current_chat_history=current_chat_history,
-        current_title=current_title
+        history_start=history_start,
+        current_title=current_title,
+        model_catalog=describe_catalog()
     )
 
 @app.route('/new_chat', methods=['POST'])
 def new_chat():
     """ Sets the application state to start a new chat. Does NOT clear API keys. """
-    openai_key_present_before = session.get('openai_api_key') is not None
-    google_key_present_before = session.get('google_api_key') is not None
-    logging.info(f"Executing /new_chat. Current chat ID was: {session.get('current_chat_id')}")
-    logging.info(f"API Keys BEFORE setting current_chat_id=None: OpenAI Present={openai_key_present_before}, Google Present={google_key_present_before}")
-
+    logging.debug(f"Executing /new_chat. Current chat ID was: {session.get('current_chat_id')}")
     session['current_chat_id'] = None
-    session.modified = True # Good practice when changing session
-
-    openai_key_present_after = session.get('openai_api_key') is not None
-    google_key_present_after = session.get('google_api_key') is not None
-    logging.info(f"Finished /new_chat. Current chat ID is now: {session.get('current_chat_id')}")
-    logging.info(f"API Keys AFTER setting current_chat_id=None: OpenAI Present={openai_key_present_after}, Google Present={google_key_present_after}")
 
     return jsonify({"message": "New chat session initiated."}), 200
 
+@app.route('/chats', methods=['GET'])
+def list_chats():
+    """ One page of the sidebar, newest first. Pass the returned next_cursor as ?before= for the next page. """
+    before = request.args.get('before')
+    try:
+        before = decode_chat_cursor(before) if before else None
+    except ValueError:
+        return jsonify({"error": "Invalid cursor."}), 400
+    chats, next_cursor = list_chats_page(get_user_id(), before, page_size_arg(CHAT_LIST_PAGE_SIZE))
+    return jsonify({
+        "chats": [{"id": chat['id'], "title": chat['title']} for chat in chats],
+        "next_cursor": next_cursor,
+    }), 200
+
+@app.route('/search', methods=['GET'])
+def search():
+    """ The user's chats matching every word of ?q= (the last word as a prefix), best first, with a highlighted snippet each. """
+    if chat_store.search_index is None:
+        return jsonify({"error": "Search is disabled."}), 404
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "Search query cannot be empty."}), 400
+    try:
+        results = chat_store.search_index.search(get_user_id(), query, page_size_arg(SEARCH_PAGE_SIZE))
+    except Exception as e:
+        logging.error(f"Error searching chats for '{query}': {e}", exc_info=True)
+        return jsonify({"error": "Search failed on server."}), 500
+    return jsonify({"query": query, "results": results}), 200
+
 @app.route('/load_chat/<chat_id>', methods=['GET'])
 def load_chat(chat_id):
-    """ Loads the history and title of a specific chat into the session and returns it. """
-    if 'chats' not in session or chat_id not in session['chats']:
+    """
+    Loads the title and the newest page of history of a specific chat and makes it the current chat.
+    history_start is the index of the first returned message; older ones come from /chat_history.
+    """
+    user_id = get_user_id()
+    chat_data = chat_store.get_chat(user_id, chat_id)
+    if chat_data is None:
         logging.warning(f"Attempted to load non-existent chat ID: {chat_id}")
         return jsonify({"error": "Chat not found."}), 404
 
-    session['current_chat_id'] = chat_id
-    chat_data = session['chats'][chat_id]
+    if session.get('current_chat_id') != chat_id:
+        session['current_chat_id'] = chat_id
 
-    history = chat_data.get('history', [])
-    if not isinstance(history, list): # Ensure history is a list
-        history = []
-    if not history or history[0].get('role') != 'system':
-         history.insert(0, DEFAULT_SYSTEM_MESSAGE)
-         chat_data['history'] = history # Update the data to be sent back
-         session['chats'][chat_id]['history'] = history # Update in session too
-         session.modified = True # Mark session as modified because we fixed history
+    history, corrected = ensure_system_message(chat_data.get('history', []))
+    if corrected:
+         chat_store.save_history(user_id, chat_id, history) # Persist the fixed history
          logging.warning(f"Corrected missing/invalid system message for chat {chat_id}")
 
     logging.info(f"Loading chat ID: {chat_id}, Title: {chat_data.get('title')}")
+    messages, start = history_page(history, limit=page_size_arg(HISTORY_PAGE_SIZE))
     return jsonify({
         "id": chat_id,
         "title": chat_data.get('title', 'Chat'),
-        "history": history # Send corrected history
+        "history": messages, # Newest page of the corrected history
+        "history_start": start,
     }), 200
 
+@app.route('/chat_history/<chat_id>', methods=['GET'])
+def chat_history(chat_id):
+    """ Returns the messages before index ?before= (default: the end), newest page first, for scroll-back. """
+    chat_data = chat_store.get_chat(get_user_id(), chat_id)
+    if chat_data is None:
+        return jsonify({"error": "Chat not found."}), 404
+    history, _ = ensure_system_message(chat_data.get('history', []))
+    messages, start = history_page(history, request.args.get('before', type=int), page_size_arg(HISTORY_PAGE_SIZE))
+    return jsonify({"id": chat_id, "messages": messages, "start": start, "has_more": start > 0}), 200
+
 @app.route('/update_title/<chat_id>', methods=['POST'])
 def update_title(chat_id):
     """ Updates the title of a specific chat. """
-    if 'chats' not in session or chat_id not in session['chats']:
-        return jsonify({"error": "Chat not found"}), 404
-
     data = request.json
     new_title = data.get('new_title', '').strip()
     MAX_TITLE_LENGTH = 100 # Consistent with JS
@@ -236,41 +438,196 @@ def update_title(chat_id):
          return jsonify({"error": f"Title cannot exceed {MAX_TITLE_LENGTH} characters."}), 400
 
     try:
-        session['chats'][chat_id]['title'] = new_title
-        session.modified = True
+        if not chat_store.update_title(get_user_id(), chat_id, new_title):
+            return jsonify({"error": "Chat not found"}), 404
         logging.info(f"Updated title for chat {chat_id} to '{new_title}'")
         return jsonify({"message": "Title updated successfully.", "new_title": new_title}), 200
     except Exception as e:
         logging.error(f"Error updating title for chat {chat_id}: {e}", exc_info=True)
         return jsonify({"error": "Failed to update title on server."}), 500
 
+@app.route('/chat_title/<chat_id>', methods=['GET'])
+def chat_title(chat_id):
+    """ Returns the current title of a chat; 'pending' is true while its background title job is still running. """
+    chat_data = chat_store.get_chat(get_user_id(), chat_id)
+    if chat_data is None:
+        return jsonify({"error": "Chat not found."}), 404
+    title = chat_data.get('title', 'Chat')
+    return jsonify({"id": chat_id, "title": title, "pending": title == PROVISIONAL_CHAT_TITLE}), 200
+
 @app.route('/delete_chat/<chat_id>', methods=['DELETE'])
 def delete_chat(chat_id):
-    """ Deletes a specific chat from the session. """
+    """ Deletes a specific chat from the chat store. """
     logging.info(f"Attempting to delete chat ID: {chat_id}")
-    if 'chats' not in session or chat_id not in session['chats']:
-        logging.warning(f"Delete failed: Chat ID {chat_id} not found in session.")
-        return jsonify({"error": "Chat not found."}), 404
-
     try:
-        deleted_chat_title = session['chats'][chat_id].get('title', 'Unknown Chat')
-        del session['chats'][chat_id] # Remove the chat data
+        if not chat_store.delete_chat(get_user_id(), chat_id):
+            logging.warning(f"Delete failed: Chat ID {chat_id} not found in chat store.")
+            return jsonify({"error": "Chat not found."}), 404
 
         if session.get('current_chat_id') == chat_id:
             session['current_chat_id'] = None
             logging.info(f"Deleted chat {chat_id} was the active chat. Resetting current_chat_id.")
 
-        session.modified = True # IMPORTANT: Ensure session changes are saved
-        logging.info(f"Successfully deleted chat ID: {chat_id} (Title: '{deleted_chat_title}')")
+        logging.info(f"Successfully deleted chat ID: {chat_id}")
         return jsonify({"message": "Chat deleted successfully."}), 200
 
-    except KeyError:
-        logging.warning(f"Delete failed: Chat ID {chat_id} caused KeyError during deletion (might indicate race condition or session issue).")
-        return jsonify({"error": "Chat not found during deletion."}), 404
     except Exception as e:
         logging.error(f"Error deleting chat ID {chat_id}: {e}", exc_info=True)
         return jsonify({"error": "An internal server error occurred while deleting the chat."}), 500
 
+# --- Export / Import ---
+
+def export_lines(user_id):
+    """ Yields the user's chats newest first, one JSON line each; holds a single history in memory at a time. """
+    before = None
+    while True:
+        chats = chat_store.list_chats(user_id, limit=EXPORT_PAGE_SIZE, before=before)
+        for summary in chats:
+            chat_data = chat_store.get_chat(user_id, summary['id'])
+            if chat_data is None: # Deleted since the page was listed
+                continue
+            history, _ = ensure_system_message(chat_data.get('history', []))
+            record = {'id': summary['id'], 'title': chat_data['title'], 'created_at': chat_data['created_at'], 'history': history}
+            yield (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+        if len(chats) < EXPORT_PAGE_SIZE:
+            return
+        before = (chats[-1]['created_at'], chats[-1]['id'])
+
+
+def gzip_chunks(chunks):
+    """ Gzip-compresses a stream of byte chunks incrementally. """
+    compressor = zlib.compressobj(wbits=31) # 31: gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def validate_import_record(record):
+    """
+    Returns the chat to store for one parsed JSONL record, with the same fixups load_chat applies
+    (a missing or invalid system message is added). Raises ValueError if the record can't be a chat.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("Expected a JSON object")
+    history = record.get('history', [])
+    if not isinstance(history, list):
+        history = [] # As load_chat treats it
+    for index, message in enumerate(history):
+        if not isinstance(message, dict) or message.get('role') not in ('system', 'user', 'assistant') \
+                or not isinstance(message.get('content'), str):
+            raise ValueError(f"Invalid message at history[{index}]")
+    history, _ = ensure_system_message(history)
+    title = record.get('title')
+    title = title.strip() if isinstance(title, str) and title.strip() else 'Chat'
+    chat_id = record.get('id')
+    if not isinstance(chat_id, str) or not chat_id or len(chat_id) > 64:
+        # Derived from the content, so importing the same file again still skips this chat
+        chat_id = str(uuid.uuid5(uuid.NAMESPACE_OID, json.dumps([title, history], sort_keys=True)))
+    created_at = record.get('created_at')
+    if not isinstance(created_at, (int, float)) or isinstance(created_at, bool) or created_at <= 0:
+        created_at = time.time()
+    return {'id': chat_id, 'title': title, 'history': history, 'created_at': float(created_at)}
+
+
+def import_request_lines(stream, gzipped):
+    """
+    Yields (line_number, line bytes) of the non-blank lines of the request body, reading it in chunks
+    (readline() on the WSGI input stream reads byte by byte). Raises ValueError for an oversized line.
+    """
+    if gzipped:
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    line_number = 0
+    pending, pending_size = [], 0 # Start of a line that continues in the next chunk
+    while True:
+        chunk = stream.read(IMPORT_READ_SIZE)
+        if not chunk:
+            break
+        pieces = chunk.split(b"\n")
+        for piece in pieces[:-1]:
+            line = b"".join(pending + [piece]) if pending else piece
+            pending, pending_size = [], 0
+            line_number += 1
+            if len(line) > IMPORT_MAX_LINE_BYTES:
+                raise ValueError(f"Line {line_number} exceeds {IMPORT_MAX_LINE_BYTES} bytes")
+            if line.strip():
+                yield line_number, line
+        if pieces[-1]:
+            pending.append(pieces[-1])
+            pending_size += len(pieces[-1])
+            if pending_size > IMPORT_MAX_LINE_BYTES:
+                raise ValueError(f"Line {line_number + 1} exceeds {IMPORT_MAX_LINE_BYTES} bytes")
+    line = b"".join(pending) # Last line without a trailing newline
+    if line.strip():
+        yield line_number + 1, line
+
+
+@app.route('/export', methods=['GET'])
+def export_chats():
+    """ Streams all of the user's chats as JSONL (?gzip=1 for a .jsonl.gz). The inverse of /import. """
+    user_id = get_user_id() # Read now: the generator runs after the request context is gone
+    gzipped = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    filename = "chats.jsonl.gz" if gzipped else "chats.jsonl"
+    logging.info(f"Exporting chats for user {user_id} (gzip={gzipped})")
+    body = gzip_chunks(export_lines(user_id)) if gzipped else export_lines(user_id)
+    return Response(
+        body,
+        mimetype='application/gzip' if gzipped else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.route('/import', methods=['POST'])
+def import_chats():
+    """
+    Imports chats from a JSONL body in the /export format, gzip-compressed if sent with
+    'Content-Encoding: gzip' or as application/gzip. Chats are stored in batches as they are read.
+    Chats whose id already exists are skipped, so importing the same file twice is harmless.
+    Invalid lines are counted and reported (the first few with their line numbers); the rest still import.
+    """
+    user_id = get_user_id()
+    gzipped = request.headers.get('Content-Encoding', '').lower() == 'gzip' or request.mimetype == 'application/gzip'
+    imported = skipped = invalid = 0
+    errors = []
+    seen_ids = set()
+    batch = []
+
+    def flush():
+        nonlocal imported, skipped
+        created = chat_store.import_chats(user_id, batch)
+        imported += len(created)
+        skipped += len(batch) - len(created)
+        batch.clear()
+
+    try:
+        for line_number, line in import_request_lines(request.stream, gzipped):
+            try:
+                chat = validate_import_record(json.loads(line))
+            except ValueError as e: # json.JSONDecodeError and UnicodeDecodeError included
+                invalid += 1
+                if len(errors) < MAX_IMPORT_ERRORS_REPORTED:
+                    errors.append({'line': line_number, 'error': str(e)})
+                continue
+            if chat['id'] in seen_ids: # Repeated within the file: the first one wins
+                skipped += 1
+                continue
+            seen_ids.add(chat['id'])
+            batch.append(chat)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush()
+        flush()
+    except (ValueError, OSError, EOFError) as e: # Oversized line, corrupt or truncated gzip
+        logging.warning(f"Import for user {user_id} aborted after {imported} chats: {e}")
+        return jsonify({"error": f"Import aborted: {e}", "imported": imported, "skipped": skipped, "invalid": invalid, "errors": errors}), 400
+    except Exception as e:
+        logging.error(f"Error importing chats for user {user_id}: {e}", exc_info=True)
+        return jsonify({"error": "Failed to import chats on server.", "imported": imported}), 500
+
+    logging.info(f"Imported {imported} chats for user {user_id} ({skipped} skipped, {invalid} invalid)")
+    return jsonify({"imported": imported, "skipped": skipped, "invalid": invalid, "errors": errors}), 200
+
+
 @app.route('/save_api_keys', methods=['POST'])
 def save_api_keys():
     """ Saves API keys provided by the user into the session. """
@@ -311,250 +668,652 @@ def save_api_keys():
         return jsonify({"error": "Failed to save API keys."}), 500
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """ Prometheus text exposition of this worker's metrics (stage timings, upstream errors, cache hits, circuit breakers). """
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/models', methods=['GET'])
+def models():
+    """ The model catalog: the model_choice values /chat accepts, with the limits and prices applied to each. """
+    return jsonify(describe_catalog()), 200
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """ Liveness plus each provider's circuit breaker state; 'degraded' while any breaker is not closed. """
+    breakers = {choice: get_circuit_breaker(provider.name).snapshot() for choice, provider in list_providers().items()}
+    status = 'ok' if all(breaker['state'] == CLOSED for breaker in breakers.values()) else 'degraded'
+    return jsonify({'status': status, 'providers': breakers}), 200
+
+
+# --- Helpers shared by /chat and /chat/stream ---
+
+def describe_chat_error(e, provider, chat_id):
+    """ Maps an exception raised by a provider call to (bot_response_content, status_code, is_api_error). """
+    # Client-side scheduler (rate_limiter.py)
+    if isinstance(e, RateLimitQueueTimeout):
+        logging.warning(f"Request for chat {chat_id} rejected by rate limiter: {e}")
+        return "ERROR: Too many requests for this API key right now. Please try again shortly.", 429, False
+    # Provider marked as failing (circuit_breaker.py) and no fallback was available
+    if isinstance(e, CircuitOpenError):
+        logging.warning(f"Request for chat {chat_id} failed fast: {e}")
+        return f"ERROR: {provider.display_name} is currently unavailable. Please try again shortly or switch models.", 503, False
+    # Blocked or empty reply; shown to the user like a normal reply (HTTP 200)
+    if isinstance(e, ProviderResponseError):
+        return str(e), 200, False
+    return provider.describe_error(e, chat_id)
+
+
+def route_around_open_circuit(session_data, model_choice):
+    """
+    Returns the model_choice to serve this turn with: model_choice itself, or its catalog fallback
+    while model_choice's circuit breaker rejects calls and the fallback's does not (and the user has a
+    key for it). A half-open breaker keeps traffic until its probe is in flight, so the probe can go through.
+    """
+    if not get_circuit_breaker(get_provider(model_choice).name).rejecting:
+        return model_choice
+    fallback_choice = fallback_model_choice(model_choice)
+    fallback = get_provider(fallback_choice)
+    if fallback is None or get_circuit_breaker(fallback.name).rejecting:
+        return model_choice
+    if fallback.requires_api_key and not get_api_key(session_data, fallback):
+        return model_choice
+    logging.warning(f"{get_provider(model_choice).display_name} circuit is rejecting calls; serving this turn with {fallback.display_name}")
+    return fallback_choice
+
+
+def missing_key_error(provider, chat_id):
+    """ Returns the (bot_response_content, status_code) pair used when the selected model has no API key. """
+    error_message = f"{provider.display_name} API Key not set. Please add it via 'API Keys'."
+    logging.warning(f"{error_message} (Chat ID: {chat_id})")
+    return f"ERROR: {error_message}", 400 # Bad Request (client-side issue - missing key)
+
+
+def prepare_chat_turn(session_data, user_id, user_message_content, model_choice, api_key):
+    """
+    Resolves the active chat (creating it if needed) and appends the user message.
+    A new chat is saved immediately under a provisional title while its real title is generated in the background.
+    Returns (chat_id, chat_history, new_chat_info, title_future); the first three are None if the session's
+    current chat is invalid, and title_future is None unless a chat was created.
+    The updated history is only persisted by record_chat_result() once the turn completes.
+    session_data is the Flask session (or the decoded cookie dict on the ASGI path, see asgi.py).
+    """
+    current_chat_id = session_data.get('current_chat_id')
+    new_chat_info = None
+    title_future = None
+    provider = get_provider(model_choice)
+
+    if current_chat_id is None:
+        # --- Create a new chat ---
+        current_chat_id = str(uuid.uuid4())
+        session_data['current_chat_id'] = current_chat_id
+        initial_history = [DEFAULT_SYSTEM_MESSAGE] # Start with system message
+
+        with time_stage('session_load', provider.name, provider.chat_model):
+            chat_store.create_chat(user_id, current_chat_id, PROVISIONAL_CHAT_TITLE, initial_history)
+        logging.info(f"Created new chat with ID: {current_chat_id}, generating title in background")
+        # Prepare info for frontend; the real title follows once the background job finishes
+        new_chat_info = {'id': current_chat_id, 'title': PROVISIONAL_CHAT_TITLE, 'title_pending': True}
+
+        # --- Generate title using the appropriate key based on model_choice, concurrently with the reply ---
+        title_future = title_executor.submit(
+            generate_and_store_title,
+            user_id,
+            current_chat_id,
+            user_message_content,
+            model_choice, # Pass the selected model
+            api_key
+        )
+        current_chat_history = list(initial_history) # Use the newly created history
+    else:
+        # --- Load existing chat ---
+        with time_stage('session_load', provider.name, provider.chat_model):
+            current_chat = chat_store.get_chat(user_id, current_chat_id)
+        if current_chat is None:
+             logging.error(f"Current chat ID {current_chat_id} not found in chat store. Resetting.")
+             session_data['current_chat_id'] = None
+             return None, None, None, None
+
+        with time_stage('history_normalization', provider.name, provider.chat_model):
+            current_chat_history, corrected = ensure_system_message(current_chat.get('history', []))
+        if corrected:
+             logging.warning(f"Corrected missing/invalid system message for chat {current_chat_id} during chat request")
+
+    # --- Append user message ---
+    current_chat_history.append({"role": "user", "content": user_message_content})
+    return current_chat_id, current_chat_history, new_chat_info, title_future
+
+
+def record_chat_result(user_id, chat_id, chat_history, bot_response_content, error_occurred, is_api_error, provider):
+    """ Appends the bot response (or rolls back the user message on non-API errors) and saves the history. """
+    if not error_occurred and bot_response_content:
+         chat_history.append({"role": "assistant", "content": bot_response_content})
+    elif error_occurred:
+         logging.error(f"Error response generated for chat {chat_id}: {bot_response_content}")
+         if not is_api_error and chat_history and chat_history[-1]['role'] == 'user':
+              logging.warning(f"Removing last user message from history for chat {chat_id} due to non-API error.")
+              chat_history.pop()
+
+    with time_stage('session_serialization', provider.name, provider.chat_model):
+        saved = chat_store.save_history(user_id, chat_id, chat_history)
+    if not saved:
+        logging.warning(f"Chat {chat_id} was deleted before its history could be saved.")
+
+
+# --- Context Window (token budget + optional rolling summary) ---
+summaries_in_progress = set() # (user_id, chat_id) pairs with a summary job running in this process
+summaries_lock = threading.Lock()
+
+def generate_context_summary(previous_summary, messages, model_choice, api_key):
+    """ Folds messages into previous_summary using the provider's title-generation model. Returns None on failure. """
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    prompt_content = SUMMARY_GENERATION_PROMPT_TEMPLATE.format(previous_summary=previous_summary or "", transcript=transcript)
+    provider = get_provider(model_choice)
+    if provider is None or (provider.requires_api_key and not api_key):
+        return None
+    try:
+        return provider.complete(
+            api_key, [{"role": "user", "content": prompt_content}], model=provider.title_model,
+            temperature=TITLE_GENERATION_TEMPERATURE, max_tokens=MAX_SUMMARY_GENERATION_TOKENS
+        )
+    except Exception as e:
+        logging.warning(f"Context summary generation failed using {model_choice}: {e}")
+    return None
+
+
+def update_rolling_summary(user_id, chat_id, previous, dropped_messages, model_choice, api_key):
+    """ Background job: extends the stored summary to cover every message dropped from the context so far. """
+    try:
+        covered = previous['covered'] if previous else 0
+        summary_text = generate_context_summary(
+            previous['text'] if previous else "", dropped_messages[covered:], model_choice, api_key
+        )
+        if summary_text:
+            chat_store.save_summary(user_id, chat_id, {'text': summary_text, 'covered': len(dropped_messages)})
+            logging.info(f"Updated rolling summary for chat {chat_id} ({len(dropped_messages)} messages covered)")
+    finally:
+        with summaries_lock:
+            summaries_in_progress.discard((user_id, chat_id))
+
+
+def build_prompt_history(user_id, chat_id, chat_history, model_choice, api_key):
+    """
+    Returns the part of chat_history to send upstream: as many recent messages as fit the model's
+    token budget, preceded (if enabled and available) by the rolling summary of the dropped turns.
+    """
+    provider = get_provider(model_choice)
+    token_budget = CONTEXT_TOKEN_BUDGETS.get(provider.chat_model, provider.context_token_budget)
+    with time_stage('history_trim', provider.name, provider.chat_model):
+        prompt_history, dropped_messages = fit_history(chat_history, provider.chat_model, token_budget)
+    if not dropped_messages:
+        return prompt_history
+
+    logging.info(f"Context for chat {chat_id}: sending {len(prompt_history)} of {len(chat_history)} messages (budget {token_budget} tokens)")
+    if not CONTEXT_SUMMARY_ENABLED:
+        return prompt_history
+
+    summary = chat_store.get_summary(user_id, chat_id)
+    if summary and summary.get('text'):
+        summary_content = f"Summary of the earlier conversation: {summary['text']}"
+        if not provider.supports_system_messages:
+            # System messages are dropped for this provider, so the summary goes in as an acknowledged user turn
+            summary_turn = [{"role": "user", "content": summary_content}, {"role": "assistant", "content": "Understood."}]
+        else:
+            summary_turn = [{"role": "system", "content": summary_content}]
+        prompt_history = prompt_history[:1] + summary_turn + prompt_history[1:]
+
+    if not summary or summary.get('covered', 0) < len(dropped_messages):
+        with summaries_lock:
+            if (user_id, chat_id) in summaries_in_progress:
+                return prompt_history
+            summaries_in_progress.add((user_id, chat_id))
+        # Ready for the next turn; this one goes out with the summary as it is now
+        title_executor.submit(
+            update_rolling_summary, user_id, chat_id, summary, dropped_messages, model_choice, api_key
+        )
+    return prompt_history
+
+
+# --- Response Cache Helpers ---
+
+def lookup_cached_reply(provider, prompt_history, api_key):
+    """
+    Returns (cache_key, cached_reply). cache_key is None when caching is disabled or the provider's
+    API key is missing (a cached answer never stands in for the key check); cached_reply is None on a miss.
+    A first turn that misses the exact cache is looked up in the semantic cache (semantic_cache.py).
+    """
+    if provider.requires_api_key and not api_key:
+        return None, None
+    exact_key = provider.cache_key(prompt_history) if response_cache is not None else None
+    cached_reply = response_cache.get(exact_key) if exact_key else None
+    if cached_reply is not None:
+        logging.info(f"Serving {provider.name} reply from response cache.")
+        return (exact_key, None), cached_reply
+
+    semantic_key = None
+    first_message = first_turn_message(prompt_history) if semantic_cache is not None else None
+    if first_message is not None:
+        # Scoped by everything but the message: provider, model, sampling settings and system prompt
+        semantic_key = semantic_cache.key(provider.cache_key(prompt_history[:-1]), first_message)
+        cached_reply = semantic_cache.get(semantic_key)
+        if cached_reply is not None:
+            logging.info(f"Serving {provider.name} reply from semantic cache.")
+
+    if exact_key is None and semantic_key is None:
+        return None, None
+    return (exact_key, semantic_key), cached_reply
+
+
+def store_cached_reply(cache_key, bot_response_content, error_occurred):
+    """ Caches a successful reply under a key returned by lookup_cached_reply(). """
+    if not cache_key or error_occurred or not bot_response_content:
+        return
+    exact_key, semantic_key = cache_key
+    if exact_key:
+        response_cache.set(exact_key, bot_response_content)
+    if semantic_key:
+        semantic_cache.set(semantic_key, bot_response_content)
+
+
+# --- Duplicate Submission Coalescing (see request_coalescing.py) ---
+chat_flights = SingleFlight()
+
+def join_chat_flight(session_data, user_id, user_message_content, model_choice, idempotency_key):
+    """ Returns (flight_key, flight, is_leader) for this submission; keyed on the chat the session points at before the turn. """
+    flight_key = coalescing_key(user_id, session_data.get('current_chat_id'), user_message_content, model_choice, idempotency_key)
+    flight, is_leader = chat_flights.join(flight_key)
+    return flight_key, flight, is_leader
+
+
+def turn_result(chat_id, bot_response_content, error_occurred, status_code, new_chat_info):
+    """ The outcome of a turn as shared with its coalesced duplicates. """
+    return {
+        'chat_id': chat_id,
+        'response': bot_response_content,
+        'is_error': error_occurred,
+        'status_code': status_code,
+        'new_chat_info': dict(new_chat_info) if new_chat_info else None,
+    }
+
+
+def wait_for_chat_flight(session_data, flight, endpoint, timeout=COALESCED_WAIT_SECONDS):
+    """
+    Blocks until the original of a duplicate submission finishes and returns its turn_result(), or None if it
+    failed or timed out. The session adopts a chat the original created, like the original's session did.
+    """
+    COALESCED_REQUESTS.inc(endpoint=endpoint)
+    logging.info(f"Duplicate submission on {endpoint}; answering it with the in-flight original")
+    result = flight.wait(timeout)
+    if result is not None and session_data.get('current_chat_id') is None:
+        session_data['current_chat_id'] = result['chat_id']
+    return result
+
+
+def coalesced_chat_response(result):
+    """ Returns the (/chat JSON body, status code) for a duplicate, mirroring the original's response. """
+    if result is None:
+        return {"error": "An identical message is still being processed or failed. Please try again.", "is_error": True}, 409
+    response_data = {"is_error": result['is_error'], 'response': result['response']}
+    if result['new_chat_info']:
+        response_data['new_chat_info'] = result['new_chat_info']
+    return response_data, result['status_code']
+
+
+def coalesced_chat_events(result):
+    """ The /chat/stream events for a duplicate: the original's whole reply as a single token. """
+    events = []
+    if result['new_chat_info']:
+        events.append(format_sse('meta', {'new_chat_info': result['new_chat_info']}))
+    if not result['is_error']:
+        events.append(format_sse('token', {'text': result['response']}))
+    events.append(format_sse('done', {'response': result['response'], 'is_error': result['is_error'], 'status_code': result['status_code']}))
+    return events
+
+
+# --- Multi-Model Fan-Out (see fan_out.py) ---
+fan_out_executor = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS, thread_name_prefix="fan-out")
+
+def parse_fan_out(data, model_choice):
+    """
+    Reads the optional 'fan_out' ('hedge' or 'compare') and 'models' fields of a /chat request.
+    Returns (mode, model_choices) with model_choice first (default: every configured provider),
+    or (None, None) for a normal single-model turn. Raises ValueError for invalid values.
+    """
+    mode = data.get('fan_out')
+    if not mode:
+        return None, None
+    if mode not in FAN_OUT_MODES:
+        raise ValueError(f"ERROR: Invalid fan_out mode. Use one of: {', '.join(FAN_OUT_MODES)}.")
+    model_choices = [model_choice] + [choice for choice in (data.get('models') or list_providers()) if choice != model_choice]
+    if any(get_provider(choice) is None for choice in model_choices):
+        raise ValueError("ERROR: Invalid model choice specified.")
+    return mode, list(dict.fromkeys(model_choices))
+
+
+def fan_out_requests(session_data, user_id, chat_id, chat_history, model_choices):
+    """ Returns (model_choice, api_key, prompt_history) per model; each model gets the history fitted to its own budget. """
+    prepared = []
+    for choice in model_choices:
+        api_key = get_api_key(session_data, get_provider(choice))
+        prepared.append((choice, api_key, build_prompt_history(user_id, chat_id, chat_history, choice, api_key)))
+    return prepared
+
+
+def fan_out_result(model_choice, bot_response_content, error_occurred, is_api_error, status_code, started):
+    return {
+        'model_choice': model_choice,
+        'response': bot_response_content,
+        'is_error': error_occurred,
+        'is_api_error': is_api_error,
+        'status_code': status_code,
+        'latency_ms': round((time.perf_counter() - started) * 1000),
+    }
+
+
+def fan_out_call(model_choice, api_key, prompt_history, chat_id):
+    """
+    Returns a fan_out.hedge()/compare() call for one model. The reply is streamed so that a
+    cancelled call stops reading (and closes the upstream response) at the next chunk.
+    """
+    provider = get_provider(model_choice)
+
+    def call(cancelled):
+        started = time.perf_counter()
+        cache_key, cached_reply = lookup_cached_reply(provider, prompt_history, api_key)
+        if cached_reply is not None:
+            return fan_out_result(model_choice, cached_reply, False, False, 200, started)
+        if provider.requires_api_key and not api_key:
+            bot_response_content, status_code = missing_key_error(provider, chat_id)
+            return fan_out_result(model_choice, bot_response_content, True, True, status_code, started)
+        parts = []
+        try:
+            stream = provider.stream(api_key, prompt_history)
+            try:
+                for text in stream:
+                    if cancelled.is_set():
+                        logging.info(f"Cancelled fan-out call to {provider.display_name} for chat {chat_id}")
+                        return None
+                    parts.append(text)
+            finally:
+                stream.close()
+        except Exception as e:
+            bot_response_content, status_code, is_api_error = describe_chat_error(e, provider, chat_id)
+            return fan_out_result(model_choice, bot_response_content, True, is_api_error, status_code, started)
+        bot_response_content = "".join(parts).strip()
+        store_cached_reply(cache_key, bot_response_content, False)
+        return fan_out_result(model_choice, bot_response_content, False, False, 200, started)
+
+    return call
+
+
+def fan_out_succeeded(result):
+    return result is not None and not result['is_error']
+
+
+def fan_out_outcome(mode, results):
+    """
+    Turns fan-out results (the hedged winner, or every compared answer) into the turn's outcome:
+    (chosen result, extra /chat response fields). The chosen result is what goes into the history:
+    the first successful answer in request order, else the first model's error.
+    """
+    chosen = next((result for result in results if fan_out_succeeded(result)), results[0])
+    response_fields = {'model_choice': chosen['model_choice']}
+    if mode == 'compare':
+        response_fields['responses'] = [
+            {key: result[key] for key in ('model_choice', 'response', 'is_error', 'latency_ms')} for result in results
+        ]
+    logging.info(f"Fan-out ({mode}) answered by {chosen['model_choice']} in {chosen['latency_ms']} ms")
+    return chosen, response_fields
+
+
+def run_fan_out(mode, session_data, user_id, chat_id, chat_history, model_choices):
+    """ Blocking fan-out for /chat. Returns (chosen result, extra response fields); see fan_out_outcome(). """
+    calls = [
+        fan_out_call(choice, api_key, prompt_history, chat_id)
+        for choice, api_key, prompt_history in fan_out_requests(session_data, user_id, chat_id, chat_history, model_choices)
+    ]
+    if mode == 'hedge':
+        return fan_out_outcome(mode, [hedge(fan_out_executor, calls, fan_out_succeeded)])
+    return fan_out_outcome(mode, compare(fan_out_executor, calls))
+
+
 # --- /chat route MODIFIED to pass model_choice to title generation ---
 @app.route('/chat', methods=['POST'])
 def chat():
-    """ Handles chat requests, manages history, generates titles using selected model's key, and routes to the AI model. """
+    """
+    Handles chat requests, manages history, generates titles using selected model's key, and routes to the AI model.
+    With 'fan_out' ('hedge' or 'compare') and optional 'models', the turn goes to several models at once (see parse_fan_out()).
+    """
+    flight = None # Set when this request leads a turn its duplicates wait on
+    result = None
     try:
         data = request.json
         logging.debug(f"Received chat request data: {data}")
 
         user_message_content = data.get('message')
-        model_choice = data.get('model_choice', 'gemini') # Default to gemini if not provided
+        model_choice = data.get('model_choice') or default_model_choice()
 
         if not user_message_content:
             logging.warning("Received empty message.")
             return jsonify({"error": "Empty message received."}), 400
-
-        if 'chats' not in session:
-             session['chats'] = {} # Initialize if missing
-
-        current_chat_id = session.get('current_chat_id')
-        is_new_chat = current_chat_id is None
-        new_chat_info = None
-
-        # --- Fetch keys needed for title generation and chat itself ---
-        openai_api_key = session.get('openai_api_key')
-        google_api_key = session.get('google_api_key')
-
-        if is_new_chat:
-            # --- Create a new chat ---
-            new_id = str(uuid.uuid4())
-            current_chat_id = new_id
-            session['current_chat_id'] = new_id
-            initial_history = [DEFAULT_SYSTEM_MESSAGE] # Start with system message
-
-            # --- Generate title using the appropriate key based on model_choice ---
-            generated_title = generate_chat_title(
-                user_message_content,
-                model_choice, # Pass the selected model
-                openai_api_key,
-                google_api_key
-            )
-            # --- End title generation change ---
-
-            session['chats'][current_chat_id] = {
-                'id': current_chat_id,
-                'title': generated_title,
-                'history': initial_history
-            }
-            logging.info(f"Created new chat with ID: {current_chat_id}, Title: '{generated_title}'")
-            new_chat_info = {'id': current_chat_id, 'title': generated_title} # Prepare info for frontend
-            current_chat_history = initial_history # Use the newly created history
-        else:
-            # --- Load existing chat ---
-            if current_chat_id not in session['chats']:
-                 logging.error(f"Current chat ID {current_chat_id} not found in session chats. Resetting.")
-                 session['current_chat_id'] = None
-                 session.modified = True
-                 return jsonify({"error": "Current chat session is invalid. Please start a new chat."}), 400
-
-            current_chat_history = session['chats'][current_chat_id].get('history', [])
-            if not isinstance(current_chat_history, list): # Ensure it's a list
-                 current_chat_history = []
-            if not current_chat_history or current_chat_history[0].get('role') != 'system':
-                 current_chat_history.insert(0, DEFAULT_SYSTEM_MESSAGE)
-                 session['chats'][current_chat_id]['history'] = current_chat_history
-                 session.modified = True # Mark modified as history was changed
-                 logging.warning(f"Corrected missing/invalid system message for chat {current_chat_id} during chat request")
-
-
-        # --- Append user message ---
-        user_message = {"role": "user", "content": user_message_content}
-        current_chat_history.append(user_message)
+        provider = get_provider(model_choice)
+        if provider is None:
+            return jsonify({"is_error": True, "response": "ERROR: Invalid model choice specified."}), 400
+        model_choice = route_around_open_circuit(session, model_choice)
+        provider = get_provider(model_choice)
+        try:
+            fan_out_mode, fan_out_choices = parse_fan_out(data, model_choice)
+        except ValueError as e:
+            return jsonify({"is_error": True, "response": str(e)}), 400
+
+        # --- Fetch the key needed for title generation and chat itself ---
+        api_key = get_api_key(session, provider)
+
+        user_id = get_user_id()
+        flight_key, joined_flight, is_leader = join_chat_flight(
+            session, user_id, user_message_content, model_choice, request.headers.get('Idempotency-Key')
+        )
+        if not is_leader:
+            response_data, status_code = coalesced_chat_response(wait_for_chat_flight(session, joined_flight, '/chat'))
+            return jsonify(response_data), status_code
+        flight = joined_flight
+
+        current_chat_id, current_chat_history, new_chat_info, title_future = prepare_chat_turn(
+            session, user_id, user_message_content, model_choice, api_key
+        )
+        if current_chat_id is None:
+            return jsonify({"error": "Current chat session is invalid. Please start a new chat."}), 400
+        # A fan-out fits the history per provider instead
+        prompt_history = None if fan_out_mode else build_prompt_history(user_id, current_chat_id, current_chat_history, model_choice, api_key)
 
         logging.info(f"Processing message for model: {model_choice} in chat: {current_chat_id}")
         bot_response_content = ""
         error_occurred = False
         is_api_error = False # Flag specifically for API key issues
         status_code = 200
+        fan_out_fields = {}
+
+        cache_key, cached_reply = (None, None) if fan_out_mode else lookup_cached_reply(provider, prompt_history, api_key)
+        if fan_out_mode:
+            # --- Same turn to several providers at once (fan_out.py); the chosen answer goes into the history ---
+            chosen, fan_out_fields = run_fan_out(fan_out_mode, session, user_id, current_chat_id, current_chat_history, fan_out_choices)
+            provider = get_provider(chosen['model_choice'])
+            bot_response_content, error_occurred, is_api_error, status_code = (
+                chosen['response'], chosen['is_error'], chosen['is_api_error'], chosen['status_code']
+            )
 
-        # --- API Key Check and AI Call (Gemini) ---
-        if model_choice == 'gemini':
-            # google_api_key already fetched
-            if not google_api_key:
-                 error_message = "Google API Key not set. Please add it via 'API Keys'."
-                 logging.warning(f"{error_message} (Chat ID: {current_chat_id})")
-                 bot_response_content = f"ERROR: {error_message}"
-                 error_occurred = True
-                 is_api_error = True
-                 status_code = 400 # Bad Request (client-side issue - missing key)
-            else:
-                try:
-                    genai.configure(api_key=google_api_key)
-                    model = genai.GenerativeModel('gemini-1.5-flash-latest') # Or 'gemini-1.5-pro-latest'
-                    logging.info(f"Calling Gemini API with prompt (simplified): '{user_message_content[:50]}...'")
-
-                    # Convert chat history for Gemini API
-                    gemini_history = []
-                    for msg in current_chat_history[:-1]: # Exclude the last user message
-                        role = 'user' if msg['role'] == 'user' else 'model'
-                        if msg['role'] != 'system': # Skip system message for Gemini history
-                            gemini_history.append({'role': role, 'parts': [msg['content']]})
-
-                    chat_session = model.start_chat(history=gemini_history)
-                    response = chat_session.send_message(user_message_content)
-
-                    if response.parts:
-                        bot_response_content = response.text
-                        logging.info("Received response from Gemini API.")
-                    elif hasattr(response, 'prompt_feedback') and response.prompt_feedback and hasattr(response.prompt_feedback, 'block_reason') and response.prompt_feedback.block_reason:
-                        block_reason = response.prompt_feedback.block_reason.name
-                        bot_response_content = f"Response blocked due to: {block_reason}"
-                        logging.warning(f"Gemini response blocked: {block_reason}")
-                        error_occurred = True # Treat as error for UI
-                    else:
-                        bot_response_content = "Gemini returned an empty or unexpected response."
-                        logging.warning(f"Gemini returned empty/unexpected response. Response: {response}")
-                        error_occurred = True
-
-                except (google.api_core.exceptions.PermissionDenied, google.api_core.exceptions.InvalidArgument) as e:
-                    error_msg = str(e)
-                    logging.error(f"Google API Auth/Argument Error: {error_msg}", exc_info=False)
-                    bot_response_content = f"ERROR: Google API permission denied or invalid argument. Check your key/API settings. ({type(e).__name__})"
-                    error_occurred = True
-                    is_api_error = True
-                    status_code = 403 # Forbidden
-                except google.api_core.exceptions.ResourceExhausted as e:
-                    logging.error(f"Google API Quota Exceeded: {e}", exc_info=False)
-                    bot_response_content = "ERROR: Google API quota exceeded. Please try again later."
-                    error_occurred = True
-                    status_code = 429 # Too Many Requests
-                except google.api_core.exceptions.GoogleAPIError as e:
-                    logging.error(f"Google API Error: {e}", exc_info=True)
-                    bot_response_content = "ERROR: An error occurred with the Google API."
-                    error_occurred = True
-                    status_code = 500
-                except Exception as e:
-                    logging.error(f"Unexpected error calling Google Gemini API: {e}", exc_info=True)
-                    bot_response_content = "ERROR: An unexpected error occurred with the Google Gemini API."
-                    error_occurred = True
-                    status_code = 500
-
-        # --- API Key Check and AI Call (GPT) ---
-        elif model_choice == 'gpt':
-            # openai_api_key already fetched
-            if not openai_api_key:
-                error_message = "OpenAI API Key not set. Please add it via 'API Keys'."
-                logging.warning(f"{error_message} (Chat ID: {current_chat_id})")
-                bot_response_content = f"ERROR: {error_message}"
-                error_occurred = True
-                is_api_error = True
-                status_code = 400 # Bad Request
-            else:
-                try:
-                    client = OpenAI(api_key=openai_api_key) # Default retries are fine for main chat
-                    logging.info(f"Calling OpenAI API with {len(current_chat_history)} history messages for chat {current_chat_id}.")
-                    response = client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        messages=current_chat_history,
-                        temperature=0.7,
-                        max_tokens=150 # Consider making this configurable
-                    )
-                    bot_response_content = response.choices[0].message.content.strip()
-                    logging.info("Received response from OpenAI API.")
-
-                except AuthenticationError as e:
-                    logging.error(f"OpenAI API Authentication Failed: {e}", exc_info=False)
-                    bot_response_content = f"ERROR: OpenAI API authentication failed. Check your key."
-                    error_occurred = True
-                    is_api_error = True
-                    status_code = 401 # Unauthorized
-                except RateLimitError as e:
-                    logging.error(f"OpenAI API Rate Limit Exceeded: {e}", exc_info=False)
-                    bot_response_content = f"ERROR: OpenAI API request limit reached. Check plan/billing."
-                    error_occurred = True
-                    status_code = 429 # Too Many Requests
-                except APIConnectionError as e:
-                    logging.error(f"OpenAI API Connection Error: {e}", exc_info=True)
-                    bot_response_content = "ERROR: Could not connect to OpenAI API."
-                    error_occurred = True
-                    status_code = 504 # Gateway Timeout
-                except BadRequestError as e:
-                     logging.error(f"OpenAI API BadRequestError: {e}", exc_info=True)
-                     error_message = str(e) or "Invalid request sent to OpenAI."
-                     if "content_policy_violation" in error_message.lower():
-                         bot_response_content = "Response blocked due to OpenAI's content policy."
-                         logging.warning(f"OpenAI content policy violation for chat {current_chat_id}")
-                     else:
-                         bot_response_content = f"ERROR: OpenAI API request error: {error_message}"
-                     error_occurred = True
-                     status_code = e.status_code if hasattr(e, 'status_code') else 400
-                except OpenAIError as e:
-                    logging.error(f"OpenAI API Error: {e}", exc_info=True)
-                    error_message = str(e) or "An unknown error occurred."
-                    status_code_from_error = e.http_status if hasattr(e, 'http_status') else 500
-                    bot_response_content = f"ERROR: An error occurred with the OpenAI API: {error_message}"
-                    error_occurred = True
-                    status_code = status_code_from_error
-                except Exception as e:
-                    logging.error(f"Unexpected error calling OpenAI API: {e}", exc_info=True)
-                    bot_response_content = "ERROR: An unexpected error occurred while contacting the OpenAI API."
-                    error_occurred = True
-                    status_code = 500
-        else:
-            bot_response_content = "ERROR: Invalid model choice specified."
+        elif cached_reply is not None:
+            bot_response_content = cached_reply # No upstream call needed
+
+        # --- API Key Check and AI Call ---
+        elif provider.requires_api_key and not api_key:
+            bot_response_content, status_code = missing_key_error(provider, current_chat_id)
             error_occurred = True
-            status_code = 400 # Bad Request
+            is_api_error = True
+        else:
+            try:
+                logging.info(f"Calling {provider.display_name} API ({provider.chat_model}) with {len(prompt_history)} history messages for chat {current_chat_id}.")
+                bot_response_content = provider.complete(api_key, prompt_history)
+                logging.info(f"Received response from {provider.display_name} API.")
+            except Exception as e:
+                bot_response_content, status_code, is_api_error = describe_chat_error(e, provider, current_chat_id)
+                error_occurred = True
+
+        if cached_reply is None:
+            store_cached_reply(cache_key, bot_response_content, error_occurred)
 
         # --- Append bot response to history ---
-        if not error_occurred and bot_response_content:
-             bot_message = {"role": "assistant", "content": bot_response_content}
-             current_chat_history.append(bot_message)
-        elif error_occurred:
-             logging.error(f"Error response generated for chat {current_chat_id}: {bot_response_content}")
-             if not is_api_error and current_chat_history and current_chat_history[-1]['role'] == 'user':
-                  logging.warning(f"Removing last user message from history for chat {current_chat_id} due to non-API error.")
-                  current_chat_history.pop()
-
-        # --- Trim History ---
-        MAX_HISTORY_MESSAGES = 20 # Max user+assistant messages (excluding system)
-        if len(current_chat_history) > (MAX_HISTORY_MESSAGES + 1): # +1 for system prompt
-            messages_to_keep = current_chat_history[-(MAX_HISTORY_MESSAGES):]
-            current_chat_history = [current_chat_history[0]] + messages_to_keep
-            session['chats'][current_chat_id]['history'] = current_chat_history
-            logging.info(f"Trimmed history for chat {current_chat_id} to {len(current_chat_history)-1} user/assistant messages")
-
-        # --- Mark session as modified ---
-        session.modified = True
+        record_chat_result(user_id, current_chat_id, current_chat_history, bot_response_content, error_occurred, is_api_error, provider)
 
         # --- Return Response ---
         response_data = {
             "is_error": error_occurred,
             # Use 'response' key for both success and error messages
-            'response': bot_response_content
+            'response': bot_response_content,
+            **fan_out_fields,
         }
         if new_chat_info:
+            # Never wait for the title job here: a pending title is fetched by the client from /chat_title
+            if title_future.done():
+                wait_for_title(title_future, new_chat_info, timeout=0)
             response_data['new_chat_info'] = new_chat_info
 
+        result = turn_result(current_chat_id, bot_response_content, error_occurred, status_code, new_chat_info)
         return jsonify(response_data), status_code
 
     except Exception as e:
         logging.error(f"General error in /chat endpoint: {e}", exc_info=True)
         return jsonify({"error": "An internal server error occurred processing your request.", "is_error": True}), 500
+    finally:
+        if flight is not None:
+            chat_flights.finish(flight_key, flight, result)
+
+
+# --- Streaming variant of /chat (Server-Sent Events) ---
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'} # Disable proxy buffering (nginx)
+
+def format_sse(event, data):
+    """ Formats a single Server-Sent Event with a JSON payload. """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Same contract as /chat, but relays the reply token-by-token as SSE ('meta', 'token', 'done' events).
+    The completed assistant message is saved to the chat store once the stream finishes.
+    """
+    flight = None # Set when this request leads a turn its duplicates wait on
+    try:
+        data = request.json
+        user_message_content = data.get('message')
+        model_choice = data.get('model_choice') or default_model_choice()
+
+        if not user_message_content:
+            logging.warning("Received empty message.")
+            return jsonify({"error": "Empty message received."}), 400
+        provider = get_provider(model_choice)
+        if provider is None:
+            return jsonify({"is_error": True, "response": "ERROR: Invalid model choice specified."}), 400
+        model_choice = route_around_open_circuit(session, model_choice)
+        provider = get_provider(model_choice)
+        if data.get('fan_out'):
+            return jsonify({"is_error": True, "response": "ERROR: fan_out is only supported on /chat."}), 400
+
+        api_key = get_api_key(session, provider)
+
+        user_id = get_user_id()
+        flight_key, joined_flight, is_leader = join_chat_flight(
+            session, user_id, user_message_content, model_choice, request.headers.get('Idempotency-Key')
+        )
+        if not is_leader:
+            # Wait before responding, so the session cookie can still pick up the original's new chat
+            result = wait_for_chat_flight(session, joined_flight, '/chat/stream')
+            if result is None:
+                response_data, status_code = coalesced_chat_response(result)
+                return jsonify(response_data), status_code
+            return Response(coalesced_chat_events(result), mimetype='text/event-stream', headers=SSE_HEADERS)
+        flight = joined_flight
+
+        current_chat_id, current_chat_history, new_chat_info, title_future = prepare_chat_turn(
+            session, user_id, user_message_content, model_choice, api_key
+        )
+        if current_chat_id is None:
+            chat_flights.finish(flight_key, flight, None)
+            return jsonify({"error": "Current chat session is invalid. Please start a new chat."}), 400
+        prompt_history = build_prompt_history(user_id, current_chat_id, current_chat_history, model_choice, api_key)
+
+    except Exception as e:
+        logging.error(f"General error in /chat/stream endpoint: {e}", exc_info=True)
+        if flight is not None:
+            chat_flights.finish(flight_key, flight, None)
+        return jsonify({"error": "An internal server error occurred processing your request.", "is_error": True}), 500
+
+    def title_event_if_ready(timeout=0):
+        """ Yields a 'title' event once the background title job for a new chat has finished. """
+        if new_chat_info and new_chat_info.get('title_pending') and (timeout or title_future.done()):
+            if wait_for_title(title_future, new_chat_info, timeout=timeout):
+                yield format_sse('title', {'id': new_chat_info['id'], 'title': new_chat_info['title']})
+
+    def generate():
+        if new_chat_info:
+            yield format_sse('meta', {'new_chat_info': new_chat_info})
+
+        logging.info(f"Streaming message for model: {model_choice} in chat: {current_chat_id}")
+        parts = []
+        error_occurred = False
+        is_api_error = False
+        status_code = 200
+        bot_response_content = ""
+
+        cache_key, cached_reply = lookup_cached_reply(provider, prompt_history, api_key)
+        try:
+            if cached_reply is not None:
+                parts.append(cached_reply) # No upstream call needed; relay the whole reply as one token
+                yield format_sse('token', {'text': cached_reply})
+
+            elif provider.requires_api_key and not api_key:
+                bot_response_content, status_code = missing_key_error(provider, current_chat_id)
+                error_occurred = True
+                is_api_error = True
+
+            else:
+                for text in provider.stream(api_key, prompt_history):
+                    parts.append(text)
+                    yield format_sse('token', {'text': text})
+                    yield from title_event_if_ready()
+
+        except Exception as e:
+            bot_response_content, status_code, is_api_error = describe_chat_error(e, provider, current_chat_id)
+            error_occurred = True
+
+        if not error_occurred:
+            bot_response_content = "".join(parts).strip()
+            logging.info(f"Finished streaming response for chat {current_chat_id}.")
+            if cached_reply is None:
+                store_cached_reply(cache_key, bot_response_content, error_occurred)
+
+        record_chat_result(user_id, current_chat_id, current_chat_history, bot_response_content, error_occurred, is_api_error, provider)
+        chat_flights.finish(flight_key, flight, turn_result(current_chat_id, bot_response_content, error_occurred, status_code, new_chat_info))
+        yield format_sse('done', {
+            'response': bot_response_content,
+            'is_error': error_occurred,
+            'status_code': status_code,
+        })
+        yield from title_event_if_ready(timeout=TITLE_WAIT_SECONDS)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+    # Releases the duplicates (as failed) if the client disconnects before the reply was saved
+    response.call_on_close(lambda: chat_flights.finish(flight_key, flight, None))
+    return response
 
 
 if __name__ == '__main__':
     # Use Gunicorn or another WSGI server in production instead of app.run(debug=True)
     # Example: gunicorn --bind 0.0.0.0:5000 app:app
+    # For many concurrent in-flight LLM calls, serve the async entry point instead (see asgi.py):
+    # Example: uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 2
     app.run(host='0.0.0.0', port=5000, debug=True) # Use debug=True only for development
\ No newline at end of file
@@ -0,0 +1,428 @@
+# asgi.py
+"""
+ASGI entry point with a non-blocking /chat path.
+
+Under WSGI every in-flight LLM call pins a gunicorn worker thread for the whole upstream call.
+Here POST /chat and POST /chat/stream are served natively on the event loop with the async
+OpenAI/Gemini clients, so many slow upstream calls share a few workers. Every other route is
+passed through to the unchanged Flask app (run in a thread pool by asgiref's WsgiToAsgi).
+
+Run with:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 2
+or, under gunicorn:
+    gunicorn -k uvicorn.workers.UvicornWorker -w 2 -b 0.0.0.0:5000 asgi:application
+
+The WSGI entry point (gunicorn app:app) keeps working as before.
+"""
+import asyncio
+import functools
+import json
+import logging
+import secrets
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import dump_cookie, parse_cookie
+
+from app import (
+    app as flask_app, migrate_legacy_chats, prepare_chat_turn, build_prompt_history, record_chat_result, wait_for_title, get_api_key,
+    describe_chat_error, missing_key_error, format_sse, lookup_cached_reply, store_cached_reply, TITLE_WAIT_SECONDS,
+    COALESCED_WAIT_SECONDS, chat_flights, join_chat_flight, wait_for_chat_flight, turn_result, coalesced_chat_response, coalesced_chat_events,
+    route_around_open_circuit, parse_fan_out, fan_out_requests, fan_out_result, fan_out_succeeded, fan_out_outcome,
+)
+from fan_out import hedge_async, compare_async
+from providers import get_provider, default_model_choice
+
+CHAT_PATHS = ('/chat', '/chat/stream')
+
+
+# --- Flask-compatible session cookie ---
+
+def load_session(scope):
+    """ Decodes the Flask session cookie from the request headers. Returns {} if absent or invalid. """
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    cookie_header = dict(scope['headers']).get(b'cookie', b'').decode('latin-1')
+    cookie_value = parse_cookie(cookie_header).get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie_value:
+        return {}
+    try:
+        return dict(serializer.loads(cookie_value, max_age=int(flask_app.permanent_session_lifetime.total_seconds())))
+    except Exception:
+        return {}
+
+
+def session_cookie_header(session_data):
+    """ Builds the Set-Cookie header Flask would send for this session. """
+    interface = flask_app.session_interface
+    value = interface.get_signing_serializer(flask_app).dumps(session_data)
+    cookie = dump_cookie(
+        flask_app.config['SESSION_COOKIE_NAME'],
+        value,
+        path=interface.get_cookie_path(flask_app),
+        domain=interface.get_cookie_domain(flask_app),
+        secure=interface.get_cookie_secure(flask_app),
+        httponly=interface.get_cookie_httponly(flask_app),
+        samesite=interface.get_cookie_samesite(flask_app),
+    )
+    return (b'set-cookie', cookie.encode('latin-1'))
+
+
+# --- Response helpers ---
+
+async def read_json_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body or b'{}')
+    except ValueError:
+        return None
+
+
+async def send_json(send, data, status, extra_headers=()):
+    body = json.dumps(data).encode()
+    headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), (b'vary', b'Cookie')]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers + list(extra_headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_coalesced_response(send, path, result, extra_headers=()):
+    """ Answers a duplicate submission with its original's result, in the format of the requested path. """
+    if path == '/chat' or result is None:
+        response_data, status_code = coalesced_chat_response(result)
+        await send_json(send, response_data, status_code, extra_headers)
+        return
+    body = "".join(coalesced_chat_events(result)).encode()
+    headers = [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'), (b'vary', b'Cookie')]
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers + list(extra_headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def wait_for_title_async(title_future, new_chat_info, timeout=TITLE_WAIT_SECONDS):
+    """ Non-blocking version of app.wait_for_title(). """
+    await asyncio.wait([asyncio.wrap_future(title_future)], timeout=timeout)
+    return wait_for_title(title_future, new_chat_info, timeout=0)
+
+
+# --- Async provider calls (mirror the blocks in app.chat() / app.chat_stream()) ---
+
+async def complete_chat_async(provider, api_key, chat_id, chat_history):
+    """ Returns (bot_response_content, error_occurred, is_api_error, status_code). """
+    if provider.requires_api_key and not api_key:
+        bot_response_content, status_code = missing_key_error(provider, chat_id)
+        return bot_response_content, True, True, status_code
+    try:
+        return await provider.complete_async(api_key, chat_history), False, False, 200
+    except Exception as e:
+        bot_response_content, status_code, is_api_error = describe_chat_error(e, provider, chat_id)
+        return bot_response_content, True, is_api_error, status_code
+
+
+async def stream_chat_async(provider, api_key, chat_id, chat_history, result):
+    """
+    Async generator of reply text chunks. On exit, result holds
+    'response', 'is_error', 'is_api_error' and 'status_code' like complete_chat_async().
+    """
+    parts = []
+    result.update({'response': "", 'is_error': False, 'is_api_error': False, 'status_code': 200})
+    if provider.requires_api_key and not api_key:
+        result['response'], result['status_code'] = missing_key_error(provider, chat_id)
+        result['is_error'] = result['is_api_error'] = True
+        return
+    try:
+        async for text in provider.stream_async(api_key, chat_history):
+            parts.append(text)
+            yield text
+    except Exception as e:
+        result['response'], result['status_code'], result['is_api_error'] = describe_chat_error(e, provider, chat_id)
+        result['is_error'] = True
+        return
+
+    result['response'] = "".join(parts).strip()
+
+
+async def fan_out_call_async(model_choice, api_key, prompt_history, chat_id):
+    """ Async counterpart of app.fan_out_call(); a cancelled task aborts its upstream request. """
+    provider = get_provider(model_choice)
+    started = time.perf_counter()
+    cache_key, cached_reply = await asyncio.to_thread(lookup_cached_reply, provider, prompt_history, api_key)
+    if cached_reply is not None:
+        return fan_out_result(model_choice, cached_reply, False, False, 200, started)
+    bot_response_content, error_occurred, is_api_error, status_code = await complete_chat_async(provider, api_key, chat_id, prompt_history)
+    await asyncio.to_thread(store_cached_reply, cache_key, bot_response_content, error_occurred)
+    return fan_out_result(model_choice, bot_response_content, error_occurred, is_api_error, status_code, started)
+
+
+async def run_fan_out_async(turn):
+    """ Async counterpart of app.run_fan_out(). """
+    prepared = await asyncio.to_thread(
+        fan_out_requests, turn['session'], turn['user_id'], turn['chat_id'], turn['history'], turn['fan_out_choices']
+    )
+    calls = [
+        functools.partial(fan_out_call_async, choice, api_key, prompt_history, turn['chat_id'])
+        for choice, api_key, prompt_history in prepared
+    ]
+    if turn['fan_out_mode'] == 'hedge':
+        return fan_out_outcome('hedge', [await hedge_async(calls, fan_out_succeeded)])
+    return fan_out_outcome('compare', await compare_async(calls))
+
+
+# --- Async /chat and /chat/stream ---
+
+async def start_turn(scope, receive, send):
+    """
+    Shared request handling for both chat paths. Returns the turn state, or None if a
+    response was already sent (an error, or the original's result for a duplicate submission).
+    """
+    data = await read_json_body(receive)
+    if not data or not data.get('message'):
+        logging.warning("Received empty message.")
+        await send_json(send, {"error": "Empty message received."}, 400)
+        return None
+
+    model_choice = data.get('model_choice') or default_model_choice()
+    provider = get_provider(model_choice)
+    if provider is None:
+        await send_json(send, {"is_error": True, "response": "ERROR: Invalid model choice specified."}, 400)
+        return None
+    try:
+        fan_out_mode, fan_out_choices = parse_fan_out(data, model_choice)
+    except ValueError as e:
+        await send_json(send, {"is_error": True, "response": str(e)}, 400)
+        return None
+    if fan_out_mode and scope['path'] != '/chat':
+        await send_json(send, {"is_error": True, "response": "ERROR: fan_out is only supported on /chat."}, 400)
+        return None
+
+    session_data = load_session(scope)
+    original_session = dict(session_data)
+    if 'sid' not in session_data:
+        session_data['sid'] = secrets.token_urlsafe(16)
+    if 'chats' in session_data: # Same as the Flask routes' before_request hook
+        await asyncio.to_thread(migrate_legacy_chats, session_data, session_data['sid'])
+    model_choice = route_around_open_circuit(session_data, model_choice)
+    provider = get_provider(model_choice)
+    api_key = get_api_key(session_data, provider)
+
+    idempotency_key = dict(scope['headers']).get(b'idempotency-key', b'').decode('latin-1')
+    flight_key, flight, is_leader = join_chat_flight(session_data, session_data['sid'], data['message'], model_choice, idempotency_key)
+    if not is_leader:
+        await flight.wait_async(COALESCED_WAIT_SECONDS) # On the loop: a waiting duplicate must not hold a worker thread
+        result = wait_for_chat_flight(session_data, flight, scope['path'], timeout=0)
+        cookie_headers = [session_cookie_header(session_data)] if session_data != original_session else []
+        await send_coalesced_response(send, scope['path'], result, cookie_headers)
+        return None
+
+    try:
+        # SQLite access and the title-job submit are quick but blocking, so keep them off the loop
+        chat_id, chat_history, new_chat_info, title_future = await asyncio.to_thread(
+            prepare_chat_turn, session_data, session_data['sid'], data['message'], model_choice, api_key
+        )
+        cookie_headers = [session_cookie_header(session_data)] if session_data != original_session else []
+        if chat_id is None:
+            chat_flights.finish(flight_key, flight, None)
+            await send_json(send, {"error": "Current chat session is invalid. Please start a new chat."}, 400, cookie_headers)
+            return None
+
+        prompt_history = None # A fan-out fits the history per provider instead
+        if not fan_out_mode:
+            prompt_history = await asyncio.to_thread(
+                build_prompt_history, session_data['sid'], chat_id, chat_history, model_choice, api_key
+            )
+    except BaseException:
+        chat_flights.finish(flight_key, flight, None)
+        raise
+
+    return {
+        'session': session_data,
+        'user_id': session_data['sid'],
+        'model_choice': model_choice,
+        'provider': provider,
+        'api_key': api_key,
+        'message': data['message'],
+        'chat_id': chat_id,
+        'history': chat_history,
+        'prompt_history': prompt_history,
+        'new_chat_info': new_chat_info,
+        'title_future': title_future,
+        'cookie_headers': cookie_headers,
+        'fan_out_mode': fan_out_mode,
+        'fan_out_choices': fan_out_choices,
+        'flight_key': flight_key,
+        'flight': flight,
+    }
+
+
+def finish_turn(turn, result):
+    """ Publishes the turn's result (None = failed) to duplicates waiting on it; see app.join_chat_flight(). """
+    chat_flights.finish(turn['flight_key'], turn['flight'], result)
+
+
+async def handle_chat(scope, receive, send):
+    """ Async equivalent of app.chat(). """
+    turn = await start_turn(scope, receive, send)
+    if turn is None:
+        return
+    try:
+        await complete_turn(turn, send)
+    finally:
+        finish_turn(turn, None) # No-op unless the turn failed before publishing its result
+
+
+async def complete_turn(turn, send):
+    """ Body of handle_chat(), once the turn has started. """
+    logging.info(f"Processing message for model: {turn['model_choice']} in chat: {turn['chat_id']} (async)")
+
+    provider = turn['provider']
+    fan_out_fields = {}
+    if turn['fan_out_mode']:
+        chosen, fan_out_fields = await run_fan_out_async(turn)
+        provider = get_provider(chosen['model_choice'])
+        bot_response_content, error_occurred, is_api_error, status_code = (
+            chosen['response'], chosen['is_error'], chosen['is_api_error'], chosen['status_code']
+        )
+    else:
+        cache_key, cached_reply = await asyncio.to_thread(lookup_cached_reply, provider, turn['prompt_history'], turn['api_key'])
+        if cached_reply is not None:
+            bot_response_content, error_occurred, is_api_error, status_code = cached_reply, False, False, 200
+        else:
+            bot_response_content, error_occurred, is_api_error, status_code = await complete_chat_async(
+                provider, turn['api_key'], turn['chat_id'], turn['prompt_history']
+            )
+            await asyncio.to_thread(store_cached_reply, cache_key, bot_response_content, error_occurred)
+    await asyncio.to_thread(
+        record_chat_result, turn['user_id'], turn['chat_id'], turn['history'], bot_response_content, error_occurred, is_api_error, provider
+    )
+
+    response_data = {"is_error": error_occurred, 'response': bot_response_content, **fan_out_fields}
+    if turn['new_chat_info']:
+        # As in app.chat(): a pending title is fetched by the client from /chat_title
+        if turn['title_future'].done():
+            wait_for_title(turn['title_future'], turn['new_chat_info'], timeout=0)
+        response_data['new_chat_info'] = turn['new_chat_info']
+    finish_turn(turn, turn_result(turn['chat_id'], bot_response_content, error_occurred, status_code, turn['new_chat_info']))
+    await send_json(send, response_data, status_code, turn['cookie_headers'])
+
+
+async def handle_chat_stream(scope, receive, send):
+    """ Async equivalent of app.chat_stream(); emits the same 'meta', 'token', 'title' and 'done' events. """
+    turn = await start_turn(scope, receive, send)
+    if turn is None:
+        return
+    try:
+        await stream_turn(turn, send)
+    finally:
+        finish_turn(turn, None) # No-op unless the stream failed (or the client left) before the reply was saved
+
+
+async def stream_turn(turn, send):
+    """ Body of handle_chat_stream(), once the turn has started. """
+    new_chat_info = turn['new_chat_info']
+    logging.info(f"Streaming message for model: {turn['model_choice']} in chat: {turn['chat_id']} (async)")
+
+    headers = [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'), # Disable proxy buffering (nginx)
+        (b'vary', b'Cookie'),
+    ]
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers + turn['cookie_headers']})
+
+    async def send_event(event, data):
+        await send({'type': 'http.response.body', 'body': format_sse(event, data).encode(), 'more_body': True})
+
+    async def send_title_if_ready(timeout=0):
+        if new_chat_info and new_chat_info.get('title_pending') and (timeout or turn['title_future'].done()):
+            if await wait_for_title_async(turn['title_future'], new_chat_info, timeout=timeout):
+                await send_event('title', {'id': new_chat_info['id'], 'title': new_chat_info['title']})
+
+    if new_chat_info:
+        await send_event('meta', {'new_chat_info': new_chat_info})
+
+    cache_key, cached_reply = await asyncio.to_thread(lookup_cached_reply, turn['provider'], turn['prompt_history'], turn['api_key'])
+    if cached_reply is not None:
+        result = {'response': cached_reply, 'is_error': False, 'is_api_error': False, 'status_code': 200}
+        await send_event('token', {'text': cached_reply})
+    else:
+        result = {}
+        async for text in stream_chat_async(turn['provider'], turn['api_key'], turn['chat_id'], turn['prompt_history'], result):
+            await send_event('token', {'text': text})
+            await send_title_if_ready()
+        await asyncio.to_thread(store_cached_reply, cache_key, result['response'], result['is_error'])
+
+    await asyncio.to_thread(
+        record_chat_result, turn['user_id'], turn['chat_id'], turn['history'], result['response'], result['is_error'], result['is_api_error'], turn['provider']
+    )
+    finish_turn(turn, turn_result(turn['chat_id'], result['response'], result['is_error'], result['status_code'], new_chat_info))
+    await send_event('done', {'response': result['response'], 'is_error': result['is_error'], 'status_code': result['status_code']})
+    await send_title_if_ready(timeout=TITLE_WAIT_SECONDS)
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def send_internal_error(scope, tracked_send):
+    """ Reports an unhandled error in whatever form the response still allows: JSON, a final SSE 'done' event, or just closing the body. """
+    error_message = "An internal server error occurred processing your request."
+    if not tracked_send.started:
+        await send_json(tracked_send, {"error": error_message, "is_error": True}, 500)
+        return
+    if tracked_send.finished:
+        return
+    if scope['path'] == '/chat/stream' and not tracked_send.stream_done:
+        event = format_sse('done', {'response': f"ERROR: {error_message}", 'is_error': True, 'status_code': 500})
+        await tracked_send({'type': 'http.response.body', 'body': event.encode(), 'more_body': True})
+    await tracked_send({'type': 'http.response.body', 'body': b''})
+
+
+class TrackedSend:
+    """ Wraps an ASGI send callable and remembers how far the response got, for the error handler. """
+
+    def __init__(self, send):
+        self.send = send
+        self.started = False # http.response.start was sent
+        self.finished = False # The last body chunk was sent
+        self.stream_done = False # The 'done' event of a /chat/stream reply was sent
+
+    async def __call__(self, message):
+        if message['type'] == 'http.response.start':
+            self.started = True
+        elif message['type'] == 'http.response.body':
+            self.stream_done = self.stream_done or message.get('body', b'').startswith(b'event: done\n')
+            self.finished = not message.get('more_body', False)
+        await self.send(message)
+
+
+class ChatASGIApp:
+    """ Serves the chat endpoints natively and delegates every other request to the Flask WSGI app. """
+
+    def __init__(self, wsgi_app):
+        self.wsgi = WsgiToAsgi(wsgi_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] in CHAT_PATHS:
+            tracked_send = TrackedSend(send)
+            try:
+                if scope['path'] == '/chat':
+                    await handle_chat(scope, receive, tracked_send)
+                else:
+                    await handle_chat_stream(scope, receive, tracked_send)
+            except Exception as e:
+                logging.error(f"General error in async {scope['path']} endpoint: {e}", exc_info=True)
+                await send_internal_error(scope, tracked_send)
+            return
+
+        await self.wsgi(scope, receive, send)
+
+
+application = ChatASGIApp(flask_app)
@@ -0,0 +1,263 @@
+# benchmarks/load_test.py
+"""
+Load and latency benchmark for the chat app.
+
+Each simulated user runs the page flow: GET /, POST /new_chat, then --turns chat turns. Each turn
+is POST /chat (or /chat/stream with --stream) followed by GET /load_chat/<id>, so the last two
+get slower as the history grows. Users run concurrently (--users) with their own session cookie.
+
+The LLM is stood in for by the mock provider (providers.MockProvider), with tunable latency and
+token rate, so the numbers measure this app rather than an upstream API. By default the app is
+served in-process on a free port with a throwaway SQLite store. To benchmark a deployed server,
+start it with MOCK_PROVIDER_ENABLED=true and pass --url.
+
+Output is one JSON document (stdout or --output) with per-endpoint p50/p95/p99 latency and
+time-to-first-byte, requests/sec, response sizes, and a per-turn breakdown of latency, response
+size and session cookie size. Example:
+
+    python benchmarks/load_test.py --users 20 --iterations 3 --turns 10 --llm-latency 0.5 --output results.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SESSION_COOKIE_NAME = "session" # Flask default
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of values (None if empty). """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100)) # Ceiling
+    return ordered[int(rank) - 1]
+
+
+def summarize(values):
+    return {
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'mean': sum(values) / len(values) if values else None,
+        'max': max(values) if values else None,
+    }
+
+
+class Recorder:
+    """ Thread-safe collection of request samples. """
+
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, **sample):
+        with self._lock:
+            self.samples.append(sample)
+
+
+class VirtualUser:
+    """ One browser: a keep-alive connection and a session cookie. """
+
+    def __init__(self, base_url, recorder, timeout):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.recorder = recorder
+        self.timeout = timeout
+        self.cookie = None
+        self.conn = None
+
+    def request(self, method, path, endpoint, body=None, turn=None):
+        """ Sends one request; records latency, TTFB, sizes. Returns (status, body bytes). """
+        headers = {'Accept': '*/*'}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        if self.cookie:
+            headers['Cookie'] = f"{SESSION_COOKIE_NAME}={self.cookie}"
+
+        start = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            first_chunk = response.read1(1) if hasattr(response, 'read1') else response.read(1)
+            ttfb = time.perf_counter() - start
+            data = first_chunk + response.read()
+            elapsed = time.perf_counter() - start
+        except (OSError, http.client.HTTPException) as e:
+            self.conn = None # Reconnect on the next request
+            self.recorder.add(endpoint=endpoint, turn=turn, ok=False, error=type(e).__name__,
+                              latency=time.perf_counter() - start, ttfb=None, response_bytes=0, cookie_bytes=len(self.cookie or ''))
+            return None, b''
+
+        for header in response.headers.get_all('Set-Cookie') or []:
+            morsel = SimpleCookie(header).get(SESSION_COOKIE_NAME)
+            if morsel is not None:
+                self.cookie = morsel.value
+        self.recorder.add(endpoint=endpoint, turn=turn, ok=response.status < 500, status=response.status,
+                          latency=elapsed, ttfb=ttfb, response_bytes=len(data), cookie_bytes=len(self.cookie or ''))
+        return response.status, data
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+def chat_id_from_response(status, data, stream):
+    """ Extracts the new chat's id from a /chat JSON body or a /chat/stream 'meta' event. """
+    if status != 200:
+        return None
+    try:
+        if stream:
+            for block in data.decode().split("\n\n"):
+                if block.startswith("event: meta"):
+                    return json.loads(block.split("data: ", 1)[1])['new_chat_info']['id']
+            return None
+        return json.loads(data).get('new_chat_info', {}).get('id')
+    except (ValueError, KeyError, IndexError):
+        return None
+
+
+def run_user(base_url, recorder, args):
+    user = VirtualUser(base_url, recorder, args.timeout)
+    chat_path = '/chat/stream' if args.stream else '/chat'
+    message = " ".join(["benchmark"] * args.message_words)
+    try:
+        for _ in range(args.iterations):
+            user.request('GET', '/', '/')
+            user.request('POST', '/new_chat', '/new_chat', body={})
+            chat_id = None
+            for turn in range(1, args.turns + 1):
+                status, data = user.request('POST', chat_path, chat_path, body={'message': f"{message} {turn}", 'model_choice': args.model}, turn=turn)
+                chat_id = chat_id or chat_id_from_response(status, data, args.stream)
+                if chat_id:
+                    user.request('GET', f'/load_chat/{chat_id}', '/load_chat/<id>', turn=turn)
+    finally:
+        user.close()
+
+
+def build_report(samples, wall_seconds, args):
+    by_endpoint = defaultdict(list)
+    by_turn = defaultdict(lambda: defaultdict(list))
+    for sample in samples:
+        by_endpoint[sample['endpoint']].append(sample)
+        if sample['turn'] is not None:
+            by_turn[sample['turn']][sample['endpoint']].append(sample)
+
+    def ms(values):
+        return [v * 1000 for v in values if v is not None]
+
+    endpoints = {}
+    for endpoint, entries in sorted(by_endpoint.items()):
+        ok = [s for s in entries if s['ok']]
+        endpoints[endpoint] = {
+            'requests': len(entries),
+            'errors': len(entries) - len(ok),
+            'requests_per_second': len(entries) / wall_seconds if wall_seconds else None,
+            'latency_ms': summarize(ms(s['latency'] for s in ok)),
+            'ttfb_ms': summarize(ms(s['ttfb'] for s in ok)),
+            'response_bytes': summarize([s['response_bytes'] for s in ok]),
+        }
+
+    turns = []
+    for turn in sorted(by_turn):
+        row = {'turn': turn}
+        for endpoint, entries in sorted(by_turn[turn].items()):
+            ok = [s for s in entries if s['ok']]
+            row[endpoint] = {
+                'latency_ms_p50': percentile(ms(s['latency'] for s in ok), 50),
+                'latency_ms_p95': percentile(ms(s['latency'] for s in ok), 95),
+                'response_bytes_mean': sum(s['response_bytes'] for s in ok) / len(ok) if ok else None,
+            }
+        row['cookie_bytes_max'] = max(s['cookie_bytes'] for entries in by_turn[turn].values() for s in entries)
+        turns.append(row)
+
+    return {
+        'config': vars(args),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'wall_seconds': wall_seconds,
+        'total_requests': len(samples),
+        'requests_per_second': len(samples) / wall_seconds if wall_seconds else None,
+        'endpoints': endpoints,
+        'by_turn': turns,
+    }
+
+
+def start_local_server(args):
+    """ Serves the app in-process with the mock provider and a throwaway chat store and search index. Returns (base_url, server). """
+    workdir = tempfile.mkdtemp(prefix='chat-bench-')
+    os.environ.update({
+        'MOCK_PROVIDER_ENABLED': 'true',
+        'MOCK_LATENCY_SECONDS': str(args.llm_latency),
+        'MOCK_TOKENS_PER_SECOND': str(args.llm_tokens_per_second),
+        'CHAT_STORE_URL': 'sqlite:///' + os.path.join(workdir, 'chats.db'),
+        'SEARCH_INDEX_URL': 'sqlite:///' + os.path.join(workdir, 'search.db'),
+    })
+    os.environ.setdefault('FLASK_SECRET_KEY', 'benchmark-secret-key')
+    sys.path.insert(0, REPO_ROOT)
+    import logging
+    from werkzeug.serving import make_server
+    from app import app # Imported after the environment is set: configuration is read at import time
+
+    logging.getLogger().setLevel(logging.WARNING) # Per-request INFO logs would dominate the measurement
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="Benchmark a running server (started with MOCK_PROVIDER_ENABLED=true) instead of an in-process one")
+    parser.add_argument('--users', type=int, default=10, help="Concurrent simulated users")
+    parser.add_argument('--iterations', type=int, default=2, help="New-chat flows per user")
+    parser.add_argument('--turns', type=int, default=10, help="Chat turns per flow (history length)")
+    parser.add_argument('--message-words', type=int, default=20, help="Words per user message")
+    parser.add_argument('--stream', action='store_true', help="Use /chat/stream instead of /chat")
+    parser.add_argument('--model', default='mock', help="model_choice sent with each message")
+    parser.add_argument('--llm-latency', type=float, default=0.2, help="Mock LLM time to first token, seconds (in-process server only)")
+    parser.add_argument('--llm-tokens-per-second', type=float, default=100, help="Mock LLM token rate, 0 = instant (in-process server only)")
+    parser.add_argument('--timeout', type=float, default=60, help="Per-request timeout, seconds")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = None
+    base_url = args.url.rstrip('/') if args.url else None
+    if base_url is None:
+        base_url, server = start_local_server(args)
+
+    recorder = Recorder()
+    threads = [threading.Thread(target=run_user, args=(base_url, recorder, args)) for _ in range(args.users)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - started
+
+    if server is not None:
+        server.shutdown()
+
+    report = json.dumps(build_report(recorder.samples, wall_seconds, args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
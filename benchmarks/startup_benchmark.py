@@ -0,0 +1,135 @@
+# benchmarks/startup_benchmark.py
+"""
+Worker cold-start benchmark: import time and memory of the app module.
+
+Each run starts a fresh interpreter, as a new gunicorn/uvicorn worker would (without --preload),
+imports the entry module (app or asgi) and reports the wall time of that import, the process RSS
+afterwards and how many modules were loaded. Every mode is measured --runs times; the report
+gives the median and the min/max.
+
+Modes:
+    lazy      provider SDKs load on first use (the default configuration)
+    eager     PRELOAD_LLM_SDKS=openai,gemini: the SDKs are imported at startup, as they used to be
+    first-use lazy, plus the cost of the first OpenAI and Gemini client (what the first request pays)
+
+RSS is read from /proc/self/status (Linux), falling back to ru_maxrss. Example:
+
+    python benchmarks/startup_benchmark.py --runs 5 --module asgi --output startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('lazy', 'eager', 'first-use')
+
+# Runs in the child interpreter; prints one JSON line
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+import_seconds = time.perf_counter() - started
+first_use_seconds = None
+if {first_use}:
+    from llm_clients import get_openai_client, get_gemini_model
+    started = time.perf_counter()
+    get_openai_client("benchmark-key")
+    get_gemini_model("benchmark-key", "gemini-1.5-flash")
+    first_use_seconds = time.perf_counter() - started
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+print(json.dumps({{
+    "import_seconds": import_seconds,
+    "first_use_seconds": first_use_seconds,
+    "rss_mb": rss_mb(),
+    "modules": len(sys.modules),
+    "sdks_loaded": sorted(name for name in ("openai", "google.generativeai") if name in sys.modules),
+}}))
+"""
+
+
+def run_once(module, mode, workdir):
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': REPO_ROOT + os.pathsep + env.get('PYTHONPATH', ''),
+        'FLASK_SECRET_KEY': env.get('FLASK_SECRET_KEY', 'benchmark-secret-key'),
+        'CHAT_STORE_URL': 'sqlite:///' + os.path.join(workdir, 'chats.db'),
+        'SEARCH_INDEX_URL': 'sqlite:///' + os.path.join(workdir, 'search.db'),
+        'PRELOAD_LLM_SDKS': 'openai,gemini' if mode == 'eager' else '',
+        'PYTHONDONTWRITEBYTECODE': '', # Keep .pyc caching on: workers boot from warm bytecode
+    })
+    probe = PROBE.format(module=module, first_use=mode == 'first-use')
+    result = subprocess.run(
+        [sys.executable, '-W', 'ignore', '-c', probe], env=env, cwd=workdir, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return {'median': statistics.median(values), 'min': min(values), 'max': max(values)}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='app', choices=('app', 'asgi'), help="Entry module the worker imports")
+    parser.add_argument('--modes', default=','.join(MODES), help=f"Comma-separated subset of {', '.join(MODES)}")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per mode")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        raise SystemExit(f"Unknown mode(s): {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix='startup-bench-')
+    run_once(args.module, 'lazy', workdir) # Warm-up: writes .pyc files and creates the SQLite schemas
+    report = {
+        'module': args.module,
+        'runs': args.runs,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'modes': {},
+    }
+    for mode in modes:
+        samples = [run_once(args.module, mode, workdir) for _ in range(args.runs)]
+        report['modes'][mode] = {
+            'import_seconds': summarize([sample['import_seconds'] for sample in samples]),
+            'first_use_seconds': summarize([sample['first_use_seconds'] for sample in samples]),
+            'rss_mb': summarize([sample['rss_mb'] for sample in samples]),
+            'modules': samples[-1]['modules'],
+            'sdks_loaded': samples[-1]['sdks_loaded'],
+        }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,544 @@
+# chat_store.py
+"""
+Server-side storage for chat conversations.
+
+The Flask session cookie only carries a small per-browser id (see app.get_user_id);
+titles and histories live here so each request reads/writes only the chat it touches.
+Histories are stored as compressed, append-only blocks (history_codec.py). Histories saved in the
+earlier JSON format are still read, and are converted the next time they are saved.
+Every write is mirrored into the optional full-text search index (search_index.py).
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from history_codec import encode_block, decode_blocks
+
+
+class StoredHistory(list):
+    """
+    A history as returned by get_chat(). stored_length is how many of its messages are already in
+    the store, so save_history() only appends the ones after it. Edits to the stored messages are
+    not tracked: build a new list for those (a plain list is always saved in full).
+    """
+
+    def __init__(self, messages, stored_length):
+        super().__init__(messages)
+        self.stored_length = stored_length
+
+
+def appended_messages(history):
+    """ The messages save_history() has to append, or None if history must be rewritten in full. """
+    stored_length = getattr(history, 'stored_length', None)
+    if stored_length is None or len(history) < stored_length:
+        return None
+    return history[stored_length:]
+
+
+class ChatStore:
+    """
+    Interface every chat storage backend implements.
+
+    Chats are addressed by (user_id, chat_id). Summaries returned by list_chats() are
+    dicts with 'id', 'title' and 'created_at'; get_chat() additionally includes 'history'.
+    """
+
+    search_index = None # A search_index.SearchIndex kept in step with every write, or None
+
+    def _update_search_index(self, method, user_id, chat_id, *args):
+        """ Index failures are logged, not raised: the chat is saved either way, search just misses it. """
+        if self.search_index is None:
+            return
+        try:
+            getattr(self.search_index, method)(user_id, chat_id, *args)
+        except Exception as e:
+            logging.error(f"Search index {method} failed for chat {chat_id}: {e}", exc_info=True)
+
+    def list_chats(self, user_id, limit=None, before=None):
+        """
+        Returns the user's chats newest first (by created_at, then chat_id). before is a
+        (created_at, chat_id) cursor, usually taken from the last chat of the previous page:
+        only older chats are returned. limit=None returns all of them.
+        """
+        raise NotImplementedError
+
+    def get_chat(self, user_id, chat_id):
+        """ Returns the chat dict (with history) or None if it does not exist. """
+        raise NotImplementedError
+
+    def create_chat(self, user_id, chat_id, title, history):
+        raise NotImplementedError
+
+    def import_chats(self, user_id, chats):
+        """
+        Bulk-creates chats (dicts with 'id', 'title', 'history' and 'created_at') in one round trip.
+        Ids must be unique within chats; chats whose id already exists are left alone.
+        Returns the ids of the chats created.
+        """
+        raise NotImplementedError
+
+    def save_history(self, user_id, chat_id, history):
+        """
+        Replaces the stored history. For a StoredHistory only the messages added since get_chat()
+        are written. Returns False if the chat does not exist.
+        """
+        raise NotImplementedError
+
+    def update_title(self, user_id, chat_id, title, expected_title=None):
+        """
+        Returns False if the chat does not exist, or if expected_title is given
+        and the current title differs from it (e.g. the user renamed the chat).
+        """
+        raise NotImplementedError
+
+    def delete_chat(self, user_id, chat_id):
+        """ Returns False if the chat does not exist. """
+        raise NotImplementedError
+
+    def get_summary(self, user_id, chat_id):
+        """ Returns the rolling summary of the chat's older turns ({'text', 'covered'}) or None. """
+        raise NotImplementedError
+
+    def save_summary(self, user_id, chat_id, summary):
+        """ Returns False if the chat does not exist. """
+        raise NotImplementedError
+
+    def scan_chats(self, after=None, limit=500):
+        """
+        Chat summaries of all users ordered by (user_id, chat_id), each with an extra 'user_id',
+        for offline maintenance jobs. after is the (user_id, chat_id) of the last chat already seen.
+        """
+        raise NotImplementedError
+
+
+class SQLiteChatStore(ChatStore):
+    """ Default backend: one row per chat in a local SQLite file (WAL mode, one connection per thread). """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chats (
+                    user_id TEXT NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    history TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, chat_id)
+                )
+            """)
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(chats)")}
+            if 'summary' not in columns: # Added after the first release of the table
+                conn.execute("ALTER TABLE chats ADD COLUMN summary TEXT")
+            # NULL: history is JSON in chats.history (older rows); 'blocks': it is in history_blocks
+            if 'history_encoding' not in columns:
+                conn.execute("ALTER TABLE chats ADD COLUMN history_encoding TEXT")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS history_blocks (
+                    user_id TEXT NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (user_id, chat_id, seq)
+                )
+            """)
+            # Sidebar pages are read newest-first per user
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_user_created ON chats (user_id, created_at, chat_id)")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer across gunicorn workers
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def list_chats(self, user_id, limit=None, before=None):
+        query = "SELECT chat_id, title, created_at FROM chats WHERE user_id = ?"
+        params = [user_id]
+        if before is not None:
+            query += " AND (created_at < ? OR (created_at = ? AND chat_id < ?))"
+            params += [before[0], before[0], before[1]]
+        query += " ORDER BY created_at DESC, chat_id DESC LIMIT ?"
+        params.append(-1 if limit is None else limit)
+        rows = self._connect().execute(query, params).fetchall()
+        return [{'id': row['chat_id'], 'title': row['title'], 'created_at': row['created_at']} for row in rows]
+
+    def get_chat(self, user_id, chat_id):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT chat_id, title, history, history_encoding, created_at FROM chats WHERE user_id = ? AND chat_id = ?",
+            (user_id, chat_id)
+        ).fetchone()
+        if row is None:
+            return None
+        if row['history_encoding'] == 'blocks':
+            blocks = conn.execute(
+                "SELECT data FROM history_blocks WHERE user_id = ? AND chat_id = ? ORDER BY seq", (user_id, chat_id)
+            ).fetchall()
+            history = decode_blocks(block['data'] for block in blocks)
+            history = StoredHistory(history, stored_length=len(history))
+        else:
+            history = json.loads(row['history']) # Older format; rewritten as blocks on the next save
+        return {
+            'id': row['chat_id'],
+            'title': row['title'],
+            'history': history,
+            'created_at': row['created_at'],
+        }
+
+    def create_chat(self, user_id, chat_id, title, history):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO chats (user_id, chat_id, title, history, history_encoding, created_at, updated_at) VALUES (?, ?, ?, '', 'blocks', ?, ?)",
+                (user_id, chat_id, title, now, now)
+            )
+            conn.execute(
+                "INSERT INTO history_blocks (user_id, chat_id, seq, data) VALUES (?, ?, 0, ?)",
+                (user_id, chat_id, encode_block(history))
+            )
+        self._update_search_index('replace_chat', user_id, chat_id, title, history)
+
+    def import_chats(self, user_id, chats):
+        if not chats:
+            return []
+        with self._connect() as conn: # One transaction for the whole batch
+            placeholders = ", ".join("?" * len(chats))
+            existing = {row['chat_id'] for row in conn.execute(
+                f"SELECT chat_id FROM chats WHERE user_id = ? AND chat_id IN ({placeholders})",
+                [user_id] + [chat['id'] for chat in chats]
+            )}
+            new_chats = [chat for chat in chats if chat['id'] not in existing]
+            conn.executemany(
+                "INSERT INTO chats (user_id, chat_id, title, history, history_encoding, created_at, updated_at) VALUES (?, ?, ?, '', 'blocks', ?, ?)",
+                [(user_id, chat['id'], chat['title'], chat['created_at'], time.time()) for chat in new_chats]
+            )
+            conn.executemany(
+                "INSERT INTO history_blocks (user_id, chat_id, seq, data) VALUES (?, ?, 0, ?)",
+                [(user_id, chat['id'], encode_block(chat['history'])) for chat in new_chats]
+            )
+        for chat in new_chats:
+            self._update_search_index('replace_chat', user_id, chat['id'], chat['title'], chat['history'])
+        return [chat['id'] for chat in new_chats]
+
+    def save_history(self, user_id, chat_id, history):
+        appended = appended_messages(history)
+        with self._connect() as conn:
+            if appended is not None:
+                # Only blocks-format rows can be appended to; older rows fall through to a full rewrite
+                cursor = conn.execute(
+                    "UPDATE chats SET updated_at = ? WHERE user_id = ? AND chat_id = ? AND history_encoding = 'blocks'",
+                    (time.time(), user_id, chat_id)
+                )
+                if cursor.rowcount > 0:
+                    if appended:
+                        conn.execute(
+                            "INSERT INTO history_blocks (user_id, chat_id, seq, data) "
+                            "SELECT ?, ?, COALESCE(MAX(seq), -1) + 1, ? FROM history_blocks WHERE user_id = ? AND chat_id = ?",
+                            (user_id, chat_id, encode_block(appended), user_id, chat_id)
+                        )
+                    self._update_search_index('add_messages', user_id, chat_id, history.stored_length, appended)
+                    history.stored_length = len(history)
+                    return True
+
+            cursor = conn.execute(
+                "UPDATE chats SET history = '', history_encoding = 'blocks', updated_at = ? WHERE user_id = ? AND chat_id = ?",
+                (time.time(), user_id, chat_id)
+            )
+            if cursor.rowcount == 0:
+                return False
+            conn.execute("DELETE FROM history_blocks WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+            conn.execute(
+                "INSERT INTO history_blocks (user_id, chat_id, seq, data) VALUES (?, ?, 0, ?)",
+                (user_id, chat_id, encode_block(history))
+            )
+        self._update_search_index('replace_messages', user_id, chat_id, history)
+        if isinstance(history, StoredHistory):
+            history.stored_length = len(history)
+        return True
+
+    def update_title(self, user_id, chat_id, title, expected_title=None):
+        query = "UPDATE chats SET title = ?, updated_at = ? WHERE user_id = ? AND chat_id = ?"
+        params = [title, time.time(), user_id, chat_id]
+        if expected_title is not None:
+            query += " AND title = ?"
+            params.append(expected_title)
+        with self._connect() as conn:
+            cursor = conn.execute(query, params)
+        if cursor.rowcount == 0:
+            return False
+        self._update_search_index('set_title', user_id, chat_id, title)
+        return True
+
+    def delete_chat(self, user_id, chat_id):
+        with self._connect() as conn:
+            cursor = conn.execute("DELETE FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+            conn.execute("DELETE FROM history_blocks WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+        if cursor.rowcount == 0:
+            return False
+        self._update_search_index('delete_chat', user_id, chat_id)
+        return True
+
+    def get_summary(self, user_id, chat_id):
+        row = self._connect().execute(
+            "SELECT summary FROM chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
+        ).fetchone()
+        return json.loads(row['summary']) if row and row['summary'] else None
+
+    def save_summary(self, user_id, chat_id, summary):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE chats SET summary = ? WHERE user_id = ? AND chat_id = ?",
+                (json.dumps(summary), user_id, chat_id)
+            )
+        return cursor.rowcount > 0
+
+    def scan_chats(self, after=None, limit=500):
+        query = "SELECT user_id, chat_id, title, created_at FROM chats"
+        params = []
+        if after is not None:
+            query += " WHERE user_id > ? OR (user_id = ? AND chat_id > ?)"
+            params += [after[0], after[0], after[1]]
+        query += " ORDER BY user_id, chat_id LIMIT ?" # Walks the primary key
+        params.append(limit)
+        return [
+            {'user_id': row['user_id'], 'id': row['chat_id'], 'title': row['title'], 'created_at': row['created_at']}
+            for row in self._connect().execute(query, params)
+        ]
+
+
+class RedisChatStore(ChatStore):
+    """
+    Backend for any Redis-compatible client (redis-py, fakeredis, ...).
+
+    Layout: hash 'chats:{user_id}' maps chat_id -> JSON {title, created_at}, and sorted set
+    'chats_by_time:{user_id}' orders the chat ids by created_at for paging;
+    list 'history:{user_id}:{chat_id}' holds the history blocks and 'summary:{user_id}:{chat_id}'
+    the rolling summary. Chats saved before the block format keep a JSON string in
+    'chat:{user_id}:{chat_id}' until their next save.
+    """
+
+    def __init__(self, client, prefix="chatbot"):
+        self.client = client
+        self.prefix = prefix
+
+    def _meta_key(self, user_id):
+        return f"{self.prefix}:chats:{user_id}"
+
+    def _history_key(self, user_id, chat_id):
+        return f"{self.prefix}:history:{user_id}:{chat_id}"
+
+    def _legacy_history_key(self, user_id, chat_id):
+        return f"{self.prefix}:chat:{user_id}:{chat_id}"
+
+    def _rewrite_history(self, user_id, chat_id, history):
+        pipe = self.client.pipeline() # MULTI/EXEC: readers never see a half-written history
+        self._queue_rewrite(pipe, user_id, chat_id, encode_block(history))
+        pipe.execute()
+
+    def _queue_rewrite(self, pipe, user_id, chat_id, block):
+        """ Adds the commands replacing a chat's history with the single block to a MULTI pipeline. """
+        pipe.delete(self._history_key(user_id, chat_id), self._legacy_history_key(user_id, chat_id))
+        pipe.rpush(self._history_key(user_id, chat_id), block)
+
+    def _time_index_key(self, user_id):
+        return f"{self.prefix}:chats_by_time:{user_id}"
+
+    def _ensure_time_index(self, user_id):
+        """ Builds the time index for chats stored before it existed. """
+        if self.client.exists(self._time_index_key(user_id)) or not self.client.hlen(self._meta_key(user_id)):
+            return
+        scores = {
+            (chat_id.decode() if isinstance(chat_id, bytes) else chat_id): json.loads(meta)['created_at']
+            for chat_id, meta in self.client.hgetall(self._meta_key(user_id)).items()
+        }
+        self.client.zadd(self._time_index_key(user_id), scores)
+
+    def list_chats(self, user_id, limit=None, before=None):
+        self._ensure_time_index(user_id)
+        index_key = self._time_index_key(user_id)
+        if before is None:
+            max_score, skip_ties = "+inf", 0
+        else:
+            # Chats sharing the cursor's timestamp are ordered by id; skip those not older than the cursor
+            max_score = before[0]
+            ties = self.client.zrevrangebyscore(index_key, before[0], before[0])
+            skip_ties = sum(1 for chat_id in ties if (chat_id.decode() if isinstance(chat_id, bytes) else chat_id) >= before[1])
+        if limit is None:
+            chat_ids = self.client.zrevrangebyscore(index_key, max_score, "-inf")
+        else:
+            chat_ids = self.client.zrevrangebyscore(index_key, max_score, "-inf", start=0, num=limit + skip_ties)
+        chat_ids = [chat_id.decode() if isinstance(chat_id, bytes) else chat_id for chat_id in chat_ids][skip_ties:]
+        if not chat_ids:
+            return []
+        chats = []
+        for chat_id, meta in zip(chat_ids, self.client.hmget(self._meta_key(user_id), chat_ids)):
+            if meta is not None:
+                meta = json.loads(meta)
+                chats.append({'id': chat_id, 'title': meta['title'], 'created_at': meta['created_at']})
+        return chats
+
+    def get_chat(self, user_id, chat_id):
+        meta = self.client.hget(self._meta_key(user_id), chat_id)
+        if meta is None:
+            return None
+        meta = json.loads(meta)
+        blocks = self.client.lrange(self._history_key(user_id, chat_id), 0, -1)
+        if blocks:
+            history = decode_blocks(blocks)
+            history = StoredHistory(history, stored_length=len(history))
+        else:
+            legacy_history = self.client.get(self._legacy_history_key(user_id, chat_id))
+            history = json.loads(legacy_history) if legacy_history else []
+        return {
+            'id': chat_id,
+            'title': meta['title'],
+            'history': history,
+            'created_at': meta['created_at'],
+        }
+
+    def create_chat(self, user_id, chat_id, title, history):
+        self._ensure_time_index(user_id) # Before the new chat exists, so older chats are indexed too
+        created_at = time.time()
+        self._rewrite_history(user_id, chat_id, history)
+        self.client.hset(self._meta_key(user_id), chat_id, json.dumps({'title': title, 'created_at': created_at}))
+        self.client.zadd(self._time_index_key(user_id), {chat_id: created_at})
+        self._update_search_index('replace_chat', user_id, chat_id, title, history)
+
+    def import_chats(self, user_id, chats):
+        if not chats:
+            return []
+        self._ensure_time_index(user_id)
+        existing = self.client.hmget(self._meta_key(user_id), [chat['id'] for chat in chats])
+        new_chats = [chat for chat, meta in zip(chats, existing) if meta is None]
+        if not new_chats:
+            return []
+        pipe = self.client.pipeline()
+        for chat in new_chats:
+            pipe.delete(self._history_key(user_id, chat['id']), self._legacy_history_key(user_id, chat['id']))
+            pipe.rpush(self._history_key(user_id, chat['id']), encode_block(chat['history']))
+        # Metadata last, as in create_chat(): a chat is listed only once its history is in place
+        pipe.hset(self._meta_key(user_id), mapping={
+            chat['id']: json.dumps({'title': chat['title'], 'created_at': chat['created_at']}) for chat in new_chats
+        })
+        pipe.zadd(self._time_index_key(user_id), {chat['id']: chat['created_at'] for chat in new_chats})
+        pipe.execute()
+        for chat in new_chats:
+            self._update_search_index('replace_chat', user_id, chat['id'], chat['title'], chat['history'])
+        return [chat['id'] for chat in new_chats]
+
+    def save_history(self, user_id, chat_id, history):
+        meta_key = self._meta_key(user_id)
+        appended = appended_messages(history)
+        # Encoded once, outside write(), which may run more than once
+        block = encode_block(history) if appended is None else encode_block(appended) if appended else None
+
+        def write(pipe):
+            """ Runs under WATCH: if the chat is deleted before EXEC, redis-py retries it and nothing is written. """
+            if not pipe.hexists(meta_key, chat_id):
+                return False
+            pipe.multi()
+            if appended is None:
+                self._queue_rewrite(pipe, user_id, chat_id, block)
+            elif appended:
+                pipe.rpush(self._history_key(user_id, chat_id), block)
+            return True
+
+        if not self.client.transaction(write, meta_key, value_from_callable=True):
+            return False
+        if appended is None:
+            self._update_search_index('replace_messages', user_id, chat_id, history)
+        elif appended:
+            self._update_search_index('add_messages', user_id, chat_id, history.stored_length, appended)
+        if isinstance(history, StoredHistory):
+            history.stored_length = len(history)
+        return True
+
+    def update_title(self, user_id, chat_id, title, expected_title=None):
+        meta_key = self._meta_key(user_id)
+
+        def compare_and_set(pipe):
+            """ Runs under WATCH: if the metadata changes before EXEC (e.g. a rename), redis-py retries it. """
+            meta = pipe.hget(meta_key, chat_id)
+            if meta is None:
+                return False
+            meta = json.loads(meta)
+            if expected_title is not None and meta['title'] != expected_title:
+                return False
+            meta['title'] = title
+            pipe.multi()
+            pipe.hset(meta_key, chat_id, json.dumps(meta))
+            return True
+
+        if not self.client.transaction(compare_and_set, meta_key, value_from_callable=True):
+            return False
+        self._update_search_index('set_title', user_id, chat_id, title)
+        return True
+
+    def delete_chat(self, user_id, chat_id):
+        if not self.client.hdel(self._meta_key(user_id), chat_id):
+            return False
+        self.client.zrem(self._time_index_key(user_id), chat_id)
+        self.client.delete(
+            self._history_key(user_id, chat_id), self._legacy_history_key(user_id, chat_id), self._summary_key(user_id, chat_id)
+        )
+        self._update_search_index('delete_chat', user_id, chat_id)
+        return True
+
+    def _summary_key(self, user_id, chat_id):
+        return f"{self.prefix}:summary:{user_id}:{chat_id}"
+
+    def get_summary(self, user_id, chat_id):
+        summary = self.client.get(self._summary_key(user_id, chat_id))
+        return json.loads(summary) if summary else None
+
+    def save_summary(self, user_id, chat_id, summary):
+        if not self.client.hexists(self._meta_key(user_id), chat_id):
+            return False
+        self.client.set(self._summary_key(user_id, chat_id), json.dumps(summary))
+        return True
+
+    def scan_chats(self, after=None, limit=500):
+        meta_prefix = self._meta_key("")
+        user_ids = sorted(
+            (key.decode() if isinstance(key, bytes) else key)[len(meta_prefix):]
+            for key in self.client.scan_iter(match=meta_prefix + "*")
+        )
+        chats = []
+        for user_id in user_ids:
+            if after is not None and user_id < after[0]:
+                continue
+            for chat_id, meta in sorted(self.client.hgetall(self._meta_key(user_id)).items()):
+                chat_id = chat_id.decode() if isinstance(chat_id, bytes) else chat_id
+                if after is not None and (user_id, chat_id) <= tuple(after):
+                    continue
+                meta = json.loads(meta)
+                chats.append({'user_id': user_id, 'id': chat_id, 'title': meta['title'], 'created_at': meta['created_at']})
+                if len(chats) >= limit:
+                    return chats
+        return chats
+
+
+def create_chat_store(url=None):
+    """
+    Builds the store configured by CHAT_STORE_URL:
+    'sqlite:///path/to/chats.db' (default 'sqlite:///chats.db') or 'redis://host:port/db'.
+    """
+    url = url or os.getenv("CHAT_STORE_URL", "sqlite:///chats.db")
+    if url.startswith("sqlite:///"):
+        path = url[len("sqlite:///"):] or "chats.db"
+        logging.info(f"Using SQLite chat store at '{path}'")
+        return SQLiteChatStore(path)
+    if url.startswith(("redis://", "rediss://")):
+        import redis # Optional dependency, only needed for this backend
+        logging.info("Using Redis chat store")
+        return RedisChatStore(redis.Redis.from_url(url))
+    raise ValueError(f"Unsupported CHAT_STORE_URL: '{url}'")
@@ -0,0 +1,182 @@
+# circuit_breaker.py
+"""
+Circuit breaker per provider.
+
+The outcome of every upstream call goes into a rolling window (CIRCUIT_WINDOW_SECONDS). When the
+window holds at least CIRCUIT_MIN_CALLS calls and the share of failed calls or of slow calls
+reaches its threshold, the breaker opens. Calls then fail at once with CircuitOpenError instead
+of each waiting out its own timeout, so worker threads don't pile up behind a dead upstream.
+After CIRCUIT_OPEN_SECONDS the breaker is half-open and lets a single probe call through.
+A good probe closes the breaker; a failed or slow one opens it again.
+
+Only upstream faults count as failures: connection errors, timeouts and 5xx responses (see
+ChatProvider.is_upstream_failure()). Bad keys, bad requests and rate limits say nothing about the
+provider's health. Breakers are per process, and per provider rather than per API key.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import registry as metrics_registry
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+CIRCUIT_WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", "60"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10")) # No verdict on fewer calls than this
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "20")) # Time to first token
+CIRCUIT_SLOW_CALL_RATE = float(os.getenv("CIRCUIT_SLOW_CALL_RATE", "0.8"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30")) # Before the half-open probe
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of calling a provider whose breaker is open. """
+
+    def __init__(self, provider, retry_after):
+        super().__init__(f"{provider} circuit is open; next probe in {retry_after:.0f}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, name, window_seconds=60.0, min_calls=10, failure_rate=0.5,
+                 slow_call_seconds=20.0, slow_call_rate=0.8, open_seconds=30.0):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.rejected = 0 # Calls failed fast, for /metrics
+        self._calls = deque() # (finished_at, failed, slow), oldest first
+        self._failures = 0
+        self._slow = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Call before each upstream call. Returns True if the call is the half-open probe (pass that on
+        to record() / release()); raises CircuitOpenError if the call must fail fast.
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == CLOSED:
+                return False
+            if state == HALF_OPEN and not self._probe_in_flight:
+                self._state = HALF_OPEN
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            retry_after = max(0.0, self._opened_at + self.open_seconds - now)
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record(self, probe, failed, latency=None):
+        """ Reports a finished call: failed is True for upstream faults; latency (seconds) marks slow calls. """
+        now = time.monotonic()
+        slow = not failed and latency is not None and latency >= self.slow_call_seconds
+        with self._lock:
+            if probe:
+                self._probe_in_flight = False
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self._close()
+                return
+            self._calls.append((now, failed, slow))
+            self._failures += failed
+            self._slow += slow
+            self._expire(now)
+            if self._state == CLOSED and len(self._calls) >= self.min_calls:
+                if self._failures >= self.failure_rate * len(self._calls) or self._slow >= self.slow_call_rate * len(self._calls):
+                    self._open(now)
+
+    def release(self, probe):
+        """ Reports a call that says nothing about upstream health (client error, abandoned stream). """
+        if probe:
+            with self._lock:
+                self._probe_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    @property
+    def rejecting(self):
+        """ True if acquire() would fail fast right now: open, or half-open with the probe already in flight. """
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            return state == OPEN or (state == HALF_OPEN and self._probe_in_flight)
+
+    def snapshot(self):
+        """ State and window statistics, for /health. """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            state = self._current_state(now)
+            calls = len(self._calls)
+            return {
+                'state': state,
+                'calls': calls,
+                'failure_rate': round(self._failures / calls, 3) if calls else 0.0,
+                'slow_call_rate': round(self._slow / calls, 3) if calls else 0.0,
+                'rejected': self.rejected,
+                'retry_after': round(max(0.0, self._opened_at + self.open_seconds - now), 1) if state == OPEN else None,
+            }
+
+    # Called with the lock held
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            return HALF_OPEN
+        return self._state
+
+    def _open(self, now):
+        self._state = OPEN
+        self._opened_at = now
+
+    def _close(self):
+        self._state = CLOSED
+        self._calls.clear() # Start the new window from scratch
+        self._failures = self._slow = 0
+
+    def _expire(self, now):
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            _, failed, slow = self._calls.popleft()
+            self._failures -= failed
+            self._slow -= slow
+
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(provider):
+    """ Returns the process-wide breaker for provider (a ChatProvider.name). """
+    with breakers_lock:
+        breaker = breakers.get(provider)
+        if breaker is None:
+            breaker = breakers[provider] = CircuitBreaker(
+                provider, CIRCUIT_WINDOW_SECONDS, CIRCUIT_MIN_CALLS, CIRCUIT_FAILURE_RATE,
+                CIRCUIT_SLOW_CALL_SECONDS, CIRCUIT_SLOW_CALL_RATE, CIRCUIT_OPEN_SECONDS,
+            )
+        return breaker
+
+
+def collect_breaker_metrics():
+    with breakers_lock:
+        snapshot = sorted(breakers.items())
+    lines = ["# TYPE chat_circuit_breaker_open gauge"]
+    lines += [f'chat_circuit_breaker_open{{provider="{name}"}} {int(breaker.state != CLOSED)}' for name, breaker in snapshot]
+    lines.append("# TYPE chat_circuit_breaker_rejections_total counter")
+    lines += [f'chat_circuit_breaker_rejections_total{{provider="{name}"}} {breaker.rejected}' for name, breaker in snapshot]
+    return lines
+
+
+metrics_registry.add_collector(collect_breaker_metrics)
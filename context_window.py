@@ -0,0 +1,115 @@
+# context_window.py
+"""
+Token counting and token-budget fitting of chat history.
+
+GPT models are counted with tiktoken (encoders cached per model); Gemini, or GPT when
+tiktoken is unavailable, uses a characters-per-token estimate. Exact counts are memoized by a
+digest of the message text (not the text itself), so re-fitting a long history on every turn
+only tokenizes new messages.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+CHARS_PER_TOKEN_ESTIMATE = 4 # Rough average for English text
+MESSAGE_OVERHEAD_TOKENS = 4 # Role/separator tokens per message in the chat format
+REPLY_PRIMING_TOKENS = 3 # Every reply is primed with <|start|>assistant<|message|>
+ENCODING_RETRY_SECONDS = 300 # After a failed encoding load (e.g. a download error), estimate until retrying
+
+_encodings = {} # model -> tiktoken encoding; successful loads only
+_encoding_failed_at = {} # model -> time.monotonic() of the last failed load
+_tiktoken_missing = False
+
+TOKEN_COUNT_CACHE_SIZE = 8192
+_token_counts = OrderedDict() # (text digest, model) -> token count, least recently used first
+_token_counts_lock = threading.Lock()
+
+
+def get_tiktoken_encoding(model):
+    """
+    Returns the cached tiktoken encoding for model, or None if tiktoken can't be used. A failed load
+    is retried after ENCODING_RETRY_SECONDS, so a transient error doesn't disable exact counts for good.
+    """
+    global _tiktoken_missing
+    encoding = _encodings.get(model)
+    if encoding is not None or _tiktoken_missing:
+        return encoding
+    failed_at = _encoding_failed_at.get(model)
+    if failed_at is not None and time.monotonic() - failed_at < ENCODING_RETRY_SECONDS:
+        return None
+    try:
+        import tiktoken # Optional dependency; only needed for exact GPT counts
+    except ImportError:
+        logging.info("tiktoken not installed; estimating GPT token counts from text length.")
+        _tiktoken_missing = True
+        return None
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e: # e.g. encoding files can't be downloaded
+        logging.warning(f"Could not load tiktoken encoding for {model}: {e}. Estimating token counts for {ENCODING_RETRY_SECONDS}s.")
+        _encoding_failed_at[model] = time.monotonic()
+        return None
+    _encodings[model] = encoding
+    _encoding_failed_at.pop(model, None)
+    return encoding
+
+
+def count_text_tokens(text, model):
+    """ Number of tokens in text for model. """
+    encoding = get_tiktoken_encoding(model) if model.startswith("gpt") else None
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN_ESTIMATE) # Ceiling division; cheap enough not to cache
+    key = (hashlib.blake2b(text.encode(), digest_size=16).digest(), model) # Bounded memory whatever the message length
+    with _token_counts_lock:
+        count = _token_counts.get(key)
+        if count is not None:
+            _token_counts.move_to_end(key)
+            return count
+    count = len(encoding.encode(text)) # Outside the lock: tokenizing a long text takes a while
+    with _token_counts_lock:
+        _token_counts[key] = count
+        if len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return count
+
+
+def count_message_tokens(message, model):
+    return count_text_tokens(message.get('content', ''), model) + MESSAGE_OVERHEAD_TOKENS
+
+
+def count_history_tokens(history, model):
+    return sum(count_message_tokens(msg, model) for msg in history) + REPLY_PRIMING_TOKENS
+
+
+def fit_history(history, model, token_budget):
+    """
+    Returns (prompt_history, dropped_messages).
+
+    history is [system message, ..., newest user message]. The system message and the newest
+    message are always kept; older messages are added newest-first while they fit the budget.
+    The kept turns always start with a user message (Gemini rejects a history that starts with
+    the model's turn), and dropped_messages are the older messages left out, oldest first.
+    """
+    if len(history) <= 2:
+        return list(history), []
+
+    system_message, older_messages, newest_message = history[0], history[1:-1], history[-1]
+    used = count_message_tokens(system_message, model) + count_message_tokens(newest_message, model) + REPLY_PRIMING_TOKENS
+
+    start = len(older_messages)
+    while start > 0:
+        cost = count_message_tokens(older_messages[start - 1], model)
+        if used + cost > token_budget:
+            break
+        used += cost
+        start -= 1
+
+    while start < len(older_messages) and older_messages[start].get('role') != 'user':
+        start += 1
+
+    return [system_message] + older_messages[start:] + [newest_message], older_messages[:start]
@@ -0,0 +1,64 @@
+# fan_out.py
+"""
+Runs one chat turn against several providers at once ('fan_out' in the /chat request body).
+
+hedge:   returns the first successful answer and cancels the other calls, so one slow or failing
+         provider no longer sets the latency of the turn.
+compare: waits for every answer and returns them all, in request order.
+
+On the WSGI path a call is a function of a threading.Event, which is set once its answer is no
+longer wanted; the call should stop early and return None. On the ASGI path calls are coroutine
+functions and are cancelled the asyncio way.
+"""
+import asyncio
+import threading
+from concurrent.futures import as_completed
+
+FAN_OUT_MODES = ('hedge', 'compare')
+
+
+def hedge(executor, calls, succeeded):
+    """
+    Runs calls concurrently on executor. Returns the first result for which succeeded(result) is true;
+    if none is, the first call's result. The other calls are cancelled as soon as the result is known.
+    """
+    cancelled = threading.Event()
+    futures = [executor.submit(call, cancelled) for call in calls]
+    try:
+        for future in as_completed(futures):
+            result = future.result()
+            if succeeded(result):
+                return result
+        return futures[0].result()
+    finally:
+        cancelled.set()
+        for future in futures:
+            future.cancel() # Drops calls still queued for a worker
+
+
+def compare(executor, calls):
+    """ Runs calls concurrently on executor and returns all results, in order. """
+    cancelled = threading.Event() # Never set: every answer is wanted
+    futures = [executor.submit(call, cancelled) for call in calls]
+    return [future.result() for future in futures]
+
+
+async def hedge_async(calls, succeeded):
+    """ Async counterpart of hedge(); the losing tasks are cancelled. """
+    tasks = [asyncio.ensure_future(call()) for call in calls]
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks: # Request order breaks ties between calls finishing together
+                if task in done and succeeded(task.result()):
+                    return task.result()
+        return tasks[0].result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def compare_async(calls):
+    """ Async counterpart of compare(). """
+    return list(await asyncio.gather(*(call() for call in calls)))
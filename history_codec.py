@@ -0,0 +1,104 @@
+# history_codec.py
+"""
+Compact binary encoding of chat histories (used by chat_store.py).
+
+A stored history is a sequence of blocks, normally one per saved turn holding just the messages
+that turn added. Saving a turn therefore costs the size of the turn, not of the whole conversation.
+A block is one format byte followed by its records, compressed unless that wouldn't make them smaller.
+A record is a role byte plus the varint length and UTF-8 bytes of the content. A message with
+another role, non-text content or extra keys is kept as a JSON record (role byte 0xFF).
+
+Blocks are compressed with zstd when the optional 'zstandard' package is installed, otherwise
+with zlib. Either build reads zlib and uncompressed blocks; zstd blocks need zstandard.
+"""
+import json
+import zlib
+
+try:
+    import zstandard # Optional dependency; better ratio and speed than zlib on short texts
+except ImportError:
+    zstandard = None
+
+ROLE_CODES = {'system': 0, 'user': 1, 'assistant': 2}
+ROLES = {code: role for role, code in ROLE_CODES.items()}
+JSON_RECORD = 0xFF
+RAW, ZLIB, ZSTD = b'r', b'z', b's'
+COMPRESSION_LEVEL = 6
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_records(messages):
+    out = bytearray()
+    for message in messages:
+        role_code = ROLE_CODES.get(message.get('role'))
+        if role_code is not None and isinstance(message.get('content'), str) and len(message) == 2:
+            payload = message['content'].encode('utf-8')
+        else:
+            role_code, payload = JSON_RECORD, json.dumps(message).encode('utf-8')
+        out.append(role_code)
+        _write_varint(out, len(payload))
+        out += payload
+    return bytes(out)
+
+
+def decode_records(data):
+    messages = []
+    pos = 0
+    while pos < len(data):
+        role_code = data[pos]
+        length, pos = _read_varint(data, pos + 1)
+        payload = data[pos:pos + length].decode('utf-8')
+        pos += length
+        messages.append(json.loads(payload) if role_code == JSON_RECORD else {'role': ROLES[role_code], 'content': payload})
+    return messages
+
+
+def encode_block(messages):
+    """ Encodes messages (a list of history dicts) into one block. """
+    records = encode_records(messages)
+    if zstandard is not None:
+        fmt, compressed = ZSTD, zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(records)
+    else:
+        fmt, compressed = ZLIB, zlib.compress(records, COMPRESSION_LEVEL)
+    if len(compressed) >= len(records): # Short turns often don't compress
+        return RAW + records
+    return fmt + compressed
+
+
+def decode_block(block):
+    block = bytes(block)
+    fmt, payload = block[:1], block[1:]
+    if fmt == ZLIB:
+        payload = zlib.decompress(payload)
+    elif fmt == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("History block is zstd-compressed, but the 'zstandard' package is not installed")
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    elif fmt != RAW:
+        raise ValueError(f"Unknown history block format {fmt!r}")
+    return decode_records(payload)
+
+
+def decode_blocks(blocks):
+    """ Decodes a stored block sequence back into one history list. """
+    history = []
+    for block in blocks:
+        history.extend(decode_block(block))
+    return history
@@ -0,0 +1,152 @@
+# llm_clients.py
+"""
+Shared, cached LLM client instances.
+
+Building an OpenAI client or a Gemini service client per request throws away its HTTP/gRPC
+connection pool (and TLS sessions). The registry keeps a bounded, LRU-evicted set of clients
+keyed by (provider, API key hash, options) that every gunicorn thread can share.
+
+The SDKs themselves (openai, google.generativeai) are imported on first use, not at startup:
+together they take most of a worker's boot time and memory, and a worker may never need one of
+them. Error handling uses sdk_exceptions(), which never imports an SDK. Set PRELOAD_LLM_SDKS
+(e.g. 'openai,gemini') to import them at startup anyway, e.g. before gunicorn --preload forks.
+"""
+import hashlib
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+def sdk_exceptions(module, *names):
+    """
+    The named exception classes of an SDK module (e.g. 'openai', 'google.api_core.exceptions'), for
+    `except` clauses and isinstance(). Returns () if the module hasn't been imported: none of its
+    exceptions can have been raised then, and an empty tuple matches nothing.
+    """
+    sdk = sys.modules.get(module)
+    if sdk is None:
+        return ()
+    return tuple(getattr(sdk, name) for name in names)
+
+
+def preload_sdks(names=None):
+    """ Imports the SDKs named in names (default: the PRELOAD_LLM_SDKS env var): 'openai' and/or 'gemini'. """
+    if names is None:
+        names = [name.strip() for name in os.getenv("PRELOAD_LLM_SDKS", "").split(",") if name.strip()]
+    for name in names:
+        if name == 'openai':
+            import openai
+        elif name == 'gemini':
+            import google.generativeai
+            import google.ai.generativelanguage
+            import google.api_core.exceptions
+        else:
+            raise ValueError(f"Unknown LLM SDK '{name}' (expected 'openai' or 'gemini')")
+
+
+class ClientRegistry:
+    """ Thread-safe LRU cache of client objects. """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(provider, api_key, **options):
+        """ Never keeps the raw key in the cache key, only its hash. """
+        key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+        return (provider, key_hash, tuple(sorted(options.items())))
+
+    def get(self, key, factory):
+        """ Returns the cached client for key, building it with factory() on a miss. """
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+
+        client = factory() # Built outside the lock; a concurrent miss for the same key just loses the race below
+
+        with self._lock:
+            existing = self._clients.get(key)
+            if existing is not None:
+                self._clients.move_to_end(key)
+                return existing
+            self._clients[key] = client
+            if len(self._clients) > self.max_size:
+                # Evicted clients are not closed explicitly: another thread may still be mid-request with it.
+                # Their connection pools are released when the last reference goes away.
+                evicted_key, _ = self._clients.popitem(last=False)
+                logging.info(f"Evicted cached {evicted_key[0]} client (registry size {self.max_size})")
+        return client
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+    def __len__(self):
+        return len(self._clients)
+
+
+client_registry = ClientRegistry(max_size=int(os.getenv("LLM_CLIENT_CACHE_SIZE", "64")))
+
+
+def get_openai_client(api_key, **options):
+    """ Returns a shared OpenAI client for this key; options (e.g. max_retries) are passed to the constructor. """
+    from openai import OpenAI # Imported on first use (see module docstring)
+    key = ClientRegistry.make_key("openai", api_key, **options)
+    return client_registry.get(key, lambda: OpenAI(api_key=api_key, **options))
+
+
+def get_gemini_model(api_key, model_name):
+    """
+    Returns a shared GenerativeModel bound to its own service client for this key.
+
+    genai.configure() swaps a process-wide default client, which is neither cheap nor safe when
+    threads serve different users' keys, so each model gets an explicit per-key client instead.
+    GenerativeModel holds no conversation state (start_chat() returns a new ChatSession), so it can be shared.
+    """
+    import google.generativeai as genai
+    from google.ai import generativelanguage as glm
+    service_key = ClientRegistry.make_key("gemini", api_key)
+    service_client = client_registry.get(
+        service_key, lambda: glm.GenerativeServiceClient(client_options={"api_key": api_key})
+    )
+
+    def build_model():
+        model = genai.GenerativeModel(model_name)
+        model._client = service_client # Used instead of the global default client when set
+        return model
+
+    model_key = ClientRegistry.make_key("gemini-model", api_key, model=model_name)
+    return client_registry.get(model_key, build_model)
+
+
+def get_async_openai_client(api_key, **options):
+    """ Async counterpart of get_openai_client(), for the ASGI entry point (asgi.py). """
+    from openai import AsyncOpenAI
+    key = ClientRegistry.make_key("openai-async", api_key, **options)
+    return client_registry.get(key, lambda: AsyncOpenAI(api_key=api_key, **options))
+
+
+def get_async_gemini_model(api_key, model_name):
+    """
+    Async counterpart of get_gemini_model(). The grpc.aio channel binds to the event loop
+    that first uses it, so call this from inside the serving loop (one per ASGI worker).
+    """
+    import google.generativeai as genai
+    from google.ai import generativelanguage as glm
+    service_key = ClientRegistry.make_key("gemini-async", api_key)
+    service_client = client_registry.get(
+        service_key, lambda: glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+    )
+
+    def build_model():
+        model = genai.GenerativeModel(model_name)
+        model._async_client = service_client # Used instead of the global default async client when set
+        return model
+
+    model_key = ClientRegistry.make_key("gemini-async-model", api_key, model=model_name)
+    return client_registry.get(model_key, build_model)
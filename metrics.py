@@ -0,0 +1,140 @@
+# metrics.py
+"""
+Minimal in-process metrics with Prometheus text exposition (served at /metrics).
+
+Counters and histograms are keyed by label values and guarded by a lock; rendering walks
+them once per scrape. Values are per process: with several gunicorn/uvicorn workers, scrape
+each worker or aggregate in Prometheus.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers quick store reads up to slow completions
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {} # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observes the duration of the with-block (also when it raises). """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """ collect() returns exposition lines computed at scrape time (e.g. gauges read from another object). """
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            lines.extend(collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# Per-stage latency of a chat turn. Stages: session_load, history_normalization, title_generation,
+# upstream_ttft, upstream_total, history_trim, session_serialization
+CHAT_STAGE_SECONDS = registry.histogram(
+    "chat_stage_seconds", "Time spent in each stage of a chat request.", ["stage", "provider", "model"]
+)
+UPSTREAM_ERRORS = registry.counter(
+    "chat_upstream_errors_total", "Failed LLM provider calls by exception class.", ["provider", "model", "exception"]
+)
+# Only for models with a price in the model catalog (model_catalog.py); token counts are local estimates
+UPSTREAM_TOKENS = registry.counter(
+    "chat_upstream_tokens_total", "Tokens sent to and received from LLM providers.", ["provider", "model", "kind"]
+)
+UPSTREAM_COST_USD = registry.counter(
+    "chat_upstream_cost_usd_total", "Estimated LLM provider spend at the catalog's prices.", ["provider", "model"]
+)
+COALESCED_REQUESTS = registry.counter(
+    "chat_coalesced_requests_total", "Duplicate chat submissions answered from an in-flight turn.", ["endpoint"]
+)
+
+
+def time_stage(stage, provider, model):
+    """ Context manager timing one chat stage into CHAT_STAGE_SECONDS. """
+    return CHAT_STAGE_SECONDS.time(stage=stage, provider=provider, model=model)
@@ -0,0 +1,220 @@
+# model_catalog.py
+"""
+Model catalog: the models clients may pick and the limits the server applies to each.
+
+Entries are keyed by the model_choice clients send (the model picker, /chat's 'model_choice').
+Each names its backend ('openai', 'gemini' or 'mock') and upstream model, plus:
+
+    label                 shown in the model picker
+    max_tokens            reply cap sent upstream (null: the provider's default)
+    temperature           null: the provider's default
+    timeout_seconds       per upstream call
+    context_token_budget  prompt history budget (see context_window.py)
+    input_cost_per_1k     USD per 1K prompt tokens (cost metrics, title routing)
+    output_cost_per_1k    USD per 1K reply tokens
+    title_model           upstream model for this entry's titles and summaries; default: the
+                          cheapest priced catalog model on the same backend, else the entry's own
+    fallback              model_choice that serves this entry's chats while its circuit breaker is
+                          open (see circuit_breaker.py); must be another enabled entry
+    enabled               false hides the entry without deleting it
+
+'default' is the model_choice used when a request names none. Example file:
+
+    {"default": "gemini-flash",
+     "models": {
+        "gpt-4o-mini":  {"provider": "openai", "model": "gpt-4o-mini", "max_tokens": 1024,
+                         "input_cost_per_1k": 0.00015, "output_cost_per_1k": 0.0006},
+        "gemini-flash": {"provider": "gemini", "model": "gemini-1.5-flash", "timeout_seconds": 30}}}
+
+The catalog comes from the JSON file at MODEL_CATALOG_PATH, else from inline JSON in MODEL_CATALOG,
+else the built-in 'gpt' and 'gemini' entries (OPENAI_CHAT_MODEL, GEMINI_CHAT_MODEL, PROVIDER_FALLBACKS, ...
+as before).
+The file is re-read when its modification time changes, checked at most every
+MODEL_CATALOG_RELOAD_SECONDS, so models, limits and routing change without a redeploy. A file that
+fails validation is logged and the catalog in use stays as it was.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+BACKENDS = ('openai', 'gemini', 'mock')
+DEFAULT_TIMEOUT_SECONDS = 60.0
+DEFAULT_CONTEXT_TOKEN_BUDGET = 3000
+MOCK_TITLE_MODEL = "mock-title" # The mock answers title prompts on this model with a short title (providers.MockProvider)
+MOCK_PROVIDER_ENABLED = os.getenv("MOCK_PROVIDER_ENABLED", "false").lower() in ("1", "true", "yes")
+
+
+class CatalogError(ValueError):
+    """ The catalog configuration is invalid. """
+
+
+def builtin_catalog():
+    """ The catalog used when none is configured: the original gpt/gemini setup. """
+    models = {
+        'gpt': {
+            'provider': 'openai',
+            'model': os.getenv("OPENAI_CHAT_MODEL", "gpt-3.5-turbo"),
+            'title_model': os.getenv("OPENAI_TITLE_MODEL", "gpt-3.5-turbo"),
+            'label': "GPT (OpenAI)",
+            'temperature': 0.7,
+            'max_tokens': 150,
+            'context_token_budget': 3000,
+        },
+        'gemini': {
+            'provider': 'gemini',
+            'model': os.getenv("GEMINI_CHAT_MODEL", "gemini-1.5-flash-latest"),
+            'title_model': os.getenv("GEMINI_TITLE_MODEL", "gemini-1.5-flash-latest"), # Use a fast model for titles
+            'label': "Gemini (Google)",
+            'context_token_budget': 8000,
+        },
+    }
+    fallbacks = json.loads(os.getenv("PROVIDER_FALLBACKS", '{"gpt": "gemini", "gemini": "gpt"}')) # model_choice -> model_choice
+    for model_choice, spec in models.items():
+        spec['fallback'] = fallbacks.get(model_choice)
+    return {'default': 'gemini', 'models': models}
+
+
+def mock_entry():
+    return {
+        'provider': 'mock',
+        'model': "mock-echo",
+        'label': "Mock (Local Echo)",
+        'latency_seconds': float(os.getenv("MOCK_LATENCY_SECONDS", "0.5")),
+        'tokens_per_second': float(os.getenv("MOCK_TOKENS_PER_SECOND", "50")),
+    }
+
+
+def _number(spec, field, model_choice, default=None, minimum=0.0):
+    value = spec.get(field, default)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < minimum:
+        raise CatalogError(f"Model '{model_choice}': '{field}' must be a number >= {minimum}")
+    return value
+
+
+def parse_catalog(raw):
+    """
+    Validates a catalog ({'default': ..., 'models': {model_choice: entry}}) and fills in defaults.
+    Returns {'default': model_choice, 'models': {model_choice: entry}}; raises CatalogError.
+    """
+    if not isinstance(raw, dict) or not isinstance(raw.get('models'), dict):
+        raise CatalogError("The catalog must be a JSON object with a 'models' object")
+    models = {}
+    for model_choice, spec in raw['models'].items():
+        if not isinstance(spec, dict):
+            raise CatalogError(f"Model '{model_choice}' must be an object")
+        if spec.get('enabled', True) is False:
+            continue
+        backend = spec.get('provider')
+        if backend not in BACKENDS:
+            raise CatalogError(f"Model '{model_choice}': 'provider' must be one of {', '.join(BACKENDS)}")
+        if backend == 'mock' and not MOCK_PROVIDER_ENABLED:
+            logging.warning(f"Skipping mock model '{model_choice}': MOCK_PROVIDER_ENABLED is not set")
+            continue
+        if not isinstance(spec.get('model'), str) or not spec['model']:
+            raise CatalogError(f"Model '{model_choice}': 'model' (the upstream model name) is required")
+        if spec.get('label') is not None and not isinstance(spec['label'], str):
+            raise CatalogError(f"Model '{model_choice}': 'label' must be a string")
+        max_tokens = _number(spec, 'max_tokens', model_choice, minimum=1)
+        models[model_choice] = {
+            **spec,
+            'label': spec.get('label') or model_choice,
+            'max_tokens': int(max_tokens) if max_tokens is not None else None,
+            'temperature': _number(spec, 'temperature', model_choice),
+            'timeout_seconds': _number(spec, 'timeout_seconds', model_choice, DEFAULT_TIMEOUT_SECONDS, minimum=0.1),
+            'context_token_budget': int(_number(spec, 'context_token_budget', model_choice, DEFAULT_CONTEXT_TOKEN_BUDGET, minimum=1)),
+            'input_cost_per_1k': _number(spec, 'input_cost_per_1k', model_choice, 0.0),
+            'output_cost_per_1k': _number(spec, 'output_cost_per_1k', model_choice, 0.0),
+        }
+    if MOCK_PROVIDER_ENABLED and not any(spec['provider'] == 'mock' for spec in models.values()):
+        models.setdefault('mock', parse_catalog({'models': {'mock': mock_entry()}})['models']['mock'])
+    if not models:
+        raise CatalogError("The catalog has no enabled models")
+
+    for model_choice, spec in models.items():
+        if not spec.get('title_model') and spec['provider'] == 'mock':
+            spec['title_model'] = MOCK_TITLE_MODEL
+        if not spec.get('title_model'):
+            spec['title_model'] = cheapest_model(models, spec['provider']) or spec['model']
+        fallback = spec.get('fallback')
+        if fallback is not None and not isinstance(fallback, str):
+            raise CatalogError(f"Model '{model_choice}': 'fallback' must be a model_choice string")
+        if fallback is not None and (fallback not in models or fallback == model_choice):
+            # Not an error: disabling a model shouldn't invalidate the entries that fall back to it
+            logging.warning(f"Model '{model_choice}': ignoring fallback '{fallback}', which is not another enabled catalog model")
+            fallback = None
+        spec['fallback'] = fallback
+    default = raw.get('default')
+    if default is None:
+        default = next(iter(models))
+    if default not in models:
+        raise CatalogError(f"Default model '{default}' is not an enabled catalog model")
+    return {'default': default, 'models': models}
+
+
+def cheapest_model(models, backend):
+    """ The upstream model on backend with the lowest price per token, or None if none of them is priced. """
+    priced = [
+        (spec['output_cost_per_1k'] + spec['input_cost_per_1k'], spec['model'])
+        for spec in models.values()
+        if spec['provider'] == backend and spec['output_cost_per_1k'] + spec['input_cost_per_1k'] > 0
+    ]
+    return min(priced)[1] if priced else None
+
+
+class CatalogSource:
+    """ Loads the configured catalog and reloads it when the catalog file changes. """
+
+    def __init__(self, path=None, inline=None, reload_seconds=5.0):
+        self.path = path
+        self.inline = inline
+        self.reload_seconds = reload_seconds
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Returns the parsed catalog; raises CatalogError (or OSError for an unreadable file). """
+        if self.path:
+            self._mtime = os.path.getmtime(self.path)
+            with open(self.path) as f:
+                raw = f.read()
+            source = f"'{self.path}'"
+        elif self.inline:
+            raw, source = self.inline, "MODEL_CATALOG"
+        else:
+            return parse_catalog(builtin_catalog())
+        try:
+            raw = json.loads(raw)
+        except ValueError as e:
+            raise CatalogError(f"Model catalog {source} is not valid JSON: {e}") from e
+        return parse_catalog(raw)
+
+    def reload_if_changed(self):
+        """ Returns the new catalog if the file changed since the last load and is valid, else None. Cheap to call per request. """
+        if not self.path or time.monotonic() < self._next_check:
+            return None
+        with self._lock:
+            if time.monotonic() < self._next_check: # Another thread just checked
+                return None
+            self._next_check = time.monotonic() + self.reload_seconds
+            try:
+                if os.path.getmtime(self.path) == self._mtime:
+                    return None
+                catalog = self.load()
+            except (OSError, CatalogError) as e:
+                logging.error(f"Keeping the current model catalog; reload failed: {e}")
+                return None
+        logging.info(f"Reloaded model catalog from '{self.path}': {', '.join(catalog['models'])}")
+        return catalog
+
+
+def create_catalog_source():
+    return CatalogSource(
+        path=os.getenv("MODEL_CATALOG_PATH") or None,
+        inline=os.getenv("MODEL_CATALOG") or None,
+        reload_seconds=float(os.getenv("MODEL_CATALOG_RELOAD_SECONDS", "5")),
+    )
@@ -0,0 +1,626 @@
+# providers.py
+"""
+LLM backends behind one interface.
+
+A ChatProvider knows its models, how to call its SDK (sync and async, complete and stream),
+how to count tokens, which of its exceptions mean "rate limited", and how its errors are
+shown to the user. Every call goes through the (provider, API key) rate limiter and the
+provider's circuit breaker (circuit_breaker.py). The SDKs are imported on first use (see
+llm_clients.py), so their exceptions are matched with openai_errors() / google_errors().
+chat(), chat_stream(), title generation, the rolling summary and asgi.py only talk to this
+interface; get_provider(model_choice) picks the backend. The registry is built from the model
+catalog (model_catalog.py) and rebuilt when the catalog file changes.
+
+MockProvider is a deterministic, keyless echo backend with configurable latency and token
+rate, for load tests and local development (MOCK_PROVIDER_ENABLED=true).
+"""
+import asyncio
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from circuit_breaker import get_circuit_breaker
+from context_window import count_history_tokens, count_text_tokens
+from metrics import CHAT_STAGE_SECONDS, UPSTREAM_ERRORS, UPSTREAM_TOKENS, UPSTREAM_COST_USD
+from llm_clients import get_openai_client, get_gemini_model, get_async_openai_client, get_async_gemini_model, sdk_exceptions
+from model_catalog import create_catalog_source
+from rate_limiter import get_rate_limiter
+from response_cache import make_cache_key
+
+# Client-side scheduling per (provider, API key); limits themselves are configured in rate_limiter.py
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_MAX_WAIT", "10")) # Longest a request may queue (incl. 429 backoff)
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "2")) # Retries after upstream 429s
+
+
+def openai_errors(*names):
+    """ The named openai exception classes, or () while openai hasn't been imported (see llm_clients.sdk_exceptions()). """
+    return sdk_exceptions('openai', *names)
+
+
+def google_errors(*names):
+    """ The named google.api_core.exceptions classes, or () while that module hasn't been imported. """
+    return sdk_exceptions('google.api_core.exceptions', *names)
+
+
+class ProviderResponseError(Exception):
+    """ The provider answered, but with nothing usable (blocked or empty). The message is shown to the user. """
+
+
+class ChatProvider:
+    """
+    Base class. messages are in the stored chat format ([system, ..., newest user message]);
+    model defaults to the provider's chat model, temperature/max_tokens to its chat settings.
+    timeout_seconds bounds each upstream call; label is the catalog entry's name in the model picker.
+    """
+
+    name = None # Rate limiter / cache namespace
+    display_name = None # Used in user-facing messages
+    api_key_field = None # Session key holding this provider's API key; None if it needs none
+    supports_system_messages = True
+
+    def __init__(self, chat_model, title_model, temperature=None, max_tokens=None,
+                 reply_token_estimate=512, context_token_budget=3000, timeout_seconds=None, label=None):
+        self.chat_model = chat_model
+        self.title_model = title_model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.timeout_seconds = timeout_seconds
+        self.label = label or self.display_name
+        self.reply_token_estimate = reply_token_estimate # Assumed reply size when max_tokens is unset
+        self.context_token_budget = context_token_budget
+
+    @property
+    def requires_api_key(self):
+        return self.api_key_field is not None
+
+    # --- Public interface ---
+
+    def complete(self, api_key, messages, model=None, temperature=None, max_tokens=None, max_retries=None):
+        """ Returns the reply text. Raises the SDK's exceptions or ProviderResponseError. """
+        model, temperature, max_tokens = self._resolve(model, temperature, max_tokens)
+
+        with self._track_call(model) as outcome:
+            def call():
+                started = time.perf_counter() # Per attempt, after any rate-limit wait
+                text = self._complete(api_key, messages, model, temperature, max_tokens, max_retries)
+                self._observe_upstream(model, started, time.perf_counter(), outcome)
+                self._record_usage(model, messages, text)
+                return text
+
+            return self._schedule(api_key, self.estimate_request_tokens(messages, model, max_tokens), call)
+
+    def stream(self, api_key, messages, model=None, temperature=None, max_tokens=None, max_retries=None):
+        """ Generator of reply text chunks; the request is scheduled and sent when iteration starts. """
+        model, temperature, max_tokens = self._resolve(model, temperature, max_tokens)
+        attempt_started = []
+
+        def open_stream():
+            attempt_started.append(time.perf_counter())
+            return self._open_stream(api_key, messages, model, temperature, max_tokens, max_retries)
+
+        with self._track_call(model) as outcome:
+            response = self._schedule(api_key, self.estimate_request_tokens(messages, model, max_tokens), open_stream)
+            first_token_at = None
+            reply = []
+            for text in self._iter_stream(response):
+                first_token_at = first_token_at or time.perf_counter()
+                reply.append(text)
+                yield text
+            self._observe_upstream(model, attempt_started[-1], first_token_at, outcome)
+            self._record_usage(model, messages, "".join(reply))
+
+    async def complete_async(self, api_key, messages, model=None, temperature=None, max_tokens=None):
+        """ Async counterpart of complete(), for asgi.py. """
+        model, temperature, max_tokens = self._resolve(model, temperature, max_tokens)
+
+        with self._track_call(model) as outcome:
+            async def call():
+                started = time.perf_counter()
+                text = await self._complete_async(api_key, messages, model, temperature, max_tokens)
+                self._observe_upstream(model, started, time.perf_counter(), outcome)
+                self._record_usage(model, messages, text)
+                return text
+
+            return await self._schedule_async(api_key, self.estimate_request_tokens(messages, model, max_tokens), call)
+
+    async def stream_async(self, api_key, messages, model=None, temperature=None, max_tokens=None):
+        """ Async counterpart of stream(). """
+        model, temperature, max_tokens = self._resolve(model, temperature, max_tokens)
+        attempt_started = []
+
+        def open_stream():
+            attempt_started.append(time.perf_counter())
+            return self._open_stream_async(api_key, messages, model, temperature, max_tokens)
+
+        with self._track_call(model) as outcome:
+            response = await self._schedule_async(api_key, self.estimate_request_tokens(messages, model, max_tokens), open_stream)
+            first_token_at = None
+            reply = []
+            async for text in self._iter_stream_async(response):
+                first_token_at = first_token_at or time.perf_counter()
+                reply.append(text)
+                yield text
+            self._observe_upstream(model, attempt_started[-1], first_token_at, outcome)
+            self._record_usage(model, messages, "".join(reply))
+
+    def count_tokens(self, messages, model=None):
+        return count_history_tokens(messages, model or self.chat_model)
+
+    def estimate_request_tokens(self, messages, model=None, max_tokens=None):
+        """ Prompt tokens plus expected reply tokens, charged against the key's tokens-per-minute budget. """
+        return self.count_tokens(messages, model) + (max_tokens or self.reply_token_estimate)
+
+    def cache_key(self, messages, model=None, temperature=None, max_tokens=None):
+        """ Response-cache key for this request (see response_cache.make_cache_key()). """
+        model, temperature, max_tokens = self._resolve(model, temperature, max_tokens)
+        return make_cache_key(self.name, model, temperature, messages, max_tokens=max_tokens)
+
+    def is_rate_limit_error(self, e):
+        return False
+
+    def is_upstream_failure(self, e):
+        """ True if e means the provider itself is failing (counts against its circuit breaker, see circuit_breaker.py). """
+        return isinstance(e, (ConnectionError, TimeoutError))
+
+    def describe_error(self, e, chat_id):
+        """ Maps an exception from one of this provider's calls to (bot_response_content, status_code, is_api_error). """
+        logging.error(f"Unexpected error calling {self.display_name} API: {e}", exc_info=True)
+        return f"ERROR: An unexpected error occurred with the {self.display_name} API.", 500, False
+
+    # --- Backend hooks ---
+
+    def _complete(self, api_key, messages, model, temperature, max_tokens, max_retries):
+        raise NotImplementedError
+
+    def _open_stream(self, api_key, messages, model, temperature, max_tokens, max_retries):
+        raise NotImplementedError
+
+    def _iter_stream(self, response):
+        raise NotImplementedError
+
+    async def _complete_async(self, api_key, messages, model, temperature, max_tokens):
+        raise NotImplementedError
+
+    async def _open_stream_async(self, api_key, messages, model, temperature, max_tokens):
+        raise NotImplementedError
+
+    async def _iter_stream_async(self, response):
+        raise NotImplementedError
+        yield # pragma: no cover (makes this an async generator)
+
+    # --- Helpers ---
+
+    @contextmanager
+    def _track_call(self, model):
+        """
+        Wraps one call: fails fast with CircuitOpenError while the provider's breaker is open, reports the
+        outcome to the breaker, and counts exceptions (rate limiter and breaker rejections included) by
+        class in UPSTREAM_ERRORS. Yields a dict that _observe_upstream() fills with the call's latency.
+        """
+        breaker = get_circuit_breaker(self.name)
+        try:
+            probe = breaker.acquire()
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(provider=self.name, model=model, exception=type(e).__name__)
+            raise
+        outcome = {}
+        reported = False
+        try:
+            yield outcome
+            breaker.record(probe, failed=False, latency=outcome.get('latency'))
+            reported = True
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(provider=self.name, model=model, exception=type(e).__name__)
+            if self.is_upstream_failure(e):
+                breaker.record(probe, failed=True)
+                reported = True
+            raise
+        finally:
+            if not reported: # Client-side error, or a stream closed early
+                breaker.release(probe)
+
+    def _observe_upstream(self, model, started, first_token_at, outcome):
+        """
+        Records time to first token (None if nothing arrived) and total time of one upstream call;
+        the time to first token is also the latency the circuit breaker judges.
+        """
+        now = time.perf_counter()
+        if first_token_at is not None:
+            CHAT_STAGE_SECONDS.observe(first_token_at - started, stage='upstream_ttft', provider=self.name, model=model)
+        CHAT_STAGE_SECONDS.observe(now - started, stage='upstream_total', provider=self.name, model=model)
+        outcome['latency'] = (first_token_at or now) - started
+
+    def _record_usage(self, model, messages, reply):
+        """ Adds a finished call's token counts and estimated cost to the usage metrics. Models without a catalog price are skipped. """
+        prices = MODEL_PRICES.get((self.name, model))
+        if prices is None:
+            return
+        prompt_tokens = self.count_tokens(messages, model)
+        reply_tokens = count_text_tokens(reply, model)
+        UPSTREAM_TOKENS.inc(prompt_tokens, provider=self.name, model=model, kind='prompt')
+        UPSTREAM_TOKENS.inc(reply_tokens, provider=self.name, model=model, kind='completion')
+        UPSTREAM_COST_USD.inc((prompt_tokens * prices[0] + reply_tokens * prices[1]) / 1000, provider=self.name, model=model)
+
+    def _resolve(self, model, temperature, max_tokens):
+        return (
+            model or self.chat_model,
+            self.temperature if temperature is None else temperature,
+            self.max_tokens if max_tokens is None else max_tokens,
+        )
+
+    def _schedule(self, api_key, estimated_tokens, call):
+        """
+        Runs call() through the (provider, API key) rate limiter: waits for capacity, retries upstream 429s
+        with jittered backoff and raises RateLimitQueueTimeout if that can't happen within RATE_LIMIT_MAX_WAIT_SECONDS.
+        """
+        return get_rate_limiter(self.name, api_key).run(
+            call, estimated_tokens, self.is_rate_limit_error, RATE_LIMIT_MAX_WAIT_SECONDS, RATE_LIMIT_MAX_RETRIES
+        )
+
+    async def _schedule_async(self, api_key, estimated_tokens, call):
+        return await get_rate_limiter(self.name, api_key).run_async(
+            call, estimated_tokens, self.is_rate_limit_error, RATE_LIMIT_MAX_WAIT_SECONDS, RATE_LIMIT_MAX_RETRIES
+        )
+
+
+class OpenAIProvider(ChatProvider):
+    name = 'openai'
+    display_name = 'OpenAI'
+    api_key_field = 'openai_api_key'
+
+    def _client(self, api_key, max_retries):
+        # SDK retries off by default: 429s are retried by the rate limiter (_schedule()), and the SDK's own
+        # retries on top would multiply the attempts and stretch the limiter's wait
+        return get_openai_client(api_key, max_retries=0 if max_retries is None else max_retries)
+
+    def _request(self, model, messages, temperature, max_tokens, **extra):
+        params = {'model': model, 'messages': messages, **extra}
+        if temperature is not None:
+            params['temperature'] = temperature
+        if max_tokens is not None:
+            params['max_tokens'] = max_tokens
+        if self.timeout_seconds is not None:
+            params['timeout'] = self.timeout_seconds
+        return params
+
+    def _complete(self, api_key, messages, model, temperature, max_tokens, max_retries):
+        response = self._client(api_key, max_retries).chat.completions.create(**self._request(model, messages, temperature, max_tokens))
+        return response.choices[0].message.content.strip()
+
+    def _open_stream(self, api_key, messages, model, temperature, max_tokens, max_retries):
+        return self._client(api_key, max_retries).chat.completions.create(**self._request(model, messages, temperature, max_tokens, stream=True))
+
+    def _iter_stream(self, stream):
+        try:
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+        finally:
+            stream.close() # Also when the consumer stops early, e.g. a cancelled hedged call (fan_out.py)
+
+    async def _complete_async(self, api_key, messages, model, temperature, max_tokens):
+        response = await get_async_openai_client(api_key, max_retries=0).chat.completions.create(**self._request(model, messages, temperature, max_tokens))
+        return response.choices[0].message.content.strip()
+
+    async def _open_stream_async(self, api_key, messages, model, temperature, max_tokens):
+        return await get_async_openai_client(api_key, max_retries=0).chat.completions.create(**self._request(model, messages, temperature, max_tokens, stream=True))
+
+    async def _iter_stream_async(self, stream):
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+        finally:
+            await stream.close()
+
+    def is_rate_limit_error(self, e):
+        return isinstance(e, openai_errors('RateLimitError'))
+
+    def is_upstream_failure(self, e):
+        # APIConnectionError includes timeouts
+        return isinstance(e, openai_errors('APIConnectionError')) or (isinstance(e, openai_errors('APIStatusError')) and e.status_code >= 500)
+
+    def describe_error(self, e, chat_id):
+        if isinstance(e, openai_errors('AuthenticationError')):
+            logging.error(f"OpenAI API Authentication Failed: {e}", exc_info=False)
+            return "ERROR: OpenAI API authentication failed. Check your key.", 401, True
+        if isinstance(e, openai_errors('RateLimitError')):
+            logging.error(f"OpenAI API Rate Limit Exceeded: {e}", exc_info=False)
+            return "ERROR: OpenAI API request limit reached. Check plan/billing.", 429, False
+        if isinstance(e, openai_errors('APIConnectionError')):
+            logging.error(f"OpenAI API Connection Error: {e}", exc_info=True)
+            return "ERROR: Could not connect to OpenAI API.", 504, False
+        if isinstance(e, openai_errors('BadRequestError')):
+            logging.error(f"OpenAI API BadRequestError: {e}", exc_info=True)
+            error_message = str(e) or "Invalid request sent to OpenAI."
+            status_code = e.status_code if hasattr(e, 'status_code') else 400
+            if "content_policy_violation" in error_message.lower():
+                logging.warning(f"OpenAI content policy violation for chat {chat_id}")
+                return "Response blocked due to OpenAI's content policy.", status_code, False
+            return f"ERROR: OpenAI API request error: {error_message}", status_code, False
+        if isinstance(e, openai_errors('OpenAIError')):
+            logging.error(f"OpenAI API Error: {e}", exc_info=True)
+            error_message = str(e) or "An unknown error occurred."
+            status_code = e.http_status if hasattr(e, 'http_status') else 500
+            return f"ERROR: An error occurred with the OpenAI API: {error_message}", status_code, False
+        return super().describe_error(e, chat_id)
+
+
+def build_gemini_history(chat_history):
+    """ Converts stored chat history into Gemini's format (system message skipped). """
+    gemini_history = []
+    for msg in chat_history:
+        if msg['role'] != 'system': # Skip system message for Gemini history
+            role = 'user' if msg['role'] == 'user' else 'model'
+            gemini_history.append({'role': role, 'parts': [msg['content']]})
+    return gemini_history
+
+
+class GeminiProvider(ChatProvider):
+    name = 'gemini'
+    display_name = 'Google'
+    api_key_field = 'google_api_key'
+    supports_system_messages = False # System messages are dropped from the history sent to Gemini
+
+    def _generation_config(self, temperature, max_tokens):
+        config = {}
+        if temperature is not None:
+            config['temperature'] = temperature
+        if max_tokens is not None:
+            config['max_output_tokens'] = max_tokens
+        return config or None
+
+    def _send(self, model, messages, temperature, max_tokens, **extra):
+        """ Starts a chat session on the earlier messages and sends the newest one. """
+        chat_session = model.start_chat(history=build_gemini_history(messages[:-1]))
+        if self.timeout_seconds is not None:
+            extra['request_options'] = {'timeout': self.timeout_seconds}
+        return chat_session, dict(
+            content=messages[-1]['content'], generation_config=self._generation_config(temperature, max_tokens), **extra
+        )
+
+    @staticmethod
+    def _empty_response_error(response):
+        feedback = getattr(response, 'prompt_feedback', None)
+        if feedback and getattr(feedback, 'block_reason', None):
+            logging.warning(f"Gemini response blocked: {feedback.block_reason.name}")
+            return ProviderResponseError(f"Response blocked due to: {feedback.block_reason.name}")
+        logging.warning(f"Gemini returned empty/unexpected response. Response: {response}")
+        return ProviderResponseError("Gemini returned an empty or unexpected response.")
+
+    def _complete(self, api_key, messages, model, temperature, max_tokens, max_retries):
+        chat_session, request = self._send(get_gemini_model(api_key, model), messages, temperature, max_tokens)
+        response = chat_session.send_message(**request)
+        if not response.parts:
+            raise self._empty_response_error(response)
+        return response.text.strip()
+
+    def _open_stream(self, api_key, messages, model, temperature, max_tokens, max_retries):
+        chat_session, request = self._send(get_gemini_model(api_key, model), messages, temperature, max_tokens, stream=True)
+        return chat_session.send_message(**request)
+
+    def _iter_stream(self, response):
+        received = False
+        for chunk in response:
+            if chunk.parts:
+                received = True
+                yield chunk.text
+        if not received:
+            raise self._empty_response_error(response)
+
+    async def _complete_async(self, api_key, messages, model, temperature, max_tokens):
+        chat_session, request = self._send(get_async_gemini_model(api_key, model), messages, temperature, max_tokens)
+        response = await chat_session.send_message_async(**request)
+        if not response.parts:
+            raise self._empty_response_error(response)
+        return response.text.strip()
+
+    async def _open_stream_async(self, api_key, messages, model, temperature, max_tokens):
+        chat_session, request = self._send(get_async_gemini_model(api_key, model), messages, temperature, max_tokens, stream=True)
+        return await chat_session.send_message_async(**request)
+
+    async def _iter_stream_async(self, response):
+        received = False
+        async for chunk in response:
+            if chunk.parts:
+                received = True
+                yield chunk.text
+        if not received:
+            raise self._empty_response_error(response)
+
+    def is_rate_limit_error(self, e):
+        return isinstance(e, google_errors('ResourceExhausted'))
+
+    def is_upstream_failure(self, e):
+        # ServerError covers 5xx, including DeadlineExceeded and ServiceUnavailable
+        return isinstance(e, google_errors('ServerError', 'RetryError') + (ConnectionError, TimeoutError))
+
+    def describe_error(self, e, chat_id):
+        if isinstance(e, google_errors('PermissionDenied', 'InvalidArgument')):
+            logging.error(f"Google API Auth/Argument Error: {e}", exc_info=False)
+            return f"ERROR: Google API permission denied or invalid argument. Check your key/API settings. ({type(e).__name__})", 403, True
+        if isinstance(e, google_errors('ResourceExhausted')):
+            logging.error(f"Google API Quota Exceeded: {e}", exc_info=False)
+            return "ERROR: Google API quota exceeded. Please try again later.", 429, False
+        if isinstance(e, google_errors('GoogleAPIError')):
+            logging.error(f"Google API Error: {e}", exc_info=True)
+            return "ERROR: An error occurred with the Google API.", 500, False
+        logging.error(f"Unexpected error calling Google Gemini API: {e}", exc_info=True)
+        return "ERROR: An unexpected error occurred with the Google Gemini API.", 500, False
+
+
+MOCK_TITLE_WORDS = 5
+QUOTED_LINE_PATTERN = re.compile(r'^"(.*?)"$', re.MULTILINE | re.DOTALL) # The user message in app.TITLE_GENERATION_PROMPT_TEMPLATE
+
+
+class MockProvider(ChatProvider):
+    """
+    Echoes the newest message back as "Echo: <message>", word by word. Waits latency_seconds before
+    the first word, then emits tokens_per_second words per second (0 = all at once). Needs no key
+    and is not rate limited, so it measures this app rather than an upstream API.
+
+    Called with its title model, it answers a title prompt like a real model would: with a short title
+    (the first MOCK_TITLE_WORDS words of the quoted user message), not an echo of the whole prompt.
+    """
+
+    name = 'mock'
+    display_name = 'Mock'
+    api_key_field = None
+
+    def __init__(self, latency_seconds=0.5, tokens_per_second=50.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency_seconds = latency_seconds
+        self.tokens_per_second = tokens_per_second
+
+    def _reply_words(self, messages, model, max_tokens):
+        quoted = QUOTED_LINE_PATTERN.search(messages[-1]['content'])
+        if model == self.title_model and model != self.chat_model and quoted:
+            words = quoted.group(1).split()[:MOCK_TITLE_WORDS] or ["Mock", "Chat"]
+        else:
+            words = f"Echo: {messages[-1]['content']}".split()
+        return words[:max_tokens] if max_tokens else words
+
+    def _token_delay(self):
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _schedule(self, api_key, estimated_tokens, call):
+        return call()
+
+    async def _schedule_async(self, api_key, estimated_tokens, call):
+        return await call()
+
+    def _complete(self, api_key, messages, model, temperature, max_tokens, max_retries):
+        words = self._reply_words(messages, model, max_tokens)
+        time.sleep(self.latency_seconds + self._token_delay() * max(0, len(words) - 1))
+        return " ".join(words)
+
+    def _open_stream(self, api_key, messages, model, temperature, max_tokens, max_retries):
+        time.sleep(self.latency_seconds)
+        return self._reply_words(messages, model, max_tokens)
+
+    def _iter_stream(self, words):
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self._token_delay())
+            yield word if i == 0 else " " + word
+
+    async def _complete_async(self, api_key, messages, model, temperature, max_tokens):
+        words = self._reply_words(messages, model, max_tokens)
+        await asyncio.sleep(self.latency_seconds + self._token_delay() * max(0, len(words) - 1))
+        return " ".join(words)
+
+    async def _open_stream_async(self, api_key, messages, model, temperature, max_tokens):
+        await asyncio.sleep(self.latency_seconds)
+        return self._reply_words(messages, model, max_tokens)
+
+    async def _iter_stream_async(self, words):
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self._token_delay())
+            yield word if i == 0 else " " + word
+
+
+# --- Provider registry (model_choice sent by the client -> backend), built from the model catalog ---
+
+BACKENDS = {'openai': OpenAIProvider, 'gemini': GeminiProvider, 'mock': MockProvider}
+
+catalog_source = create_catalog_source()
+# Replaced as a whole on reload, never mutated: a reader always sees one consistent catalog
+CATALOG = {'default': None, 'models': {}}
+PROVIDERS = {}
+MODEL_PRICES = {} # (provider name, upstream model) -> (input, output) USD per 1K tokens; priced models only
+
+
+def build_provider(spec):
+    """ Provider instance for one catalog entry (see model_catalog.parse_catalog()). """
+    options = {}
+    if spec['provider'] == 'mock':
+        options = {key: spec[key] for key in ('latency_seconds', 'tokens_per_second') if key in spec}
+    return BACKENDS[spec['provider']](
+        chat_model=spec['model'],
+        title_model=spec['title_model'],
+        temperature=spec['temperature'],
+        max_tokens=spec['max_tokens'],
+        context_token_budget=spec['context_token_budget'],
+        timeout_seconds=spec['timeout_seconds'],
+        label=spec['label'],
+        **options,
+    )
+
+
+def apply_catalog(catalog):
+    """ Makes catalog the current one. Entries that didn't change keep their provider instance. """
+    global CATALOG, PROVIDERS, MODEL_PRICES
+    providers = {
+        model_choice: PROVIDERS[model_choice] if CATALOG['models'].get(model_choice) == spec else build_provider(spec)
+        for model_choice, spec in catalog['models'].items()
+    }
+    prices = {
+        (BACKENDS[spec['provider']].name, spec['model']): (spec['input_cost_per_1k'], spec['output_cost_per_1k'])
+        for spec in catalog['models'].values()
+        if spec['input_cost_per_1k'] or spec['output_cost_per_1k']
+    }
+    CATALOG, PROVIDERS, MODEL_PRICES = catalog, providers, prices
+
+
+apply_catalog(catalog_source.load()) # An invalid catalog at startup is a configuration error: fail loudly
+
+
+def refresh_catalog():
+    """ Applies the catalog file if it changed (checked at most every MODEL_CATALOG_RELOAD_SECONDS). """
+    catalog = catalog_source.reload_if_changed()
+    if catalog is not None:
+        apply_catalog(catalog)
+
+
+def get_provider(model_choice):
+    """ Returns the provider for a model_choice (a catalog entry, e.g. 'gpt' or 'gemini'), or None if unknown. """
+    refresh_catalog()
+    return PROVIDERS.get(model_choice)
+
+
+def list_providers():
+    """ The current {model_choice: provider} mapping. Don't mutate it. """
+    refresh_catalog()
+    return PROVIDERS
+
+
+def default_model_choice():
+    """ The model_choice used when a request doesn't name one. """
+    refresh_catalog()
+    return CATALOG['default']
+
+
+def fallback_model_choice(model_choice):
+    """ The catalog's fallback for model_choice (used while its circuit breaker is open), or None. """
+    refresh_catalog()
+    spec = CATALOG['models'].get(model_choice)
+    return spec['fallback'] if spec else None
+
+
+def describe_catalog():
+    """ The catalog as shown to clients (model picker, GET /models): what each model is and the limits applied to it. """
+    refresh_catalog()
+    catalog = CATALOG
+    return {
+        'default': catalog['default'],
+        'models': [
+            {
+                'id': model_choice,
+                'label': spec['label'],
+                'provider': spec['provider'],
+                'model': spec['model'],
+                'max_tokens': spec['max_tokens'],
+                'timeout_seconds': spec['timeout_seconds'],
+                'context_token_budget': spec['context_token_budget'],
+                'input_cost_per_1k': spec['input_cost_per_1k'],
+                'output_cost_per_1k': spec['output_cost_per_1k'],
+                'fallback': spec['fallback'],
+            }
+            for model_choice, spec in catalog['models'].items()
+        ],
+    }
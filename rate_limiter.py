@@ -0,0 +1,173 @@
+# rate_limiter.py
+"""
+Client-side request scheduling per (provider, API key).
+
+Each key gets two token buckets, requests-per-minute and tokens-per-minute. A request reserves
+capacity up front and waits its turn (reservations queue in arrival order). A request whose turn
+would come later than its deadline is rejected immediately instead of waiting and then failing.
+Upstream 429s pause the key with jittered exponential backoff, and the call is retried while the
+deadline allows.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+from llm_clients import ClientRegistry
+
+
+class RateLimitQueueTimeout(Exception):
+    """ Raised when a request can't be scheduled within its deadline. """
+
+    def __init__(self, provider, wait_seconds):
+        super().__init__(f"{provider} request would wait {wait_seconds:.1f}s for rate limit capacity")
+        self.provider = provider
+        self.wait_seconds = wait_seconds
+
+
+class TokenBucket:
+    """ Continuous-refill bucket. The level may go negative: that is capacity already promised to queued requests. """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount):
+        """ Seconds until amount would be available (0 if available now). Caller must refill() first. """
+        deficit = min(amount, self.capacity) - self.level
+        return max(0.0, deficit / self.rate)
+
+
+class KeyRateLimiter:
+    """ RPM/TPM buckets and 429 backoff state for one (provider, API key). """
+
+    def __init__(self, provider, requests_per_minute, tokens_per_minute, max_queued=50,
+                 base_backoff=1.0, max_backoff=30.0):
+        self.provider = provider
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_queued = max_queued
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.blocked_until = 0.0
+        self.consecutive_rate_limits = 0
+        self.queued = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, estimated_tokens, max_wait):
+        """
+        Claims one request and estimated_tokens of capacity. Returns the seconds to wait before
+        sending; raises RateLimitQueueTimeout (claiming nothing) if that exceeds max_wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            wait = max(self.requests.wait_for(1), self.tokens.wait_for(estimated_tokens), self.blocked_until - now, 0.0)
+            if wait > max_wait or (wait > 0 and self.queued >= self.max_queued):
+                raise RateLimitQueueTimeout(self.provider, wait)
+            self.requests.level -= 1
+            self.tokens.level -= min(estimated_tokens, self.tokens.capacity)
+            if wait > 0:
+                self.queued += 1
+            return wait
+
+    def release_queue_slot(self):
+        with self._lock:
+            self.queued = max(0, self.queued - 1)
+
+    def report_rate_limited(self):
+        """ Upstream said 429: pause this key for a jittered, exponentially growing interval. Returns the pause. """
+        with self._lock:
+            self.consecutive_rate_limits += 1
+            backoff = min(self.max_backoff, self.base_backoff * (2 ** (self.consecutive_rate_limits - 1)))
+            backoff = random.uniform(backoff / 2, backoff) # Jitter spreads out retries from concurrent requests
+            self.blocked_until = max(self.blocked_until, time.monotonic() + backoff)
+            return backoff
+
+    def report_success(self):
+        with self._lock:
+            self.consecutive_rate_limits = 0
+
+    def run(self, call, estimated_tokens, is_rate_limit_error, max_wait, max_retries):
+        """ Schedules and runs call(), retrying upstream rate-limit errors within the max_wait deadline. """
+        deadline = time.monotonic() + max_wait
+        attempt = 0
+        while True:
+            wait = self.reserve(estimated_tokens, max(0.0, deadline - time.monotonic()))
+            if wait > 0:
+                logging.info(f"Rate limiter: delaying {self.provider} request by {wait:.2f}s")
+                try:
+                    time.sleep(wait)
+                finally:
+                    self.release_queue_slot()
+            try:
+                result = call()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= max_retries:
+                    if is_rate_limit_error(e):
+                        self.report_rate_limited()
+                    raise
+                backoff = self.report_rate_limited()
+                attempt += 1
+                logging.warning(f"{self.provider} rate limited; retry {attempt}/{max_retries} after ~{backoff:.1f}s backoff")
+                continue
+            self.report_success()
+            return result
+
+    async def run_async(self, call, estimated_tokens, is_rate_limit_error, max_wait, max_retries):
+        """ Same as run(), for coroutine functions; waits with asyncio.sleep. """
+        deadline = time.monotonic() + max_wait
+        attempt = 0
+        while True:
+            wait = self.reserve(estimated_tokens, max(0.0, deadline - time.monotonic()))
+            if wait > 0:
+                try:
+                    await asyncio.sleep(wait)
+                finally:
+                    self.release_queue_slot()
+            try:
+                result = await call()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= max_retries:
+                    if is_rate_limit_error(e):
+                        self.report_rate_limited()
+                    raise
+                backoff = self.report_rate_limited()
+                attempt += 1
+                logging.warning(f"{self.provider} rate limited; retry {attempt}/{max_retries} after ~{backoff:.1f}s backoff")
+                continue
+            self.report_success()
+            return result
+
+
+# Per-provider limits; defaults are conservative, override per deployment/tier
+PROVIDER_LIMITS = {
+    'openai': {
+        'requests_per_minute': int(os.getenv("OPENAI_RPM", "500")),
+        'tokens_per_minute': int(os.getenv("OPENAI_TPM", "60000")),
+    },
+    'gemini': {
+        'requests_per_minute': int(os.getenv("GEMINI_RPM", "15")),
+        'tokens_per_minute': int(os.getenv("GEMINI_TPM", "1000000")),
+    },
+}
+RATE_LIMIT_MAX_QUEUED = int(os.getenv("RATE_LIMIT_MAX_QUEUED", "50"))
+
+limiter_registry = ClientRegistry(max_size=int(os.getenv("RATE_LIMITER_CACHE_SIZE", "1024")))
+
+
+def get_rate_limiter(provider, api_key):
+    """ Returns the shared limiter for this provider and key (limits from PROVIDER_LIMITS). """
+    key = ClientRegistry.make_key(provider, api_key, purpose="rate-limit")
+    return limiter_registry.get(
+        key, lambda: KeyRateLimiter(provider, max_queued=RATE_LIMIT_MAX_QUEUED, **PROVIDER_LIMITS[provider])
+    )
@@ -0,0 +1,155 @@
+# regenerate_titles.py
+"""
+Offline job that regenerates fallback chat titles.
+
+When title generation fails (missing key, rate limit, API error), generate_chat_title() stores a
+fallback such as "Chat 14:05 (Rate Limit)", and nothing ever retries it. This job scans the
+chat store for those titles, plus provisional "New Chat" titles whose background job never
+finished, and regenerates them in batches. Title calls stay out of the interactive request path.
+
+Users' API keys only live in their session cookies, so the job uses server-side keys from
+OPENAI_API_KEY / GOOGLE_API_KEY. Chats are spread round-robin over the selected providers.
+A bounded worker pool runs the calls, and a semaphore per provider caps its in-flight requests.
+The providers' rate limiters (rate_limiter.py) still apply on top of that.
+
+Progress is checkpointed to a JSON file after each batch, so an interrupted run resumes
+where it stopped. Use --reset to start over, e.g. to retry titles that failed again.
+
+    python regenerate_titles.py --providers gemini,gpt --workers 8 --concurrency gemini=2,gpt=6
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import (
+    chat_store, generate_chat_title, FALLBACK_TITLE_PATTERN, PROVISIONAL_CHAT_TITLE,
+)
+from providers import get_provider
+
+SERVER_API_KEY_ENV = {'openai_api_key': "OPENAI_API_KEY", 'google_api_key': "GOOGLE_API_KEY"}
+PROVISIONAL_TITLE_GRACE_SECONDS = 600 # "New Chat" younger than this may still have its title job running
+
+
+def needs_new_title(chat, now):
+    if chat['title'] == PROVISIONAL_CHAT_TITLE:
+        return now - chat['created_at'] > PROVISIONAL_TITLE_GRACE_SECONDS
+    return bool(FALLBACK_TITLE_PATTERN.match(chat['title']))
+
+
+def first_user_message(history):
+    return next((msg['content'] for msg in history if msg.get('role') == 'user'), None)
+
+
+def load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return {'after': None, 'scanned': 0, 'updated': 0, 'failed': 0, 'skipped': 0}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    """ Atomic replace, so a crash mid-write never leaves a corrupt checkpoint. """
+    if not path:
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def regenerate_title(chat, model_choice, api_key, semaphore, dry_run):
+    """ Returns 'updated', 'failed' or 'skipped'. """
+    stored = chat_store.get_chat(chat['user_id'], chat['id'])
+    if stored is None or stored['title'] != chat['title']:
+        return 'skipped' # Deleted or renamed since the scan
+    user_message = first_user_message(stored.get('history', []))
+    if not user_message:
+        return 'skipped'
+    if dry_run:
+        logging.info(f"Would regenerate title of chat {chat['id']} ('{chat['title']}') with {model_choice}")
+        return 'skipped'
+
+    with semaphore:
+        title = generate_chat_title(user_message, model_choice, api_key)
+    if FALLBACK_TITLE_PATTERN.match(title):
+        logging.warning(f"Title generation failed again for chat {chat['id']}: '{title}'")
+        return 'failed'
+    # expected_title: never overwrite a title the user set meanwhile
+    if not chat_store.update_title(chat['user_id'], chat['id'], title, expected_title=chat['title']):
+        return 'skipped'
+    logging.info(f"Regenerated title of chat {chat['id']}: '{chat['title']}' -> '{title}'")
+    return 'updated'
+
+
+def parse_concurrency(value):
+    limits = {}
+    for item in filter(None, value.split(',')):
+        name, _, limit = item.partition('=')
+        limits[name.strip()] = int(limit)
+    return limits
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--providers', default='gemini', help="Comma-separated model choices to generate titles with")
+    parser.add_argument('--workers', type=int, default=4, help="Worker pool size")
+    parser.add_argument('--concurrency', default='', help="Per-provider in-flight limits, e.g. 'gemini=2,gpt=6' (default: --workers)")
+    parser.add_argument('--batch-size', type=int, default=200, help="Chats scanned per batch (checkpoint granularity)")
+    parser.add_argument('--checkpoint', default='regenerate_titles.checkpoint.json', help="Checkpoint file ('' to disable)")
+    parser.add_argument('--reset', action='store_true', help="Ignore an existing checkpoint and scan from the start")
+    parser.add_argument('--dry-run', action='store_true', help="Only report which chats would get a new title")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    concurrency = parse_concurrency(args.concurrency)
+
+    targets = [] # (model_choice, api_key, semaphore)
+    for model_choice in filter(None, (name.strip() for name in args.providers.split(','))):
+        provider = get_provider(model_choice)
+        if provider is None:
+            raise SystemExit(f"Unknown provider '{model_choice}'")
+        api_key = os.getenv(SERVER_API_KEY_ENV[provider.api_key_field]) if provider.requires_api_key else None
+        if provider.requires_api_key and not api_key:
+            raise SystemExit(f"{SERVER_API_KEY_ENV[provider.api_key_field]} must be set to generate titles with '{model_choice}'")
+        targets.append((model_choice, api_key, threading.BoundedSemaphore(concurrency.get(model_choice, args.workers))))
+    if not targets:
+        raise SystemExit("No providers selected")
+
+    checkpoint = load_checkpoint(None if args.reset else args.checkpoint)
+    if checkpoint['after']:
+        logging.info(f"Resuming after chat {checkpoint['after'][1]} of user {checkpoint['after'][0]}")
+    assignment = itertools.cycle(targets)
+
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="title-batch") as executor:
+        while True:
+            chats = chat_store.scan_chats(after=checkpoint['after'], limit=args.batch_size)
+            if not chats:
+                break
+            now = time.time()
+            futures = [
+                executor.submit(regenerate_title, chat, *next(assignment), args.dry_run)
+                for chat in chats if needs_new_title(chat, now)
+            ]
+            for future in futures: # The whole batch completes before the checkpoint moves past it
+                outcome = future.result()
+                checkpoint[outcome] += 1
+            checkpoint['scanned'] += len(chats)
+            checkpoint['after'] = [chats[-1]['user_id'], chats[-1]['id']]
+            save_checkpoint(args.checkpoint, checkpoint)
+
+    logging.info(
+        f"Done: scanned {checkpoint['scanned']} chats, updated {checkpoint['updated']}, "
+        f"failed {checkpoint['failed']}, skipped {checkpoint['skipped']}"
+    )
+    print(json.dumps(checkpoint))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# request_coalescing.py
+"""
+Single-flight coalescing of duplicate chat submissions.
+
+A double-click or a client retry can post the same message to /chat (or /chat/stream) again
+while the first request is still running. Both would call the LLM and both would append to the
+chat's history, racing on save_history(). Requests are keyed by (user, chat id, message hash,
+Idempotency-Key header). The first request with a key runs the turn (the "leader"); duplicates
+arriving while it is in flight wait for its result and return it without touching the history.
+
+With an Idempotency-Key, the finished result is also kept for RETRY_WINDOW_SECONDS, so a retry
+that arrives just after the original completed gets the same answer. Without one, only
+concurrent duplicates are coalesced: sending the same text again later is a new turn.
+
+Flights are tracked per process; duplicates routed to different workers are not coalesced.
+"""
+import asyncio
+import hashlib
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait as futures_wait
+
+RETRY_WINDOW_SECONDS = 60
+
+
+def coalescing_key(user_id, chat_id, message, model_choice, idempotency_key=None):
+    """ chat_id is the session's current chat before the turn (None when the turn creates a chat). """
+    message_hash = hashlib.sha256(f"{model_choice}\0{message}".encode()).hexdigest()
+    return (user_id, chat_id, message_hash, idempotency_key or None)
+
+
+class Flight:
+    """ One turn in flight; its result is published by SingleFlight.finish(). """
+
+    def __init__(self):
+        self.future = Future()
+
+    def wait(self, timeout=None):
+        """ Returns the leader's result, or None if it failed or did not finish within timeout. """
+        futures_wait([self.future], timeout)
+        return self.future.result() if self.future.done() else None
+
+    async def wait_async(self, timeout=None):
+        """ Same as wait(), but waits on the event loop instead of blocking a thread (asgi.py). """
+        # asyncio.wait() doesn't cancel on timeout; cancelling the wrapper would cancel the shared future
+        await asyncio.wait([asyncio.wrap_future(self.future)], timeout=timeout)
+        return self.future.result() if self.future.done() else None
+
+
+class SingleFlight:
+    def __init__(self, retry_window=RETRY_WINDOW_SECONDS):
+        self.retry_window = retry_window
+        self._flights = {}
+        self._retained = deque() # (finished_at, key) of results kept for retries, oldest first
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """ Returns (flight, is_leader). The leader must call finish(), also when it fails. """
+        with self._lock:
+            self._expire(time.monotonic())
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def finish(self, key, flight, result):
+        """ Publishes the leader's result (None = failed) and wakes the duplicates. Later calls are no-ops. """
+        with self._lock:
+            if flight.future.done():
+                return
+            if result is not None and key[-1] is not None:
+                self._retained.append((time.monotonic(), key))
+            elif self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.future.set_result(result) # Under the lock: a second finish() must see the flight as done
+
+    def _expire(self, now):
+        while self._retained and now - self._retained[0][0] > self.retry_window:
+            _, key = self._retained.popleft()
+            self._flights.pop(key, None)
@@ -0,0 +1,174 @@
+# response_cache.py
+"""
+Opt-in cache of completed LLM replies.
+
+Entries are keyed by a hash of (provider, model, temperature, normalized message history, ...),
+expire after a TTL and are evicted least-recently-used beyond a size limit. The in-process
+backend serves a single worker; the SQLite backend is shared by every worker on the host.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_cache_key(provider, model, temperature, messages, **params):
+    """ Stable hash of everything that determines the reply. Whitespace around message content is ignored. """
+    normalized = {
+        'provider': provider,
+        'model': model,
+        'temperature': temperature,
+        'messages': [(msg['role'], msg['content'].strip()) for msg in messages],
+        'params': sorted(params.items()),
+    }
+    return hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode()).hexdigest()
+
+
+class ResponseCache:
+    """ Base class: hit/miss counters around the backend's _get/_set. """
+
+    def __init__(self, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key):
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._set(key, value)
+
+    def stats(self):
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value):
+        raise NotImplementedError
+
+
+class MemoryResponseCache(ResponseCache):
+    """ Per-process LRU with TTL. """
+
+    def __init__(self, ttl_seconds=3600, max_entries=1000):
+        super().__init__(ttl_seconds, max_entries)
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteResponseCache(ResponseCache):
+    """ Cache shared by all workers through a SQLite file. Pruning runs every PRUNE_EVERY writes, not on every write. """
+
+    PRUNE_EVERY = 50
+
+    def __init__(self, path, ttl_seconds=3600, max_entries=1000):
+        super().__init__(ttl_seconds, max_entries)
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _get(self, key):
+        now = time.time()
+        row = self._connect().execute(
+            "SELECT value FROM response_cache WHERE key = ? AND expires_at >= ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        with self._connect() as conn:
+            conn.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def _set(self, key, value):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl_seconds, now)
+            )
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        """ Drops expired entries, then the least recently used ones beyond max_entries. """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+            conn.execute("""
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+
+
+def create_response_cache(url=None):
+    """
+    Builds the cache configured by RESPONSE_CACHE_URL ('memory' or 'sqlite:///path/to/cache.db').
+    Returns None (caching disabled) when it is unset. RESPONSE_CACHE_TTL (seconds, default 3600)
+    and RESPONSE_CACHE_MAX_ENTRIES (default 1000) apply to both backends.
+    """
+    url = url if url is not None else os.getenv("RESPONSE_CACHE_URL", "")
+    if not url:
+        return None
+    ttl_seconds = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+    max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+    if url == "memory":
+        logging.info("Using in-process response cache")
+        return MemoryResponseCache(ttl_seconds, max_entries)
+    if url.startswith("sqlite:///"):
+        path = url[len("sqlite:///"):] or "response_cache.db"
+        logging.info(f"Using SQLite response cache at '{path}'")
+        return SQLiteResponseCache(path, ttl_seconds, max_entries)
+    raise ValueError(f"Unsupported RESPONSE_CACHE_URL: '{url}'")
@@ -0,0 +1,218 @@
+# search_index.py
+"""
+Full-text search over chat titles and messages (SQLite FTS5).
+
+The chat store keeps the index up to date as it writes (see ChatStore.search_index): a saved turn
+adds just its new messages, a rewritten history replaces the chat's messages, and a deleted chat
+drops them. Searches never read or decode histories, so they stay fast however long chats grow.
+
+Each title and each user/assistant message is one row in search_documents, mirrored into the
+external-content FTS5 table search_fts by triggers. The owning user id is indexed too, so a
+search only walks that user's postings. Chats are ranked by their best-matching row (BM25).
+The index is a local SQLite file; with the Redis chat store it covers the chats written on this host.
+
+    python search_index.py   # (Re)builds the index from the chat store, e.g. for chats saved before it existed
+"""
+import html
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+TITLE_POSITION = -1 # position of the title row; messages use their index in the history
+INDEXED_ROLES = ('user', 'assistant')
+MAX_QUERY_TERMS = 16
+SNIPPET_TOKENS = 16
+HIGHLIGHT_START, HIGHLIGHT_END = '\x02', '\x03' # Replaced by <mark> once the snippet is HTML-escaped
+
+
+def build_match_query(user_id, text):
+    """
+    FTS5 query for the words in text, all required, the last one as a prefix (search as you type),
+    restricted to user_id's rows. Returns None if text has no words.
+    """
+    terms = re.findall(r"\w+", text)[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    terms = [f'"{term}"' for term in terms] # Quoted: user input is never parsed as FTS5 syntax
+    terms[-1] += '*'
+    owner = user_id.replace('"', '""')
+    return f'user_id : "{owner}" AND content : ({" ".join(terms)})'
+
+
+def highlight(snippet):
+    """ HTML-escapes a snippet and wraps the matched terms in <mark>. """
+    return html.escape(snippet).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
+
+
+class SearchIndex:
+    """ Inverted index in a SQLite file (WAL mode, one connection per thread). """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS search_documents (
+                    id INTEGER PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    content TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_search_documents_chat ON search_documents (user_id, chat_id, position)")
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'search_fts'").fetchone()
+            if not exists:
+                conn.execute("""
+                    CREATE VIRTUAL TABLE search_fts USING fts5(
+                        user_id, content, content='search_documents', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2'
+                    )
+                """)
+                # Rank by the content column only; user_id just narrows the search to one user
+                conn.execute("INSERT INTO search_fts (search_fts, rank) VALUES ('rank', 'bm25(0.0, 1.0)')")
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS search_documents_insert AFTER INSERT ON search_documents BEGIN
+                    INSERT INTO search_fts (rowid, user_id, content) VALUES (new.id, new.user_id, new.content);
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS search_documents_delete AFTER DELETE ON search_documents BEGIN
+                    INSERT INTO search_fts (search_fts, rowid, user_id, content) VALUES ('delete', old.id, old.user_id, old.content);
+                END
+            """)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _message_rows(user_id, chat_id, start, messages):
+        return [
+            (user_id, chat_id, position, message['content'])
+            for position, message in enumerate(messages, start)
+            if message.get('role') in INDEXED_ROLES and isinstance(message.get('content'), str) and message['content'].strip()
+        ]
+
+    def add_messages(self, user_id, chat_id, start, messages):
+        """ Indexes messages appended to a chat's history; start is the index of the first one. """
+        rows = self._message_rows(user_id, chat_id, start, messages)
+        if rows:
+            with self._connect() as conn:
+                conn.executemany("INSERT INTO search_documents (user_id, chat_id, position, content) VALUES (?, ?, ?, ?)", rows)
+
+    def replace_messages(self, user_id, chat_id, history):
+        """ Re-indexes a rewritten history; the title row is kept. """
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM search_documents WHERE user_id = ? AND chat_id = ? AND position >= 0", (user_id, chat_id)
+            )
+            conn.executemany(
+                "INSERT INTO search_documents (user_id, chat_id, position, content) VALUES (?, ?, ?, ?)",
+                self._message_rows(user_id, chat_id, 0, history)
+            )
+
+    def set_title(self, user_id, chat_id, title):
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM search_documents WHERE user_id = ? AND chat_id = ? AND position = ?",
+                (user_id, chat_id, TITLE_POSITION)
+            )
+            conn.execute(
+                "INSERT INTO search_documents (user_id, chat_id, position, content) VALUES (?, ?, ?, ?)",
+                (user_id, chat_id, TITLE_POSITION, title)
+            )
+
+    def replace_chat(self, user_id, chat_id, title, history):
+        """ Indexes a whole chat, replacing whatever was indexed for it. """
+        self.set_title(user_id, chat_id, title)
+        self.replace_messages(user_id, chat_id, history)
+
+    def delete_chat(self, user_id, chat_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM search_documents WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+
+    def search(self, user_id, text, limit=20):
+        """
+        Returns up to limit of the user's chats matching every word of text, best first, as dicts with
+        'id', 'title', 'snippet' (HTML, matches in <mark>) and 'message_index' (the best-matching
+        message's index in the history, or None when the title matched best).
+        """
+        match_query = build_match_query(user_id, text)
+        if match_query is None:
+            return []
+        conn = self._connect()
+        best_rows = conn.execute("""
+            SELECT d.chat_id, d.id, d.position, MIN(search_fts.rank) AS score
+            FROM search_fts CROSS JOIN search_documents d ON d.id = search_fts.rowid -- CROSS: run the MATCH once, then join
+            WHERE search_fts MATCH ? AND d.user_id = ?
+            GROUP BY d.chat_id ORDER BY score LIMIT ?
+        """, (match_query, user_id, limit)).fetchall()
+        if not best_rows:
+            return []
+        placeholders = ", ".join("?" * len(best_rows))
+        # Snippets only for the rows returned, not for every match
+        snippets = dict(conn.execute(
+            f"SELECT rowid, snippet(search_fts, 1, ?, ?, '…', ?) FROM search_fts WHERE search_fts MATCH ? AND rowid IN ({placeholders})",
+            [HIGHLIGHT_START, HIGHLIGHT_END, SNIPPET_TOKENS, match_query] + [row['id'] for row in best_rows]
+        ).fetchall())
+        titles = dict(conn.execute(
+            f"SELECT chat_id, content FROM search_documents WHERE user_id = ? AND position = ? AND chat_id IN ({placeholders})",
+            [user_id, TITLE_POSITION] + [row['chat_id'] for row in best_rows]
+        ).fetchall())
+        return [
+            {
+                'id': row['chat_id'],
+                'title': titles.get(row['chat_id'], 'Chat'),
+                'snippet': highlight(snippets.get(row['id'], '')),
+                'message_index': row['position'] if row['position'] != TITLE_POSITION else None,
+            }
+            for row in best_rows
+        ]
+
+
+def create_search_index(url=None):
+    """
+    Builds the index configured by SEARCH_INDEX_URL ('sqlite:///path/to/search.db', default
+    'sqlite:///search.db'). Returns None (search disabled) when it is set to an empty string.
+    """
+    url = url if url is not None else os.getenv("SEARCH_INDEX_URL", "sqlite:///search.db")
+    if not url:
+        return None
+    if url.startswith("sqlite:///"):
+        path = url[len("sqlite:///"):] or "search.db"
+        logging.info(f"Using SQLite search index at '{path}'")
+        return SearchIndex(path)
+    raise ValueError(f"Unsupported SEARCH_INDEX_URL: '{url}'")
+
+
+def rebuild(chat_store, search_index, batch_size=500):
+    """ Re-indexes every chat in chat_store. Returns the number of chats indexed. """
+    indexed = 0
+    after = None
+    while True:
+        chats = chat_store.scan_chats(after=after, limit=batch_size)
+        if not chats:
+            return indexed
+        for summary in chats:
+            chat = chat_store.get_chat(summary['user_id'], summary['id'])
+            if chat is not None:
+                search_index.replace_chat(summary['user_id'], summary['id'], chat['title'], chat['history'])
+                indexed += 1
+        after = (chats[-1]['user_id'], chats[-1]['id'])
+        logging.info(f"Indexed {indexed} chats")
+
+
+if __name__ == '__main__':
+    from app import chat_store
+    if chat_store.search_index is None:
+        raise SystemExit("Search is disabled (SEARCH_INDEX_URL is empty)")
+    logging.info(f"Rebuilt the search index: {rebuild(chat_store, chat_store.search_index)} chats")
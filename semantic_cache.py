@@ -0,0 +1,191 @@
+# semantic_cache.py
+"""
+Opt-in cache that answers a first message with the reply to an earlier, similar first message.
+
+The exact-match cache (response_cache.py) only helps when a question comes in again word for
+word. First messages are often paraphrases of each other ("how do I reverse a list in python" /
+"python: reverse a list?"), so they are also looked up by similarity. A message is embedded
+locally as a hashed bag of words and character n-grams (no model, no network). Lookup is
+one matrix-vector product over all stored vectors (NumPy). The best match is served if its
+cosine similarity reaches SEMANTIC_CACHE_THRESHOLD.
+
+Only first turns are cached: later replies depend on the conversation so far. Entries are
+scoped by provider, model, sampling settings and system prompt (the part of the request other
+than the message), expire after a TTL, and the least recently used one is replaced once
+SEMANTIC_CACHE_MAX_ENTRIES are stored. The cache is per process.
+
+Hashed n-grams measure wording, not meaning: "install" and "uninstall" share most of their
+n-grams. Keep the threshold high. Replies are shared between users, as with the exact cache.
+NumPy is an optional dependency, only needed when SEMANTIC_CACHE_ENABLED is set.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+WORD_PATTERN = re.compile(r"\w+")
+CHAR_NGRAM_SIZES = (3, 4, 5)
+WORD_WEIGHT = 2.0 # Whole words count more than the n-grams inside them
+
+
+def first_turn_message(messages):
+    """ The text of the only user message if messages is a first turn (no earlier user/assistant messages), else None. """
+    conversation = [msg for msg in messages if msg.get('role') != 'system']
+    if len(conversation) != 1 or conversation[0].get('role') != 'user' or not isinstance(conversation[0].get('content'), str):
+        return None
+    return conversation[0]['content']
+
+
+def features(text):
+    """ Yields (feature, weight): the lower-cased words and the character n-grams of each word padded with spaces. """
+    for word in WORD_PATTERN.findall(text.lower()):
+        yield 'w:' + word, WORD_WEIGHT
+        padded = f" {word} "
+        for size in CHAR_NGRAM_SIZES:
+            for start in range(len(padded) - size + 1):
+                yield 'c:' + padded[start:start + size], 1.0
+
+
+class SemanticKey:
+    """ Returned by SemanticCache.key(): the request's scope and its message embedding, computed once for get() and set(). """
+
+    __slots__ = ('namespace', 'vector')
+
+    def __init__(self, namespace, vector):
+        self.namespace = namespace
+        self.vector = vector
+
+
+class SemanticCache:
+    """ Fixed-capacity vector index with LRU replacement; thread-safe. """
+
+    def __init__(self, threshold=0.92, max_entries=5000, ttl_seconds=3600, dimensions=1024):
+        import numpy # Optional dependency, imported only when the cache is enabled
+        self.np = numpy
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.dimensions = dimensions
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Row i of every array is slot i; only the first self._size slots are in use
+        self._vectors = numpy.zeros((max_entries, dimensions), dtype=numpy.float32)
+        self._namespaces = numpy.zeros(max_entries, dtype=numpy.int64)
+        self._expires_at = numpy.zeros(max_entries, dtype=numpy.float64)
+        self._last_used = numpy.zeros(max_entries, dtype=numpy.float64)
+        self._replies = [None] * max_entries
+        self._size = 0
+        # namespace -> small int id stored per slot; an id is dropped with the namespace's last slot,
+        # so the map never outgrows max_entries
+        self._namespace_ids = {}
+        self._namespace_slots = {} # namespace id -> number of slots holding it
+        self._slot_namespaces = [None] * max_entries # slot -> its namespace (the key of _namespace_ids)
+        self._next_namespace_id = 0
+        self._lock = threading.Lock()
+
+    def embed(self, text):
+        """ Unit-length float32 vector of the text's hashed features (signed feature hashing). """
+        vector = self.np.zeros(self.dimensions, dtype=self.np.float32)
+        for feature, weight in features(text):
+            digest = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little') # Stable across processes
+            vector[digest % self.dimensions] += weight if digest >> 63 else -weight
+        norm = self.np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def key(self, namespace, text):
+        """ namespace: everything besides the message that determines the reply (see app.lookup_cached_reply()). """
+        return SemanticKey(namespace, self.embed(text))
+
+    def get(self, key):
+        """ Returns the reply stored for the most similar message in key's namespace, or None below the threshold. """
+        now = time.time()
+        with self._lock:
+            reply, similarity = None, None
+            namespace_id = self._namespace_ids.get(key.namespace)
+            if namespace_id is not None and self._size:
+                similarities = self._vectors[:self._size] @ key.vector
+                similarities[(self._namespaces[:self._size] != namespace_id) | (self._expires_at[:self._size] < now)] = -1.0
+                best = int(self.np.argmax(similarities))
+                similarity = float(similarities[best])
+                if similarity >= self.threshold:
+                    reply = self._replies[best]
+                    self._last_used[best] = now
+            if reply is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if reply is not None:
+            logging.info(f"Semantic cache hit (similarity {similarity:.3f})")
+        return reply
+
+    def set(self, key, reply):
+        now = time.time()
+        with self._lock:
+            if self._size < self.max_entries:
+                slot = self._size
+                self._size += 1
+            else:
+                # Expired entries have the oldest possible last_used, so they are replaced first
+                last_used = self.np.where(self._expires_at < now, -1.0, self._last_used)
+                slot = int(self.np.argmin(last_used))
+                self.evictions += 1
+                self._release_namespace(self._slot_namespaces[slot])
+            namespace_id = self._namespace_ids.get(key.namespace)
+            if namespace_id is None:
+                namespace_id = self._namespace_ids[key.namespace] = self._next_namespace_id
+                self._next_namespace_id += 1
+            self._namespace_slots[namespace_id] = self._namespace_slots.get(namespace_id, 0) + 1
+            self._slot_namespaces[slot] = key.namespace
+            self._vectors[slot] = key.vector
+            self._namespaces[slot] = namespace_id
+            self._expires_at[slot] = now + self.ttl_seconds
+            self._last_used[slot] = now
+            self._replies[slot] = reply
+
+    def _release_namespace(self, namespace):
+        """ Called with the lock held when a slot of namespace is replaced; forgets the namespace with its last slot. """
+        namespace_id = self._namespace_ids[namespace]
+        self._namespace_slots[namespace_id] -= 1
+        if not self._namespace_slots[namespace_id]:
+            del self._namespace_slots[namespace_id]
+            del self._namespace_ids[namespace]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0,
+                'entries': self._size, 'evictions': self.evictions,
+            }
+
+    def collect_metrics(self):
+        """ Collector for metrics.registry. """
+        stats = self.stats()
+        return [
+            "# TYPE chat_semantic_cache_hits_total counter", f"chat_semantic_cache_hits_total {stats['hits']}",
+            "# TYPE chat_semantic_cache_misses_total counter", f"chat_semantic_cache_misses_total {stats['misses']}",
+            "# TYPE chat_semantic_cache_hit_ratio gauge", f"chat_semantic_cache_hit_ratio {stats['hit_rate']:.4f}",
+            "# TYPE chat_semantic_cache_entries gauge", f"chat_semantic_cache_entries {stats['entries']}",
+            "# TYPE chat_semantic_cache_evictions_total counter", f"chat_semantic_cache_evictions_total {stats['evictions']}",
+        ]
+
+
+def create_semantic_cache():
+    """
+    Builds the cache if SEMANTIC_CACHE_ENABLED is true, else returns None. Settings:
+    SEMANTIC_CACHE_THRESHOLD (cosine similarity, default 0.92), SEMANTIC_CACHE_MAX_ENTRIES (5000),
+    SEMANTIC_CACHE_TTL (seconds, 3600), SEMANTIC_CACHE_DIMENSIONS (1024).
+    """
+    if os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() not in ("1", "true", "yes"):
+        return None
+    cache = SemanticCache(
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+        max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000")),
+        ttl_seconds=int(os.getenv("SEMANTIC_CACHE_TTL", "3600")),
+        dimensions=int(os.getenv("SEMANTIC_CACHE_DIMENSIONS", "1024")),
+    )
+    logging.info(f"Using semantic cache for first messages (threshold {cache.threshold}, {cache.max_entries} entries)")
+    return cache
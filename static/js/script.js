@@ -13,6 +13,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- Sidebar Elements ---
     const newChatButton = document.getElementById('new-chat-button');
     const chatList = document.getElementById('chat-list');
+    const chatListContainer = chatList.closest('.chat-list-container');
 
     // --- API Key Modal Elements ---
     const saveKeysButton = document.getElementById('save-keys-button');
@@ -27,6 +28,11 @@ document.addEventListener('DOMContentLoaded', () => {
     // Initialize currentChatId by checking if an item has the 'active' class from server render
     let currentChatId = document.querySelector('#chat-list .list-group-item.active')?.dataset.chatId || null;
     console.log("Initial currentChatId:", currentChatId);
+    // Paging: the server renders only the newest chats and the newest page of the current chat's history
+    let chatListCursor = chatList.dataset.nextCursor || null; // Cursor for the next (older) page of chats, null when done
+    let isLoadingChats = false;
+    let historyStart = parseInt(chatWindow.dataset.historyStart || '0', 10); // Index of the oldest message shown
+    let isLoadingHistory = false;
 
     // --- Utility Functions ---
 
@@ -38,8 +44,43 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    // --- Append Message with Code Block Handling ---
-    function appendMessage(sender, text, isError = false) {
+    // Unique key per submitted message: a retried request with the same key gets the original reply
+    function newIdempotencyKey() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID(); // Secure contexts only (https, localhost)
+        return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    }
+
+    // Read a fetch() response body as Server-Sent Events, calling onEvent(eventName, data) per event
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let eventName = 'message';
+                const dataLines = [];
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                    else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+                });
+                if (dataLines.length > 0) {
+                    await onEvent(eventName, JSON.parse(dataLines.join('\n')));
+                }
+            }
+        }
+    }
+
+    // --- Build a Message Element with Code Block Handling ---
+    function buildMessageElement(sender, text, isError = false) {
         const messageDiv = document.createElement('div');
         messageDiv.classList.add('message', sender === 'user' ? 'user-message' : 'bot-message');
         const isLikelyHtml = /[<>&]/.test(text) && !text.includes('```'); // Basic check
@@ -101,10 +142,28 @@ document.addEventListener('DOMContentLoaded', () => {
             messageDiv.textContent = text;
         }
 
-        chatWindow.appendChild(messageDiv);
+        return messageDiv;
+    }
+
+    // --- Append Message ---
+    function appendMessage(sender, text, isError = false) {
+        chatWindow.appendChild(buildMessageElement(sender, text, isError));
         scrollToBottom(); // Scroll after adding ANY message
     }
 
+    // Insert older messages above the ones shown, keeping the visible messages in place
+    function prependMessages(messages) {
+        const previousHeight = chatWindow.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        messages.forEach(message => {
+            if (message.role === 'user' || message.role === 'assistant') {
+                fragment.appendChild(buildMessageElement(message.role, message.content, message.is_error || false));
+            }
+        });
+        chatWindow.insertBefore(fragment, chatWindow.firstChild);
+        chatWindow.scrollTop += chatWindow.scrollHeight - previousHeight;
+    }
+
 
     // Show/hide the typing indicator
     function showTypingIndicator(show) {
@@ -182,8 +241,11 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-     // Add a new chat item to the top of the sidebar list
-     function addChatToList(chatId, title, isActive = false) {
+     // Add a chat item to the top of the sidebar list (or to the bottom, for older pages)
+     function addChatToList(chatId, title, isActive = false, atEnd = false) {
+         if (atEnd && chatList.querySelector(`.list-group-item[data-chat-id="${chatId}"]`)) {
+             return; // Already shown (e.g. the active chat rendered out of order)
+         }
          const listItem = document.createElement('li');
          listItem.className = 'list-group-item list-group-item-action d-flex justify-content-between align-items-center';
          listItem.dataset.chatId = chatId;
@@ -218,6 +280,11 @@ document.addEventListener('DOMContentLoaded', () => {
             </div>
          `;
 
+         if (atEnd) {
+             chatList.appendChild(listItem);
+             return;
+         }
+
          // Remove existing active class before adding new item
          const currentlyActive = chatList.querySelector('.list-group-item.active');
          if (currentlyActive) {
@@ -231,9 +298,86 @@ document.addEventListener('DOMContentLoaded', () => {
          }
      }
 
+    // Apply a title that arrived after the chat was created (sidebar item + header)
+    function applyGeneratedTitle(chatId, title) {
+        const listItem = chatList.querySelector(`.list-group-item[data-chat-id="${chatId}"]`);
+        if (listItem) {
+            const titleInput = listItem.querySelector('.chat-title-input');
+            const titleSpan = listItem.querySelector('.chat-title-text');
+            // Don't clobber a title the user is currently editing
+            if (titleInput && titleSpan && titleInput.classList.contains('d-none')) {
+                titleInput.value = title;
+                titleInput.dataset.originalTitle = title;
+                titleSpan.textContent = title.substring(0, 25) + (title.length > 25 ? '...' : '');
+            }
+        }
+        if (currentChatId === chatId) {
+            currentChatTitleElement.textContent = title;
+            document.title = `${title} - Multi-AI Chatbot`;
+        }
+    }
+
+    // Poll for a title still being generated in the background (used if the stream closed before it was ready)
+    async function pollChatTitle(chatId, attemptsLeft = 5, delayMs = 2000) {
+        try {
+            const response = await fetch(`/chat_title/${chatId}`);
+            if (!response.ok) return;
+            const data = await response.json();
+            if (!data.pending) {
+                applyGeneratedTitle(chatId, data.title);
+            } else if (attemptsLeft > 1) {
+                setTimeout(() => pollChatTitle(chatId, attemptsLeft - 1, delayMs), delayMs);
+            }
+        } catch (error) {
+            console.warn('Error polling chat title:', error);
+        }
+    }
+
+    // Fetch the next page of older chats into the sidebar
+    async function loadMoreChats() {
+        if (!chatListCursor || isLoadingChats) return;
+        isLoadingChats = true;
+        try {
+            const response = await fetch(`/chats?before=${encodeURIComponent(chatListCursor)}`);
+            if (!response.ok) throw new Error(`Server error: ${response.status}`);
+            const data = await response.json();
+            data.chats.forEach(chat => addChatToList(chat.id, chat.title, false, true));
+            chatListCursor = data.next_cursor;
+        } catch (error) {
+            console.warn('Error loading more chats:', error);
+        } finally {
+            isLoadingChats = false;
+        }
+        // Keep going while the list doesn't fill the sidebar yet (nothing to scroll)
+        if (chatListCursor && chatListContainer.scrollHeight <= chatListContainer.clientHeight) {
+            loadMoreChats();
+        }
+    }
+
+    // Fetch the page of messages before the oldest one shown
+    async function loadOlderMessages() {
+        if (!currentChatId || historyStart <= 0 || isLoadingHistory) return;
+        isLoadingHistory = true;
+        const chatId = currentChatId;
+        try {
+            const response = await fetch(`/chat_history/${chatId}?before=${historyStart}`);
+            if (!response.ok) throw new Error(`Server error: ${response.status}`);
+            const data = await response.json();
+            if (chatId === currentChatId) { // Ignore if another chat was opened meanwhile
+                prependMessages(data.messages);
+                historyStart = data.start;
+            }
+        } catch (error) {
+            console.warn('Error loading older messages:', error);
+        } finally {
+            isLoadingHistory = false;
+        }
+    }
+
     // Clear chat window and maybe show initial message
     function clearChatWindow(showInitialMessage = true, messageText = null, isError = false) {
          chatWindow.innerHTML = ''; // Clear messages
+         historyStart = 0;
          if (showInitialMessage) {
              const initialHtmlContent = messageText ||
                 'Hello! Start a new chat or select one. <br><small class="text-muted">Remember to <button type="button" class="btn btn-link p-0 align-baseline" data-bs-toggle="modal" data-bs-target="#apiKeysModal">add your API keys</button> if needed.</small>';
@@ -512,6 +656,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
                  // Update UI
                  renderHistory(chatData.history); // Use the render function
+                 historyStart = chatData.history_start || 0; // Older messages load when scrolling up
                  setActiveChatItem(chatIdToLoad); // Update active state/buttons
                  const safeTitle = chatData.title || "Chat"; // Use escaped title from backend
                  currentChatTitleElement.textContent = safeTitle;
@@ -557,9 +702,9 @@ document.addEventListener('DOMContentLoaded', () => {
         showTypingIndicator(true);
 
         try {
-            const response = await fetch('/chat', {
+            const response = await fetch('/chat/stream', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: { 'Content-Type': 'application/json', 'Idempotency-Key': newIdempotencyKey() },
                 body: JSON.stringify({
                     message: messageToSend,
                     model_choice: selectedModel
@@ -567,33 +712,52 @@ document.addEventListener('DOMContentLoaded', () => {
                 }),
             });
 
-            showTypingIndicator(false);
-            const data = await response.json(); // Assume JSON response for errors too based on backend logic
-
-            // Use backend's 'is_error' flag and message content directly
-            const responseText = data.response || data.error || "An unexpected empty response occurred.";
-            const isErrorFromServer = data.is_error || !response.ok; // Fallback check on response status
-
-            if (responseText) {
-                 appendMessage('bot', responseText, isErrorFromServer);
-            } else {
-                 console.warn("Received response but no message content or error:", data);
-                 // Avoid showing an empty bubble
+            if (!response.ok || !response.body) {
+                // Validation errors come back as plain JSON, like /chat
+                showTypingIndicator(false);
+                const data = await response.json().catch(() => ({ error: `Server error: ${response.status}` }));
+                appendMessage('bot', data.response || data.error || "An unexpected empty response occurred.", true);
+                return;
             }
 
-            // Handle new chat creation feedback only if a new chat was actually created
-            if (data.new_chat_info && isCurrentlyNewChat) {
-                 console.log("New chat created by backend:", data.new_chat_info);
-                 addChatToList(data.new_chat_info.id, data.new_chat_info.title, true); // Add and make active
-                 setActiveChatItem(data.new_chat_info.id); // Update state, title, buttons
-                 currentChatTitleElement.textContent = data.new_chat_info.title; // Update header
-                 document.title = `${data.new_chat_info.title} - Multi-AI Chatbot`;
-            } else if (isCurrentlyNewChat && !data.new_chat_info && !isErrorFromServer) {
-                 // If it was supposed to be a new chat but backend didn't confirm (and no error occurred)
-                 // This might indicate a logic issue. Maybe reload the chat list?
-                 console.warn("Sent message in 'new chat' mode, but backend did not return new_chat_info and no error reported. State might be inconsistent.");
-                 // Force reload might be too disruptive, just log for now.
-            }
+            let streamingDiv = null; // Bot bubble that grows as tokens arrive
+            let streamedText = '';
+            let pendingTitleChatId = null; // New chat whose generated title hasn't arrived yet
+
+            await readEventStream(response, async (eventName, data) => {
+                if (eventName === 'meta' && data.new_chat_info && isCurrentlyNewChat) {
+                    // Show the new chat in the sidebar right away instead of after the full reply
+                    console.log("New chat created by backend:", data.new_chat_info);
+                    addChatToList(data.new_chat_info.id, data.new_chat_info.title, true); // Add and make active
+                    setActiveChatItem(data.new_chat_info.id); // Update state, title, buttons
+                    currentChatTitleElement.textContent = data.new_chat_info.title; // Update header
+                    document.title = `${data.new_chat_info.title} - Multi-AI Chatbot`;
+                    messageInput.disabled = true; // Keep input locked until the reply finishes
+                    sendButton.disabled = true;
+                    if (data.new_chat_info.title_pending) pendingTitleChatId = data.new_chat_info.id;
+                } else if (eventName === 'title') {
+                    applyGeneratedTitle(data.id, data.title);
+                    pendingTitleChatId = null;
+                } else if (eventName === 'token') {
+                    if (!streamingDiv) {
+                        showTypingIndicator(false);
+                        streamingDiv = document.createElement('div');
+                        streamingDiv.classList.add('message', 'bot-message');
+                        chatWindow.appendChild(streamingDiv);
+                    }
+                    streamedText += data.text;
+                    streamingDiv.textContent = streamedText; // Plain text while streaming; formatted on 'done'
+                    scrollToBottom();
+                } else if (eventName === 'done') {
+                    showTypingIndicator(false);
+                    if (streamingDiv) streamingDiv.remove();
+                    // Re-render the complete reply so code blocks are formatted
+                    const responseText = data.response || "An unexpected empty response occurred.";
+                    appendMessage('bot', responseText, data.is_error);
+                }
+            });
+            showTypingIndicator(false);
+            if (pendingTitleChatId) pollChatTitle(pendingTitleChatId);
 
         } catch (error) {
             showTypingIndicator(false);
@@ -761,7 +925,23 @@ document.addEventListener('DOMContentLoaded', () => {
      });
 
 
+    // Load older chats / messages when scrolled near the end
+    chatListContainer.addEventListener('scroll', () => {
+        if (chatListContainer.scrollTop + chatListContainer.clientHeight >= chatListContainer.scrollHeight - 100) {
+            loadMoreChats();
+        }
+    });
+    chatWindow.addEventListener('scroll', () => {
+        if (chatWindow.scrollTop < 100) {
+            loadOlderMessages();
+        }
+    });
+
+
     // --- Run Initialization ---
     initializeChatView();
+    if (chatListCursor && chatListContainer.scrollHeight <= chatListContainer.clientHeight) {
+        loadMoreChats();
+    }
 
 });
\ No newline at end of file